@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 00:41:27 2026
+
+@author: MIRI Pixel DB developers
+
+Benchmark suite for the ingest and query paths of the MIRI Pixel DB. Each benchmark case is a synthetic JPL LVL1 exposure of a given subarray,
+NINTS and NGROUPS (see generate_lvl1_exposure), which goes through the stages of a real ingest against a (scratch) postgresql DB:
+
+    pipefits          - pipefits.create_pipeline_ready_file on the LVL1 file
+    raw_ingest        - exposuresdb.add_raw_exposure_to_db on the *_pipe.fits file
+    corrected_ingest  - exposuresdb.add_corrected_exposure_to_db on synthetic *_ramp.fits and *_rateints.fits (or *_rate.fits) files standing
+                        in for the Detector1Pipeline products (see generate_corrected_exposure)
+    raw_cube, corrected_cube, pixel_history - the miridb.get_exposure_cube and miridb.get_pixel_history queries of the exposure
+
+Every stage runs in a freshly spawned process, so its peak RSS is its own, and reports its wall and CPU time, the rows written (or read), the
+bytes read (FITS files, or query results), rows/s, MB/s and peak RSS. The pipefits and ingest stages also report the breakdown of their time by
+sub-stage (FITS read, reshape, serialize, COPY, ... - see metrics.py), from a metrics log written next to the synthetic files. The size of
+each table holding the exposure is reported too - the exposure tables are emptied before each case, so the DB must be a scratch DB, holding
+nothing but benchmark exposures. The synthetic data depends only on the case and the seed, so reports written at different commits
+(with the same cases, options and machine) can be compared with compare_benchmarks. Usage:
+
+    $ python benchmark.py connection_string work_dir report_json [subarrays] [nints] [ngroups]
+    $ python benchmark.py compare baseline_json report_json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import multiprocessing
+from datetime import datetime
+import numpy as np
+import psycopg2
+from astropy.io import fits
+from sqlalchemy import Table, text
+from fitsreader import open_fits, read_image_cube
+from pixelmap import subarray_definitions, get_pixel_ids_from_header
+from exposuresdb import insert_pixel_detector_info, add_raw_exposure_to_db, add_corrected_exposure_to_db, is_view, table_exists
+from miridb import init_db, load_miri_tables, load_engine, delete_exposure, get_exposure_cube, get_pixel_history
+from miridb_script import load_ingest_tables
+from pipefits import create_pipeline_ready_file, write_streamed_fits
+from metrics import get_peak_rss_mb, enable_metrics, read_metrics, summarize_metrics
+
+""" Subarrays benchmarked by default, from the smallest to the full frame"""
+benchmark_subarrays = ['SUB64', 'SUB128', 'SUB256', 'BRIGHTSKY', 'FULL']
+
+""" Tables whose size is reported - the partitions of a partitioned table are included (see get_table_bytes)"""
+benchmark_tables = ['exposures', 'ramps', 'groups', 'correctedexposures', 'correctedramps', 'correctedgroups', 'pixelstats', 'ingeststate']
+
+""" Metrics compared by compare_benchmarks - all of them are better when lower"""
+compared_stage_metrics = ['seconds', 'cpu_seconds', 'peak_rss_mb']
+
+""" Changes of timings shorter than this (s) are not flagged as regressions by compare_benchmarks - they are mostly noise"""
+min_compared_seconds = 0.5
+
+""" Number of pixels whose history is queried in the pixel_history stage"""
+num_history_pixels = 100
+
+""" Frame time (s) of the full frame - the frame time of a subarray is scaled by its number of pixels"""
+full_frame_time = 2.775
+
+
+""" Name of the LVL1 file of a benchmark case"""
+def synthetic_exposure_name(subarray, nints, ngroups):
+    return 'BENCH_%s_%dx%d.fits' % (subarray, nints, ngroups)
+
+
+""" Synthetic ramps of one integration, as float32 (ngroups, nrows, ncols) ADC counts: a random offset and slope per pixel, plus read noise.
+    The values depend only on seed and integration, so the LVL1 file and the corrected files of an exposure see the same ramps."""
+def synthetic_ramps(seed, integration, ngroups, nrows, ncols):
+    rng = np.random.default_rng([seed, integration])
+    offsets = rng.uniform(8000, 12000, size=(nrows, ncols)).astype(np.float32)
+    slopes = rng.uniform(5, 200, size=(nrows, ncols)).astype(np.float32)
+    groups = np.arange(ngroups, dtype=np.float32)[:, np.newaxis, np.newaxis]
+    return offsets + slopes * groups + rng.normal(0, 3, size=(ngroups, nrows, ncols)).astype(np.float32)
+
+
+""" Write a synthetic JPL LVL1 exposure of a subarray (a key of pixelmap.subarray_definitions) to output_dir, with the header keywords
+    pipefits.Generate_JPL_Pipeline_Ready_File reads. The frames are written one integration at a time. Returns the path of the file."""
+def generate_lvl1_exposure(output_dir, subarray, nints, ngroups, seed=0):
+    (substrt1, substrt2), (subsize1, subsize2) = subarray_definitions[subarray]
+    """ the reference output rows follow the data rows - they are a quarter as many"""
+    naxis2 = subsize2 + subsize2 // 4
+    lvl1_file = synthetic_exposure_name(subarray, nints, ngroups)
+    frame_time = round(full_frame_time * subsize1 * naxis2 / (1032 * 1280), 5)
+    hdr = fits.Header()
+    hdr['ROWSTART'] = substrt2
+    """ Generate_JPL_Pipeline_Ready_File corrects the JPL COLSTART (SUBSTRT1 = 4*int(0.2*COLSTART + 0.8) - 3)"""
+    hdr['COLSTART'] = 5 * ((substrt1 + 3) // 4) - 3
+    hdr['ORIGIN'] = 'JPL'
+    hdr['FILENAME'] = lvl1_file
+    hdr['DATE_OBS'] = '2026-10-17'
+    hdr['TIME_OBS'] = '00:00:00'
+    hdr['DATE_END'] = 'yyyy-mm-dd'
+    hdr['TIME_END'] = 'hh:mm:ss'
+    hdr['OBS_ID'] = 0
+    hdr['SCA_ID'] = 20
+    hdr['DETECTOR'] = 'IC'
+    hdr['NFRAME'] = 1
+    hdr['NGROUPS'] = ngroups
+    hdr['NINT'] = nints
+    hdr['TFRAME'] = frame_time
+    hdr['TGROUP'] = frame_time
+    hdr['INTTIME'] = round(frame_time * ngroups, 5)
+    hdr['EXPTIME'] = round(frame_time * ngroups * nints, 5)
+    primaryhdu = fits.PrimaryHDU(header = hdr)
+    primaryhdu.data = np.broadcast_to(np.zeros(1, dtype=np.uint16), (nints * ngroups, naxis2, subsize1))
+    frames = (synthetic_ramps(seed, integration, ngroups, naxis2, subsize1).clip(0, 65535).astype(np.uint16) for integration in range(nints))
+    lvl1_path = os.path.join(output_dir, lvl1_file)
+    write_streamed_fits(fits.HDUList([primaryhdu]), [frames], lvl1_path)
+    return lvl1_path
+
+
+""" Write the synthetic Detector1Pipeline products of a pipeline ready file: the *_ramp.fits file (SCI, PIXELDQ, GROUPDQ and ERR extensions)
+    and the *_rateints.fits file (*_rate.fits for a single integration). The corrected ramps are the synthetic ramps of the exposure minus their
+    first group, a few groups are flagged as jumps, saturated or do not use, and the slopes are fitted from the first and last groups.
+    Returns the path of the *_ramp.fits file."""
+def generate_corrected_exposure(pipeline_ready_file, seed=0):
+    with open_fits(pipeline_ready_file) as pipe_hdu:
+        hdr = pipe_hdu[0].header.copy()
+        nints, ngroups, nrows, ncols = read_image_cube(pipe_hdu, 'SCI').shape
+    naxis2 = nrows + nrows // 4
+    """ the corrected ramps are computed once per integration and extension - this is not part of what is benchmarked"""
+    def corrected_ramps(integration):
+        ramps = synthetic_ramps(seed, integration, ngroups, naxis2, ncols)[:, :nrows]
+        return ramps - ramps[0]
+    def group_dq(integration):
+        rng = np.random.default_rng([seed, integration, 1])
+        draws = rng.random((ngroups, nrows, ncols))
+        dq = np.zeros((ngroups, nrows, ncols), dtype=np.uint8)
+        dq[draws < 0.005] |= 4
+        dq[draws < 0.001] |= 2
+        dq[draws < 0.0002] |= 1
+        return dq
+    def slopes(integration):
+        ramps = corrected_ramps(integration)
+        return (ramps[-1] - ramps[0]) / max(ngroups - 1, 1) / hdr['TGROUP']
+    corrected_ramp_file = pipeline_ready_file.replace('.fits', '_ramp.fits')
+    hdr['FILENAME'] = os.path.basename(corrected_ramp_file)
+    hdr['CAL_VER'] = '0.17.1'
+    hdr['CRDS_VER'] = '7.5.0'
+    hdr['CAL_VCS'] = 'RELEASE'
+    for step in ['S_DQINIT', 'S_SATURA', 'S_REFPIX', 'S_RSCD', 'S_LASTFR', 'S_LINEAR', 'S_JUMP']:
+        hdr[step] = 'COMPLETE'
+    hdr['S_DARK'] = 'SKIPPED'
+    ramp_hdus = fits.HDUList([fits.PrimaryHDU(header = hdr)])
+    for name, dtype, shape in [('SCI', np.float32, (nints, ngroups, nrows, ncols)), ('PIXELDQ', np.uint32, (nrows, ncols)),
+                               ('GROUPDQ', np.uint8, (nints, ngroups, nrows, ncols)), ('ERR', np.float32, (nints, ngroups, nrows, ncols))]:
+        ramp_hdus.append(fits.ImageHDU(np.broadcast_to(np.zeros(1, dtype=dtype), shape), name = name))
+    integrations = range(nints)
+    write_streamed_fits(ramp_hdus, [[], (corrected_ramps(integration) for integration in integrations), [np.zeros((nrows, ncols), dtype=np.uint32)],
+                                    (group_dq(integration) for integration in integrations),
+                                    (np.sqrt(np.abs(corrected_ramps(integration)) + 9) for integration in integrations)], corrected_ramp_file, overwrite=True)
+    slope_shape = (nints, nrows, ncols) if nints > 1 else (nrows, ncols)
+    slope_hdus = fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(np.broadcast_to(np.zeros(1, dtype=np.float32), slope_shape), name = 'SCI')])
+    slope_file = corrected_ramp_file.replace('_ramp.fits', '_rateints.fits' if nints > 1 else '_rate.fits')
+    write_streamed_fits(slope_hdus, [[], (slopes(integration) for integration in integrations)], slope_file, overwrite=True)
+    return corrected_ramp_file
+
+
+""" Run a stage function and measure it - called in the spawned process of the stage (see run_stage). The stage function returns the number of
+    rows it wrote (or read) and the number of bytes it read. start_rss_mb is the memory of the process before the stage (the imported modules).
+    With a metrics_path, metrics are logged there (it is emptied first) and the report's breakdown holds the counters of each sub-stage, summed
+    over the scopes of the stage (see metrics.summarize_metrics)."""
+def measure_stage(stage_function, stage_args, metrics_path=None):
+    if metrics_path:
+        if os.path.exists(metrics_path):
+            os.remove(metrics_path)
+        enable_metrics(metrics_path)
+    start_rss_mb = get_peak_rss_mb()
+    start, start_cpu = time.time(), time.process_time()
+    rows, data_bytes = stage_function(*stage_args)
+    seconds, cpu_seconds = time.time() - start, time.process_time() - start_cpu
+    stage_report = {'seconds': seconds, 'cpu_seconds': cpu_seconds, 'rows': rows, 'bytes': data_bytes, 'start_rss_mb': start_rss_mb, 'peak_rss_mb': get_peak_rss_mb(),
+                    'rows_per_second': rows / seconds if seconds else None, 'mb_per_second': data_bytes / 1e6 / seconds if seconds else None}
+    if metrics_path:
+        records = read_metrics(metrics_path) if os.path.exists(metrics_path) else []
+        summary = summarize_metrics([dict(record, scope=None) for record in records if record['stage'] != 'total'])
+        stage_report['breakdown'] = {stage: totals for (scope, stage), totals in summary.items()}
+    return stage_report
+
+
+""" Run a stage in a freshly spawned process, so that its peak RSS does not include the earlier stages - the time to start the process is not
+    measured. cpu_seconds only counts this process (all its threads): time spent in the postgresql server shows up as seconds - cpu_seconds.
+    metrics_path is the metrics log of the stage (see measure_stage)."""
+def run_stage(stage_function, *stage_args, metrics_path=None):
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(measure_stage, (stage_function, stage_args, metrics_path))
+
+
+""" Open the DB of a stage process and load the tables used by the ingest, as the ingest workers of miridb_script do"""
+def connect_stage(connection_string, schema_options):
+    engine = load_engine(connection_string)
+    session, base, connection, cursor = init_db(engine)
+    load_miri_tables(base, **schema_options)
+    return engine, session, connection, load_ingest_tables(engine, base)
+
+
+""" Number of rows a ramp ingest writes: one per ramp, plus one per group if groups_table is a table (not a view in compact_groups mode)"""
+def count_ingest_rows(number_of_ramps, ngroups, groups_table, connection):
+    return number_of_ramps * (1 if is_view(groups_table, connection) else 1 + ngroups)
+
+
+""" pipefits stage: write the pipeline ready file of an LVL1 exposure"""
+def pipefits_stage(lvl1_path):
+    with open_fits(lvl1_path) as lvl1_hdu:
+        nframes, naxis2, naxis1 = read_image_cube(lvl1_hdu, 0).shape
+    create_pipeline_ready_file(lvl1_path, 'JPL', os.path.dirname(lvl1_path) + '/')
+    return nframes * naxis2 * naxis1, os.path.getsize(lvl1_path)
+
+
+""" raw_ingest stage: add the pipeline ready file to the DB"""
+def raw_ingest_stage(connection_string, schema_options, ingest_options, pipeline_ready_file):
+    engine, session, connection, (exposures, ramps, groups, correctedexposures, correctedramps) = connect_stage(connection_string, schema_options)
+    add_raw_exposure_to_db(pipeline_ready_file, 'JPL', None, None, session, connection, exposures, ramps, **ingest_options)
+    with open_fits(pipeline_ready_file) as pipe_hdu:
+        nints, ngroups, nrows, ncols = read_image_cube(pipe_hdu, 'SCI').shape
+    rows = count_ingest_rows(nints * nrows * ncols, ngroups, 'groups', connection)
+    connection.close()
+    return rows, os.path.getsize(pipeline_ready_file)
+
+
+""" corrected_ingest stage: add the corrected ramp and slope files to the DB. The pixelstats rows are counted when the DB keeps them."""
+def corrected_ingest_stage(connection_string, schema_options, ingest_options, corrected_ramp_file, slope_file):
+    engine, session, connection, (exposures, ramps, groups, correctedexposures, correctedramps) = connect_stage(connection_string, schema_options)
+    add_corrected_exposure_to_db(corrected_ramp_file, session, connection, exposures, groups, ramps, correctedexposures, correctedramps, **ingest_options)
+    with open_fits(corrected_ramp_file) as corrected_ramp_hdu:
+        nints, ngroups, nrows, ncols = read_image_cube(corrected_ramp_hdu, 'SCI').shape
+    rows = count_ingest_rows(nints * nrows * ncols, ngroups, 'correctedgroups', connection)
+    if table_exists('pixelstats', connection):
+        rows += nrows * ncols
+    connection.close()
+    return rows, os.path.getsize(corrected_ramp_file) + os.path.getsize(slope_file)
+
+
+""" raw_cube and corrected_cube stages: rebuild the exposure cube of a ramp column from the DB - the rows are the ramps read"""
+def exposure_cube_stage(connection_string, exposure_name, column):
+    cube = get_exposure_cube(load_engine(connection_string), exposure_name, column)
+    return cube.shape[0] * cube.shape[2] * cube.shape[3], cube.nbytes
+
+
+""" pixel_history stage: query the history of a set of pixels - the rows are the ramps read"""
+def pixel_history_stage(connection_string, pixel_ids):
+    history = get_pixel_history(load_engine(connection_string), pixel_ids=pixel_ids)
+    return len(history['pixel_id']), sum(values.nbytes for values in history.values())
+
+
+""" Size on disk (bytes) of each of table_names that exists in the DB, including the partitions of partitioned tables"""
+def get_table_bytes(engine, table_names):
+    table_bytes = {}
+    with engine.connect() as con:
+        for table_name in table_names:
+            if con.execute(text('SELECT to_regclass(:table_name)'), table_name=table_name).scalar() is None:
+                continue
+            """ pg_partition_tree lists a partitioned table and its partitions, and nothing for a table that is not partitioned"""
+            table_bytes[table_name] = int(con.execute(text("""SELECT coalesce(sum(pg_total_relation_size(relid)), pg_total_relation_size(CAST(:table_name AS regclass)))
+                                                         FROM pg_partition_tree(CAST(:table_name AS regclass))"""), table_name=table_name).scalar())
+    return table_bytes
+
+
+""" Empty the exposure tables before a benchmark case, so that the table sizes measured after the ingest are those of the case's exposure
+    alone (deleted rows leave free space behind them, which a later ingest partly reuses). The DB must be a scratch DB: a ValueError is raised if
+    it holds exposures that are not benchmark exposures. The partitions of the benchmark exposures are dropped with them (see delete_exposure)."""
+def reset_benchmark_tables(engine):
+    with engine.connect() as con:
+        exposure_names = [row[0] for row in con.execute('SELECT exp FROM exposures')]
+    other_exposures = [exposure_name for exposure_name in exposure_names if not exposure_name.startswith('BENCH_')]
+    if other_exposures:
+        raise ValueError('Benchmarks need a scratch DB - this DB holds %d other exposures (e.g. %s)' % (len(other_exposures), other_exposures[0]))
+    for exposure_name in exposure_names:
+        delete_exposure(engine, exposure_name)
+    with engine.begin() as con:
+        """ groups and correctedgroups are views in compact_groups mode"""
+        tables = [table_name for table_name in benchmark_tables
+                  if con.execute(text('SELECT relkind FROM pg_class WHERE oid = to_regclass(:table_name)'), table_name=table_name).scalar() in ('r', 'p')]
+        con.execute('TRUNCATE %s RESTART IDENTITY CASCADE' % ', '.join(tables))
+
+
+""" Create the MIRI Pixel DB tables (with the load_miri_tables options schema_options) and the detector/pixel rows if they are missing"""
+def prepare_benchmark_db(connection_string, schema_options):
+    engine = load_engine(connection_string)
+    session, base, connection, cursor = init_db(engine)
+    load_miri_tables(base, **schema_options)
+    base.metadata.create_all()
+    detectors = Table('detectors',  base.metadata, autoload=True, autoload_with=engine)
+    if session.query(detectors).count() == 0:
+        insert_pixel_detector_info(connection)
+    session.close()
+    connection.close()
+    return engine
+
+
+""" The git commit of the code being benchmarked, and whether the working tree has uncommitted changes (None outside a git checkout)"""
+def get_code_version():
+    code_directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=code_directory, stderr=subprocess.DEVNULL).decode().strip()
+        changes = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=code_directory, stderr=subprocess.DEVNULL).decode()
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+    return {'commit': commit, 'dirty': bool(changes.strip())}
+
+
+""" Run one benchmark case: generate the exposure in work_dir (the LVL1 file is reused if it is already there), empty the exposure tables (see
+    reset_benchmark_tables), run every stage, and delete the exposure from the DB (with keep_exposure=True it is left in the DB until the next
+    case). Returns the case's report."""
+def run_benchmark_case(connection_string, work_dir, subarray, nints, ngroups, schema_options, ingest_options, seed=0, keep_exposure=False):
+    lvl1_path = os.path.join(work_dir, synthetic_exposure_name(subarray, nints, ngroups))
+    if not os.path.exists(lvl1_path):
+        generate_lvl1_exposure(work_dir, subarray, nints, ngroups, seed)
+    pipeline_ready_file = lvl1_path.replace('.fits', '_pipe.fits')
+    exposure_name = os.path.basename(pipeline_ready_file)
+    engine = load_engine(connection_string)
+    """ the pipeline ready file is written again - create_pipeline_ready_file leaves an existing one alone"""
+    if os.path.exists(pipeline_ready_file):
+        os.remove(pipeline_ready_file)
+    reset_benchmark_tables(engine)
+    stage_metrics_path = lambda stage: pipeline_ready_file.replace('_pipe.fits', '_%s_metrics.jsonl' % stage)
+    stages = {}
+    print('%s: pipefits' % exposure_name)
+    stages['pipefits'] = run_stage(pipefits_stage, lvl1_path, metrics_path=stage_metrics_path('pipefits'))
+    corrected_ramp_file = generate_corrected_exposure(pipeline_ready_file, seed)
+    slope_file = corrected_ramp_file.replace('_ramp.fits', '_rateints.fits' if nints > 1 else '_rate.fits')
+    print('%s: raw_ingest' % exposure_name)
+    stages['raw_ingest'] = run_stage(raw_ingest_stage, connection_string, schema_options, ingest_options, pipeline_ready_file,
+                                     metrics_path=stage_metrics_path('raw_ingest'))
+    print('%s: corrected_ingest' % exposure_name)
+    stages['corrected_ingest'] = run_stage(corrected_ingest_stage, connection_string, schema_options, ingest_options, corrected_ramp_file, slope_file,
+                                           metrics_path=stage_metrics_path('corrected_ingest'))
+    table_bytes = get_table_bytes(engine, benchmark_tables)
+    print('%s: queries' % exposure_name)
+    stages['raw_cube'] = run_stage(exposure_cube_stage, connection_string, exposure_name, 'ramp')
+    stages['corrected_cube'] = run_stage(exposure_cube_stage, connection_string, exposure_name, 'corrected_ramp')
+    with open_fits(pipeline_ready_file) as pipe_hdu:
+        data_pixel_ids, reference_pixel_ids = get_pixel_ids_from_header(pipe_hdu[0].header)
+    stages['pixel_history'] = run_stage(pixel_history_stage, connection_string, [int(pixel_id) for pixel_id in data_pixel_ids[:num_history_pixels]])
+    if not keep_exposure:
+        delete_exposure(engine, exposure_name)
+    engine.dispose()
+    return {'exposure': exposure_name, 'subarray': subarray, 'nints': nints, 'ngroups': ngroups, 'pixels': len(data_pixel_ids),
+            'stages': stages, 'table_bytes': table_bytes}
+
+
+""" Run the benchmark cases - every combination of subarrays, nints and ngroups - against the DB of connection_string, with the synthetic files
+    in work_dir. schema_options are the load_miri_tables options of the DB (used if its tables have to be created) and ingest_options are
+    passed to add_raw_exposure_to_db and add_corrected_exposure_to_db (e.g. {'chunk_rows': 64, 'prefetch': 0}). The report is written to
+    report_path (JSON) if given, and returned."""
+def run_benchmarks(connection_string, work_dir, subarrays=benchmark_subarrays, nints=[2], ngroups=[10], schema_options={}, ingest_options={},
+                   seed=0, report_path=None, keep_exposures=False):
+    os.makedirs(work_dir, exist_ok=True)
+    engine = prepare_benchmark_db(connection_string, schema_options)
+    with engine.connect() as con:
+        server_version = con.execute('SHOW server_version').scalar()
+    engine.dispose()
+    report = {'created': datetime.now().isoformat(timespec='seconds'), 'code': get_code_version(),
+              'environment': {'host': platform.node(), 'platform': platform.platform(), 'cpus': os.cpu_count(), 'python': platform.python_version(),
+                              'numpy': np.__version__, 'psycopg2': psycopg2.__version__.split()[0], 'postgresql': server_version},
+              'options': {'schema': schema_options, 'ingest': ingest_options, 'seed': seed}, 'cases': []}
+    for subarray in subarrays:
+        for case_nints in nints:
+            for case_ngroups in ngroups:
+                report['cases'].append(run_benchmark_case(connection_string, work_dir, subarray, case_nints, case_ngroups, schema_options,
+                                                          ingest_options, seed, keep_exposures))
+                if report_path:
+                    with open(report_path, 'w') as report_file:
+                        json.dump(report, report_file, indent=1)
+    return report
+
+
+""" Compare two benchmark reports: for every stage of every case found in both, the change of each of compared_stage_metrics, and the change of
+    the size of every table. Returns a list of dictionaries (exposure, stage, metric, baseline, current, change), where change is the relative
+    change (current/baseline - 1) and regression is True when it is larger than tolerance (timings only if they take min_compared_seconds)."""
+def compare_benchmarks(baseline_report, current_report, tolerance=0.1):
+    baseline_cases = {case['exposure']: case for case in baseline_report['cases']}
+    comparisons = []
+    for case in current_report['cases']:
+        baseline_case = baseline_cases.get(case['exposure'])
+        if baseline_case is None:
+            continue
+        metrics = [(stage, metric, baseline_case['stages'][stage][metric], stage_metrics[metric])
+                   for stage, stage_metrics in case['stages'].items() if stage in baseline_case['stages'] for metric in compared_stage_metrics]
+        metrics += [('table_bytes', table_name, baseline_case['table_bytes'][table_name], size)
+                    for table_name, size in case['table_bytes'].items() if table_name in baseline_case['table_bytes']]
+        for stage, metric, baseline, current in metrics:
+            change = current / baseline - 1 if baseline else 0.0
+            timing_noise = metric in ('seconds', 'cpu_seconds') and max(baseline, current) < min_compared_seconds
+            comparisons.append({'exposure': case['exposure'], 'stage': stage, 'metric': metric, 'baseline': baseline, 'current': current,
+                                'change': change, 'regression': change > tolerance and not timing_noise})
+    return comparisons
+
+
+""" To run this script from the command line, do:
+    $ python benchmark.py connection_string work_dir report_json [subarrays] [nints] [ngroups]
+    where:
+    connection_string = connection string of a scratch DB - the benchmark exposures are added to it and deleted again
+    work_dir = directory for the synthetic FITS files (the LVL1 files are kept and reused by later runs)
+    report_json = path of the JSON report
+    subarrays, nints, ngroups = (optional) comma separated lists - defaults: SUB64,SUB128,SUB256,BRIGHTSKY,FULL 2 10
+    To compare two reports (e.g. of two commits), printing the changes and exiting with status 1 if a metric regressed by more than 10%, do:
+    $ python benchmark.py compare baseline_json report_json
+"""
+if __name__ == '__main__':
+    if sys.argv[1] == 'compare':
+        with open(sys.argv[2]) as baseline_file, open(sys.argv[3]) as report_file:
+            comparisons = compare_benchmarks(json.load(baseline_file), json.load(report_file))
+        for comparison in comparisons:
+            print('%-40s %-17s %-20s %12.4g %12.4g %+7.1f%%%s' % (comparison['exposure'], comparison['stage'], comparison['metric'], comparison['baseline'],
+                                                                comparison['current'], 100 * comparison['change'], '  REGRESSION' if comparison['regression'] else ''))
+        sys.exit(1 if any(comparison['regression'] for comparison in comparisons) else 0)
+    connection_string = sys.argv[1]
+    work_dir = sys.argv[2]
+    report_path = sys.argv[3]
+    subarrays = sys.argv[4].upper().split(',') if len(sys.argv) > 4 else benchmark_subarrays
+    nints = [int(value) for value in sys.argv[5].split(',')] if len(sys.argv) > 5 else [2]
+    ngroups = [int(value) for value in sys.argv[6].split(',')] if len(sys.argv) > 6 else [10]
+    run_benchmarks(connection_string, work_dir, subarrays, nints, ngroups, report_path=report_path)
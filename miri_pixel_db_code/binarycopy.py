@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 09:12:41 2026
+
+@author: MIRI Pixel DB developers
+
+The methods in this package write NumPy column buffers straight into a postgresql table using the binary COPY format
+(https://www.postgresql.org/docs/12/sql-copy.html#id-1.9.3.55.9.4). Every row of a MIRI Pixel DB ingest table is
+fixed-width (integers, floats, booleans and equal-length ramp arrays), so a whole COPY payload can be described by a single
+NumPy structured dtype and filled in one vectorized assignment per column - no text formatting on our side, and no text
+parsing on the postgresql side. The same layout is used in the other direction to read fixed-width query results back with
+a binary COPY TO (see copy_query_to_columns).
+"""
+import struct
+from io import BytesIO
+import numpy as np
+
+""" Every binary COPY stream starts with this signature, followed by a 32-bit flags field and a 32-bit header extension length"""
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('>h', -1)
+
+""" postgresql type OIDs (see pg_type) and the big-endian (network byte order) numpy dtype of their binary representation"""
+pg_binary_dtypes = {
+ 16: '?',     # boolean
+ 20: '>i8',   # bigint
+ 21: '>i2',   # smallint
+ 23: '>i4',   # integer
+ 700: '>f4',  # real
+ 701: '>f8'}  # double precision
+
+
+""" Query the postgresql catalog for the type of every column of a table. Returns a dictionary of column name -> (type_oid, element_oid),
+    where element_oid is None for scalar columns and the OID of the element type for array columns"""
+def get_table_types(table_name, connection):
+    cursor = connection.cursor()
+    cursor.execute("""SELECT a.attname, a.atttypid, t.typelem, t.typcategory FROM pg_attribute a
+                      JOIN pg_type t ON t.oid = a.atttypid
+                      WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped""", (table_name,))
+    table_types = {name: (type_oid, elem_oid if category == 'A' else None) for name, type_oid, elem_oid, category in cursor.fetchall()}
+    cursor.close()
+    return table_types
+
+
+""" Query the postgresql catalog for the type of each column we are about to COPY into. Returns a list of (type_oid, element_oid)
+    tuples, where element_oid is None for scalar columns and the OID of the element type for array columns"""
+def get_column_types(table_name, columns, connection):
+    table_types = get_table_types(table_name, connection)
+    return [table_types[column] for column in columns]
+
+
+""" Build the structured dtype describing one tuple of a binary COPY stream: a 16-bit field count, then for each field a 32-bit
+    byte length followed by the value. One dimensional arrays carry their own header (ndim, has-null flag, element OID, size, lower bound)
+    and every array element is preceded by its own 32-bit length."""
+def binary_row_dtype(column_types, array_lengths):
+    fields = [('nfields', '>i2')]
+    for i, ((type_oid, elem_oid), array_length) in enumerate(zip(column_types, array_lengths)):
+        if elem_oid is None:
+            fields += [('len_%d' % i, '>i4'), ('val_%d' % i, pg_binary_dtypes[type_oid])]
+        else:
+            element_dtype = np.dtype([('len', '>i4'), ('val', pg_binary_dtypes[elem_oid])])
+            fields += [('len_%d' % i, '>i4'), ('ndim_%d' % i, '>i4'), ('hasnull_%d' % i, '>i4'), ('elemtype_%d' % i, '>i4'),
+                       ('dim_%d' % i, '>i4'), ('lbound_%d' % i, '>i4'), ('val_%d' % i, element_dtype, (array_length,))]
+    return np.dtype(fields)
+
+
+""" Fill a structured array with the binary COPY representation of the given columns. column_values are NumPy arrays (1-D for scalar
+    columns, 2-D with one row per table row for array columns) or scalars, which are broadcast to every row. Conversion to network byte order
+    happens here, once, in the assignment into the outgoing buffer."""
+def encode_binary_rows(column_values, column_types):
+    column_values = [np.asarray(values) for values in column_values]
+    nrows = max([len(values) for values in column_values if values.ndim > 0], default=1)
+    array_lengths = [values.shape[-1] if elem_oid is not None else 0 for values, (type_oid, elem_oid) in zip(column_values, column_types)]
+    rows = np.empty(nrows, dtype=binary_row_dtype(column_types, array_lengths))
+    rows['nfields'] = len(column_values)
+    for i, (values, (type_oid, elem_oid), array_length) in enumerate(zip(column_values, column_types, array_lengths)):
+        if elem_oid is None:
+            rows['len_%d' % i] = np.dtype(pg_binary_dtypes[type_oid]).itemsize
+            rows['val_%d' % i] = values
+        else:
+            element_size = np.dtype(pg_binary_dtypes[elem_oid]).itemsize
+            rows['len_%d' % i] = 20 + array_length * (4 + element_size)
+            rows['ndim_%d' % i] = 1
+            rows['hasnull_%d' % i] = 0
+            rows['elemtype_%d' % i] = elem_oid
+            rows['dim_%d' % i] = array_length
+            rows['lbound_%d' % i] = 1
+            rows['val_%d' % i]['len'] = element_size
+            rows['val_%d' % i]['val'] = values
+    return rows
+
+
+""" Minimal file-like object handed to cursor.copy_expert - it serves the header, the encoded rows and the trailer without
+    concatenating them into yet another copy of the payload"""
+class BinaryCopyStream(object):
+    def __init__(self, rows):
+        self.buffers = [memoryview(PGCOPY_HEADER), memoryview(rows.view(np.uint8)), memoryview(PGCOPY_TRAILER)]
+
+    def read(self, size=-1):
+        while self.buffers and len(self.buffers[0]) == 0:
+            self.buffers.pop(0)
+        if not self.buffers:
+            return b''
+        if size is None or size < 0:
+            size = len(self.buffers[0])
+        chunk = self.buffers[0][:size]
+        self.buffers[0] = self.buffers[0][size:]
+        return chunk.tobytes()
+
+
+""" Add rows to table from a dictionary of NumPy column buffers ({column name: values}) using a binary COPY. The dtype of each buffer does not
+    need to match the table - values are cast to the column types found in the postgresql catalog as they are written to the outgoing buffer.
+    With commit=False the COPY is left in the caller's transaction."""
+def add_columns_to_table(column_data, table_name, connection, commit=True):
+    columns = tuple(column_data.keys())
+    column_types = get_column_types(table_name, columns, connection)
+    rows = encode_binary_rows(list(column_data.values()), column_types)
+    copy_binary_rows(rows, table_name, columns, connection, commit)
+
+
+""" COPY rows encoded by encode_binary_rows into the given columns of table_name. Encoding does not need the connection, so it can be done
+    ahead of the COPY by another thread (see prefetch.py). With commit=False the COPY is left in the caller's transaction."""
+def copy_binary_rows(rows, table_name, columns, connection, commit=True):
+    cursor = connection.cursor()
+    copy_sql = 'COPY %s (%s) FROM STDIN WITH (FORMAT binary)' % (table_name, ', '.join(columns))
+    cursor.copy_expert(copy_sql, BinaryCopyStream(rows), size=1 << 20)
+    if commit:
+        connection.commit()
+
+
+""" Decode a binary COPY TO payload whose rows are all fixed-width (no NULLs, every array of a column with array_lengths elements) into a
+    structured array with the dtype of binary_row_dtype - the payload is viewed in place, not parsed row by row. Raises ValueError if a row
+    does not have that layout."""
+def decode_binary_rows(payload, column_types, array_lengths):
+    payload = memoryview(payload)
+    if bytes(payload[:11]) != PGCOPY_HEADER[:11] or bytes(payload[-2:]) != PGCOPY_TRAILER:
+        raise ValueError('Not a binary COPY payload')
+    header_length = len(PGCOPY_HEADER) + struct.unpack('>i', payload[15:19])[0]
+    row_dtype = binary_row_dtype(column_types, array_lengths)
+    if (len(payload) - header_length - 2) % row_dtype.itemsize != 0:
+        raise ValueError('Rows of the COPY payload are not %d bytes wide - NULL values, or arrays that are not %s elements long' % (row_dtype.itemsize, array_lengths))
+    rows = np.frombuffer(payload[header_length:len(payload) - 2], dtype=row_dtype)
+    expected_lengths = [np.dtype(pg_binary_dtypes[type_oid]).itemsize if elem_oid is None else 20 + array_length * (4 + np.dtype(pg_binary_dtypes[elem_oid]).itemsize)
+                        for (type_oid, elem_oid), array_length in zip(column_types, array_lengths)]
+    if len(rows) and ((rows['nfields'] != len(column_types)).any() or any((rows['len_%d' % i] != length).any() for i, length in enumerate(expected_lengths))):
+        raise ValueError('Rows of the COPY payload do not match the expected columns - NULL values, or arrays that are not %s elements long' % (array_lengths,))
+    return rows
+
+
+""" Run query and return its columns as NumPy arrays (1-D for scalar columns, 2-D for array columns, in network byte order), transferred with
+    a single binary COPY TO. column_types are the (type_oid, element_oid) of the query's columns (see get_column_types) and array_lengths the
+    number of elements of each array column (0 for scalar columns) - every row must have that fixed-width layout (see decode_binary_rows)."""
+def copy_query_to_columns(query, column_types, array_lengths, connection):
+    buffer = BytesIO()
+    cursor = connection.cursor()
+    cursor.copy_expert('COPY (%s) TO STDOUT WITH (FORMAT binary)' % query, buffer, size=1 << 20)
+    cursor.close()
+    rows = decode_binary_rows(buffer.getbuffer(), column_types, array_lengths)
+    return [rows['val_%d' % i] if elem_oid is None else rows['val_%d' % i]['val'] for i, (type_oid, elem_oid) in enumerate(column_types)]
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 16:40:05 2026
+
+@author: MIRI Pixel DB developers
+
+The methods in this package implement a bulk-load session for backfilling many exposures. While a session is open the secondary indexes,
+unique constraints and foreign keys of the ramps, groups, correctedramps and correctedgroups tables are dropped, so every COPY only
+writes table pages. Closing the session rebuilds the indexes and re-adds the constraints (foreign keys are added NOT VALID, then validated
+with a single scan per constraint), and reports anything that could not be restored.
+
+The dropped definitions are saved in the bulkloadddl table before anything is dropped, so a session interrupted by a crash can still be
+closed later (end_bulk_load) from another process. Usage:
+
+    with bulk_load_session(engine):
+        ... ingest exposures ...
+"""
+from sqlalchemy import text
+from contextlib import contextmanager
+
+""" Tables whose indexes and constraints are dropped during a bulk load"""
+bulk_load_tables = ['ramps', 'groups', 'correctedramps', 'correctedgroups']
+
+""" Indexes the ingest functions themselves query (see exposuresdb.get_exposure_ramp_and_group_ids) - these are kept, otherwise every
+    corrected ingest would scan the whole ramps/groups tables"""
+ingest_lookup_indexes = [('ramps', 'exp_id'), ('groups', 'ramp_id')]
+
+""" Order in which saved definitions are restored: indexes and unique constraints first, so foreign keys are validated last"""
+restore_order = ['index', 'unique', 'foreign key']
+
+
+""" Definitions of the indexes and constraints dropped by begin_bulk_load"""
+def find_bulk_load_ddl(con):
+    tables = [table_name for table_name in bulk_load_tables if con.execute(text('SELECT to_regclass(:t)'), t=table_name).scalar() is not None]
+    indexes = con.execute(text("""SELECT c.relname, i.relname, pg_get_indexdef(i.oid), array_agg(a.attname::text) FROM pg_index x
+                                  JOIN pg_class c ON c.oid = x.indrelid JOIN pg_class i ON i.oid = x.indexrelid
+                                  JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = ANY(x.indkey)
+                                  WHERE c.relname = ANY(:tables) AND c.relnamespace = 'public'::regnamespace AND NOT x.indisprimary
+                                  AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = x.indexrelid)
+                                  GROUP BY c.relname, i.relname, i.oid"""), tables=tables).fetchall()
+    ddl = [(table_name, index_name, 'index', definition.replace(' ON ONLY ', ' ON ')) for table_name, index_name, definition, columns in indexes
+           if (table_name, columns[0]) not in ingest_lookup_indexes or len(columns) > 1]
+    constraints = con.execute(text("""SELECT c.relname, k.conname, k.contype, pg_get_constraintdef(k.oid) FROM pg_constraint k
+                                      JOIN pg_class c ON c.oid = k.conrelid
+                                      WHERE c.relname = ANY(:tables) AND c.relnamespace = 'public'::regnamespace AND k.contype IN ('u', 'f')
+                                      AND k.conparentid = 0"""), tables=tables).fetchall()
+    ddl += [(table_name, constraint_name, {'u': 'unique', 'f': 'foreign key'}[contype], definition) for table_name, constraint_name, contype, definition in constraints]
+    return ddl
+
+
+""" Start a bulk-load session: save, then drop, the secondary indexes, unique constraints and foreign keys of the bulk_load_tables.
+    Raises RuntimeError if a session is already open (its saved definitions have not been restored yet)."""
+def begin_bulk_load(engine):
+    with engine.begin() as con:
+        con.execute("""CREATE TABLE IF NOT EXISTS bulkloadddl (table_name varchar(255), object_name varchar(255), object_type varchar(255),
+                       definition text, PRIMARY KEY (table_name, object_name))""")
+        if con.execute('SELECT count(*) FROM bulkloadddl').scalar() > 0:
+            raise RuntimeError('A bulk load session is already open - call end_bulk_load to restore its indexes and constraints first')
+        ddl = find_bulk_load_ddl(con)
+        for table_name, object_name, object_type, definition in ddl:
+            con.execute(text('INSERT INTO bulkloadddl VALUES (:t, :o, :ty, :d)'), t=table_name, o=object_name, ty=object_type, d=definition)
+        for table_name, object_name, object_type, definition in sorted(ddl, key=lambda entry: -restore_order.index(entry[2])):
+            if object_type == 'index':
+                con.execute('DROP INDEX %s' % object_name)
+            else:
+                con.execute('ALTER TABLE %s DROP CONSTRAINT %s' % (table_name, object_name))
+    print('Bulk load session started: dropped %d indexes/constraints' % len(ddl))
+    return ddl
+
+
+""" Restore one saved index or constraint in its own transaction. Foreign keys are added NOT VALID and then validated, which checks
+    every existing row in one scan without blocking writes to the referenced table; partitioned tables do not support NOT VALID foreign keys,
+    so those are added (and checked) directly."""
+def restore_bulk_load_object(con, table_name, object_name, object_type, definition):
+    if object_type == 'index':
+        con.execute(definition)
+    elif object_type == 'unique':
+        con.execute('ALTER TABLE %s ADD CONSTRAINT %s %s' % (table_name, object_name, definition))
+    elif con.execute(text('SELECT relkind FROM pg_class WHERE oid = CAST(:t AS regclass)'), t=table_name).scalar() == 'p':
+        con.execute('ALTER TABLE %s ADD CONSTRAINT %s %s' % (table_name, object_name, definition))
+    else:
+        con.execute('ALTER TABLE %s ADD CONSTRAINT %s %s NOT VALID' % (table_name, object_name, definition))
+        con.execute('ALTER TABLE %s VALIDATE CONSTRAINT %s' % (table_name, object_name))
+    con.execute(text('DELETE FROM bulkloadddl WHERE table_name = :t AND object_name = :o'), t=table_name, o=object_name)
+
+
+""" End a bulk-load session: rebuild every saved index and constraint. Objects that fail (e.g. a foreign key violated by a loaded row) are
+    rolled back individually, kept in bulkloadddl so end_bulk_load can be called again once the data is fixed, and returned as a list of
+    dictionaries (table, object, type, error). A report is printed either way."""
+def end_bulk_load(engine):
+    with engine.begin() as con:
+        if con.execute("SELECT to_regclass('bulkloadddl')").scalar() is None:
+            print('No bulk load session to end')
+            return []
+        saved_ddl = con.execute('SELECT table_name, object_name, object_type, definition FROM bulkloadddl').fetchall()
+    failures = []
+    for table_name, object_name, object_type, definition in sorted(saved_ddl, key=lambda entry: restore_order.index(entry[2])):
+        try:
+            with engine.begin() as con:
+                restore_bulk_load_object(con, table_name, object_name, object_type, definition)
+        except Exception as error:
+            failures.append({'table': table_name, 'object': object_name, 'type': object_type, 'error': str(getattr(error, 'orig', error)).strip()})
+    print('Bulk load session ended: restored %d of %d indexes/constraints' % (len(saved_ddl) - len(failures), len(saved_ddl)))
+    for failure in failures:
+        print('  FAILED %(type)s %(object)s on %(table)s: %(error)s' % failure)
+    return failures
+
+
+""" Context manager wrapping begin_bulk_load/end_bulk_load - the session is ended even if the load raises"""
+@contextmanager
+def bulk_load_session(engine):
+    begin_bulk_load(engine)
+    try:
+        yield
+    finally:
+        end_bulk_load(engine)
@@ -8,20 +8,21 @@ Created on Mon Sep 17 10:28:20 2019
 This package contains all the methods necessary to add exposure data to the MIRI Pixel DB.
 
 """
-from astropy.io import fits
 import numpy as np
 import os
 from datetime import datetime
-import itertools
 import pandas as pd
 from io import StringIO
 import time
+import warnings
+from binarycopy import get_table_types, get_column_types, encode_binary_rows, copy_binary_rows
+from prefetch import PrefetchIterator
+from metrics import measure, measured, instrumented
+from fitsreader import open_fits, read_image_cube
+from pixelmap import get_pixel_ids_from_header
 
-""" Uncomment these 4 lines below to profile functions using the @profile decorator"""
-# import line_profiler
-# import atexit
-# profile = line_profiler.LineProfiler()
-# atexit.register(profile.print_stats)
+""" The ingest functions below record the time of each of their stages (FITS read, reshape, DQ decode, serialize, COPY, ...) when metrics are
+    on - set MIRIDB_METRICS to the path of a log, and see metrics.py"""
 
 
 """ The function below, add_rows_to_table, is the fastest way I found to insert many rows into a postgresql table. This method
@@ -43,36 +44,598 @@ that I have found.
 More info on this solution found here:
 https://stackoverflow.com/questions/23103962/how-to-write-dataframe-to-postgres-table
 https://www.codementor.io/bruce3557/graceful-data-ingestion-with-sqlalchemy-and-pandas-pft7ddcy6 """
-def add_rows_to_table(df, table_name, connection):
+def add_rows_to_table(df, table_name, connection, commit=True):
     """add rows to table via a pandas DataFrame"""
+    output = format_rows_as_text(df)
+    cursor = connection.cursor()
+    columns_mine = tuple(df.columns)
+    cursor.copy_from(output, table_name, null="", columns = columns_mine)
+    if commit:
+        connection.commit()
+
+
+""" Tab separated text of the rows of a pandas DataFrame, as read by add_rows_to_table"""
+def format_rows_as_text(df):
     output = StringIO()
     df.to_csv(output, sep='\t',header=False,index=False)
     output.seek(0)
+    return output
+
+
+""" The ramps, groups, correctedramps and correctedgroups tables are filled from dictionaries of NumPy column buffers. By default these are
+    sent with a binary COPY (see binarycopy.py), which skips formatting every value to text here and parsing it again in postgresql - for these
+    tables that text round trip was the bulk of the add_rows_to_table time reported in code_profile_info.txt. copy_format='text' keeps the
+    original DataFrame/CSV path, with 2-D (array column) buffers converted by prep_ramps_for_db. With commit=False the COPY is left in the
+    caller's transaction, so several COPYs can be committed together."""
+def copy_columns_to_table(column_data, table_name, connection, copy_format='binary', commit=True):
+    prepared_copy = prepare_copy(column_data, table_name, get_table_types(table_name, connection), copy_format)
+    execute_copy(prepared_copy, connection, commit)
+
+
+""" Prepare the COPY of column_data into table_name (see copy_columns_to_table) without using the connection, so it can be done in a background
+    thread while another COPY runs (see prefetch.py): table_types are the column types of the table (binarycopy.get_table_types). Returns the
+    prepared copy - (table_name, columns, copy_format, nrows, payload), where the payload is the encoded binary rows or the tab separated text."""
+def prepare_copy(column_data, table_name, table_types, copy_format='binary'):
+    columns = tuple(column_data.keys())
+    if copy_format not in ('binary', 'text'):
+        raise ValueError("copy_format must be 'binary' or 'text', not %r" % copy_format)
+    nrows = max([len(values) for values in column_data.values() if np.ndim(values) > 0], default=0)
+    check_narrow_column_types(column_data, table_name, table_types)
+    with measure('serialize') as stage:
+        if copy_format == 'binary':
+            payload = encode_binary_rows(list(column_data.values()), [table_types[column] for column in columns])
+            stage['bytes'] = payload.nbytes
+        else:
+            df_dict = {}
+            for column, values in column_data.items():
+                values = np.asarray(values)
+                if values.ndim == 2:
+                    values = prep_ramps_for_db(values)
+                elif values.ndim == 0:
+                    values = np.full(nrows, values)
+                elif not values.dtype.isnative:
+                    values = values.astype(values.dtype.newbyteorder('='))
+                df_dict[column] = values
+            payload = format_rows_as_text(pd.DataFrame(df_dict))
+            stage['bytes'] = payload.seek(0, os.SEEK_END)
+            payload.seek(0)
+        stage['rows'] = nrows
+    return table_name, columns, copy_format, nrows, payload
+
+
+""" Run a COPY prepared by prepare_copy. With commit=False the COPY is left in the caller's transaction."""
+def execute_copy(prepared_copy, connection, commit=True):
+    table_name, columns, copy_format, nrows, payload = prepared_copy
+    with measure('copy') as stage:
+        if copy_format == 'binary':
+            copy_binary_rows(payload, table_name, columns, connection, commit)
+            stage['bytes'] = payload.nbytes
+        else:
+            stage['bytes'] = payload.seek(0, os.SEEK_END)
+            payload.seek(0)
+            cursor = connection.cursor()
+            cursor.copy_from(payload, table_name, null="", columns = columns)
+            if commit:
+                connection.commit()
+        stage['rows'] = nrows
+
+
+""" Reserve a contiguous block of count primary keys from the sequence behind table_name.id_column and return the first id of the block,
+    so ids (and the foreign keys that point at them) can be computed with NumPy instead of being queried back after each COPY.
+    The advisory lock serializes reservations from concurrent ingests so their nextval/setval pairs cannot interleave. It is a session-level
+    lock, released as soon as the block is reserved: sequence updates are not transactional, so nothing is committed and the reservation can
+    be part of the caller's transaction (see merge_staged_corrected_exposure). Rows added to ramps, groups, correctedramps or correctedgroups
+    while an ingest is running must also take their ids from reserve_id_block."""
+@measured('id_query')
+def reserve_id_block(table_name, id_column, count, connection):
     cursor = connection.cursor()
-    columns_mine = tuple(df.columns)
-    cursor.copy_from(output, table_name, null="", columns = columns_mine)
+    cursor.execute("SELECT pg_get_serial_sequence(%s, %s)", (table_name, id_column))
+    sequence_name = cursor.fetchone()[0]
+    cursor.execute("SELECT pg_advisory_lock(%s::regclass::oid::bigint)", (sequence_name,))
+    try:
+        cursor.execute("SELECT setval(%s, nextval(%s) + %s - 1)", (sequence_name, sequence_name, max(count, 1)))
+        last_id = cursor.fetchone()[0]
+    except Exception:
+        """ the failed statement aborted the transaction - roll it back so the lock can be released"""
+        connection.rollback()
+        raise
+    finally:
+        cursor.execute("SELECT pg_advisory_unlock(%s::regclass::oid::bigint)", (sequence_name,))
+        cursor.close()
+    return last_id - max(count, 1) + 1
+
+
+""" Names of the per-exposure partitions of the tables that can be partitioned by exposure (see miridb.load_miri_tables). Every exposure's
+    ramps, groups, correctedramps and correctedgroups are written as one contiguous primary key block (see reserve_id_block), so these tables
+    are partitioned by RANGE of their primary key with exactly one partition per block - the primary keys, and the foreign keys that reference
+    them, are unchanged. Raw tables are suffixed with the exp_id, corrected tables with the corrected_exp_id."""
+exposure_partitions = {
+ 'ramps': 'ramps_exp_%d',
+ 'groups': 'groups_exp_%d',
+ 'correctedramps': 'correctedramps_cexp_%d',
+ 'correctedgroups': 'correctedgroups_cexp_%d'}
+
+""" Columns of the unique constraint created on each partition, in place of the constraint the table has when it is not partitioned"""
+exposure_partition_unique_columns = {
+ 'ramps': 'exp_id, pixel_id, intnumber',
+ 'groups': 'ramp_id, group_number',
+ 'correctedramps': 'corrected_exp_id, ramp_id',
+ 'correctedgroups': 'corr_ramp_id, group_id'}
+
+
+""" If table_name is partitioned, create the partition that holds the id block [first_id, first_id + count) of one exposure - exposure_id is the
+    exp_id (raw tables) or corrected_exp_id (corrected tables) used to name the partition. Does nothing for tables that are not partitioned.
+    With commit=False the partition is created in the caller's transaction."""
+def create_exposure_partition(table_name, exposure_id, first_id, count, connection, commit=True):
+    cursor = connection.cursor()
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = %s::regclass", (table_name,))
+    if cursor.fetchone()[0] == 'p':
+        partition_name = exposure_partitions[table_name] % exposure_id
+        cursor.execute('CREATE TABLE %s PARTITION OF %s (CONSTRAINT %s_unique UNIQUE (%s)) FOR VALUES FROM (%d) TO (%d)'
+                       % (partition_name, table_name, partition_name, exposure_partition_unique_columns[table_name], first_id, first_id + count))
+        if commit:
+            connection.commit()
+    cursor.close()
+
+
+""" Create the UNLOGGED staging tables of a corrected exposure (see add_corrected_exposure_to_db with staging=True): the columns of
+    correctedramps/correctedgroups without their ids and foreign keys, plus the pixel_id and intnumber of the raw ramp each row belongs to.
+    Returns the staging table names (None for the groups staging table if store_groups is False)."""
+def create_corrected_staging_tables(exp_id, store_groups, connection):
+    staging_tables = [('correctedramps', 'staging_correctedramps_exp_%d' % exp_id, 'corr_ramp_id, DROP COLUMN ramp_id, DROP COLUMN corrected_exp_id')]
+    if store_groups:
+        staging_tables.append(('correctedgroups', 'staging_correctedgroups_exp_%d' % exp_id, 'corr_group_id, DROP COLUMN group_id, DROP COLUMN corr_ramp_id'))
+    cursor = connection.cursor()
+    for table_name, staging_name, id_columns in staging_tables:
+        cursor.execute('DROP TABLE IF EXISTS %s' % staging_name)
+        cursor.execute('CREATE UNLOGGED TABLE %s AS SELECT r.pixel_id, r.intnumber, t.* FROM %s t, ramps r WITH NO DATA' % (staging_name, table_name))
+        cursor.execute('ALTER TABLE %s DROP COLUMN %s' % (staging_name, id_columns))
+    connection.commit()
+    cursor.close()
+    return staging_tables[0][1], staging_tables[1][1] if store_groups else None
+
+
+""" Column names of a table, in table order"""
+def get_table_columns(table_name, connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT attname FROM pg_attribute WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped ORDER BY attnum", (table_name,))
+    columns = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    return columns
+
+
+""" Drop tables (None entries are skipped)"""
+def drop_tables(table_names, connection):
+    cursor = connection.cursor()
+    for table_name in table_names:
+        if table_name is not None:
+            cursor.execute('DROP TABLE IF EXISTS %s' % table_name)
+    connection.commit()
+    cursor.close()
+
+
+""" Insert a row (a dictionary of column values) into table_name in the caller's transaction, and return the value of its id_column"""
+@measured('id_query')
+def insert_row(table_name, row, id_column, connection):
+    cursor = connection.cursor()
+    cursor.execute('INSERT INTO %s (%s) VALUES (%s) RETURNING %s' % (table_name, ', '.join(row.keys()), ', '.join(['%s'] * len(row)), id_column),
+                   list(row.values()))
+    row_id = cursor.fetchone()[0]
+    cursor.close()
+    return row_id
+
+
+""" Ingest checkpoints: if the DB has an ingeststate table (see miridb.load_miri_tables), add_raw_exposure_to_db and add_corrected_exposure_to_db
+    record the progress of each exposure in it. The exposure row, its id blocks and its partitions are committed together with a 'loading'
+    state row; each chunk (its ramps and groups COPYs) is committed together with its checkpoint (chunks_done); and the state becomes 'complete' in
+    the transaction that writes the exposure's last rows. Ingesting the same file again skips a complete exposure and resumes a 'loading' one
+    after its last committed chunk - or cleans it up and starts over (see clean_up_ingest) if it cannot be resumed, e.g. it was started with a
+    different chunk_rows or copy_format (text COPY rounds float values, so the chunks of the two formats may not be mixed). A crash therefore never
+    leaves rows that are not accounted for by a checkpoint."""
+ingest_state_columns = ['exp', 'kind', 'exp_id', 'corrected_exp_id', 'stage', 'chunk_rows', 'copy_format', 'num_chunks', 'chunks_done', 'first_ramp_id',
+                        'first_group_id']
+
+""" First key of the session-level advisory lock held while an exposure is ingested - the second key is the hashtext of its file name. Two-key
+    advisory locks never conflict with the single-key locks of reserve_id_block."""
+INGEST_LOCK_KEY = 5582
+
+
+""" Take the advisory lock of an exposure (or corrected exposure) file name for this session, so no other process ingests or cleans it up
+    meanwhile. Returns False (without waiting) if another session holds it."""
+def lock_exposure_ingest(exp, connection):
+    cursor = connection.cursor()
+    cursor.execute('SELECT pg_try_advisory_lock(%s, hashtext(%s))', (INGEST_LOCK_KEY, exp))
+    locked = cursor.fetchone()[0]
+    connection.commit()
+    cursor.close()
+    return locked
+
+
+""" Release the lock taken by lock_exposure_ingest - any unfinished transaction (e.g. the chunk that was being written when the ingest failed)
+    is rolled back first"""
+def unlock_exposure_ingest(exp, connection):
+    connection.rollback()
+    cursor = connection.cursor()
+    cursor.execute('SELECT pg_advisory_unlock(%s, hashtext(%s))', (INGEST_LOCK_KEY, exp))
+    connection.commit()
+    cursor.close()
+
+
+""" The ingeststate row of an exposure or corrected exposure file name as a dictionary (see ingest_state_columns), or None"""
+def get_ingest_state(exp, connection):
+    cursor = connection.cursor()
+    cursor.execute('SELECT %s FROM ingeststate WHERE exp = %%s' % ', '.join(ingest_state_columns), (exp,))
+    row = cursor.fetchone()
+    cursor.close()
+    return dict(zip(ingest_state_columns, row)) if row is not None else None
+
+
+""" Insert or update the ingeststate row of ingest_state['exp'], in the caller's transaction - commit it together with the rows it accounts for"""
+def record_ingest_state(ingest_state, connection):
+    cursor = connection.cursor()
+    cursor.execute("""INSERT INTO ingeststate (%s, updated) VALUES (%s, now())
+                      ON CONFLICT (exp) DO UPDATE SET %s, updated = now()""" % (', '.join(ingest_state_columns), ', '.join(['%s'] * len(ingest_state_columns)),
+                   ', '.join('%s = EXCLUDED.%s' % (column, column) for column in ingest_state_columns[1:])),
+                   [ingest_state[column] for column in ingest_state_columns])
+    cursor.close()
+
+
+""" Delete everything a (possibly half-finished) ingest wrote, in one transaction: the exposure (kind 'raw', with any corrected exposures of it) or
+    the corrected exposure, their rows - partitions are detached and dropped, as in miridb.delete_exposure - and the ingeststate row"""
+def clean_up_ingest(ingest_state, connection):
+    cursor = connection.cursor()
+    if ingest_state['kind'] == 'raw':
+        cursor.execute('SELECT corrected_exp_id FROM correctedexposures WHERE exp_id = %s', (ingest_state['exp_id'],))
+        corrected_exp_ids = [row[0] for row in cursor.fetchall()]
+        delete_sql, delete_id = 'DELETE FROM exposures WHERE exp_id = %s', ingest_state['exp_id']
+    else:
+        corrected_exp_ids = [ingest_state['corrected_exp_id']]
+        delete_sql, delete_id = 'DELETE FROM correctedexposures WHERE corrected_exp_id = %s', ingest_state['corrected_exp_id']
+    partitions = [(table_name, exposure_partitions[table_name] % corrected_exp_id) for table_name in ['correctedgroups', 'correctedramps'] for corrected_exp_id in corrected_exp_ids]
+    if ingest_state['kind'] == 'raw':
+        partitions += [(table_name, exposure_partitions[table_name] % ingest_state['exp_id']) for table_name in ['groups', 'ramps']]
+    for table_name, partition in partitions:
+        cursor.execute('SELECT to_regclass(%s)', (partition,))
+        if cursor.fetchone()[0] is not None:
+            cursor.execute('ALTER TABLE %s DETACH PARTITION %s' % (table_name, partition))
+            cursor.execute('DROP TABLE %s' % partition)
+    cursor.execute(delete_sql, (delete_id,))
+    cursor.execute('DELETE FROM ingeststate WHERE exp = %s', (ingest_state['exp'],))
+    connection.commit()
+    cursor.close()
+    print('Cleaned up the unfinished ingest of %s' % ingest_state['exp'])
+
+
+""" The ingest state to continue from when exp (an exposure, kind 'raw', or corrected exposure, kind 'corrected') is ingested again: None to
+    start a new ingest, or its ingeststate row - complete, or resumable after its last checkpoint. An unfinished ingest that cannot be resumed (it
+    was started with other chunks or another copy_format, or resumable is False) is cleaned up first, and None is returned."""
+def find_resumable_ingest(exp, kind, chunk_rows, copy_format, num_chunks, connection, resumable=True):
+    ingest_state = get_ingest_state(exp, connection)
+    if ingest_state is None or ingest_state['stage'] == 'complete':
+        return ingest_state
+    if not resumable or (ingest_state['kind'], ingest_state['chunk_rows'], ingest_state['copy_format'], ingest_state['num_chunks']) != (kind, chunk_rows, copy_format, num_chunks):
+        clean_up_ingest(ingest_state, connection)
+        return None
+    return ingest_state
+
+
+""" Commit the caller's transaction, together with a checkpoint of ingest_state if use_checkpoints is True"""
+@measured('commit')
+def commit_ingest_state(ingest_state, use_checkpoints, connection):
+    if use_checkpoints:
+        record_ingest_state(ingest_state, connection)
+    connection.commit()
+
+
+""" The ingeststate rows (see get_ingest_state) of the exposures and corrected exposures whose ingest has not completed"""
+def get_unfinished_ingests(connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT %s FROM ingeststate WHERE stage <> 'complete' ORDER BY updated" % ', '.join(ingest_state_columns))
+    unfinished_ingests = [dict(zip(ingest_state_columns, row)) for row in cursor.fetchall()]
     connection.commit()
+    cursor.close()
+    return unfinished_ingests
+
+
+""" Clean up (see clean_up_ingest) every unfinished ingest that is not running - exposures being ingested by another process hold their advisory
+    lock and are skipped. Use this for files that will not be ingested again; files that will are resumed by the ingest functions. Returns the
+    file names cleaned up."""
+def clean_up_unfinished_ingests(connection):
+    cleaned_up = []
+    for exp in [ingest_state['exp'] for ingest_state in get_unfinished_ingests(connection)]:
+        if not lock_exposure_ingest(exp, connection):
+            continue
+        try:
+            """ the ingest may have completed or been cleaned up since the rows were listed"""
+            ingest_state = get_ingest_state(exp, connection)
+            if ingest_state is not None and ingest_state['stage'] != 'complete':
+                clean_up_ingest(ingest_state, connection)
+                cleaned_up.append(exp)
+        finally:
+            unlock_exposure_ingest(exp, connection)
+    return cleaned_up
+
+
+""" Move a staged corrected exposure into the permanent tables, in one transaction: insert the correctedexposures row, then the corrected
+    ramps and groups with a set-based INSERT ... SELECT that joins the staged (pixel_id, intnumber, group_number) keys to the raw exposure's
+    ramps and groups. The corr_ramp_id/corr_group_id blocks are reserved up front, and numbered in the order of the raw ramps (ramp_id, i.e.
+    integration then position in the subarray - pixel ids are not increasing in position order for every subarray) and group_number, as on
+    the direct path.
+    Raises ValueError (and nothing is committed) if any staged row has no matching raw ramp/group. With commit=False the merge is left in the
+    caller's transaction."""
+@measured('merge')
+def merge_staged_corrected_exposure(exp_id, corrected_exposure_row, number_of_ramps, ramp_len, ramps_staging, groups_staging, connection, commit=True):
+    first_corrected_ramp_id = reserve_id_block('correctedramps', 'corr_ramp_id', number_of_ramps, connection)
+    if groups_staging is not None:
+        first_corrected_group_id = reserve_id_block('correctedgroups', 'corr_group_id', number_of_ramps * ramp_len, connection)
+    corrected_exp_id = insert_row('correctedexposures', corrected_exposure_row, 'corrected_exp_id', connection)
+    cursor = connection.cursor()
+    create_exposure_partition('correctedramps', corrected_exp_id, first_corrected_ramp_id, number_of_ramps, connection, commit=False)
+    staged_columns = [column for column in get_table_columns(ramps_staging, connection) if column not in ('pixel_id', 'intnumber')]
+    cursor.execute("""INSERT INTO correctedramps (corr_ramp_id, ramp_id, corrected_exp_id, {columns})
+                      SELECT %(first_id)s - 1 + row_number() OVER (ORDER BY r.ramp_id), r.ramp_id, %(corrected_exp_id)s, {staged_columns}
+                      FROM {staging} s JOIN ramps r ON r.exp_id = %(exp_id)s AND r.pixel_id = s.pixel_id AND r.intnumber = s.intnumber""".format(
+                   columns=', '.join(staged_columns), staged_columns=', '.join('s.' + column for column in staged_columns), staging=ramps_staging),
+                   {'first_id': first_corrected_ramp_id, 'corrected_exp_id': corrected_exp_id, 'exp_id': exp_id})
+    if cursor.rowcount != number_of_ramps:
+        raise ValueError('%d of %d staged corrected ramps match a raw ramp of exposure %s' % (cursor.rowcount, number_of_ramps, exp_id))
+    if groups_staging is not None:
+        create_exposure_partition('correctedgroups', corrected_exp_id, first_corrected_group_id, number_of_ramps * ramp_len, connection, commit=False)
+        staged_columns = [column for column in get_table_columns(groups_staging, connection) if column not in ('pixel_id', 'intnumber')]
+        cursor.execute("""INSERT INTO correctedgroups (corr_group_id, group_id, corr_ramp_id, {columns})
+                          SELECT %(first_id)s + (cr.corr_ramp_id - %(first_ramp_id)s) * %(ramp_len)s + s.group_number - 1, g.group_id, cr.corr_ramp_id, {staged_columns}
+                          FROM {staging} s JOIN ramps r ON r.exp_id = %(exp_id)s AND r.pixel_id = s.pixel_id AND r.intnumber = s.intnumber
+                          JOIN groups g ON g.ramp_id = r.ramp_id AND g.group_number = s.group_number
+                          JOIN correctedramps cr ON cr.ramp_id = r.ramp_id AND cr.corrected_exp_id = %(corrected_exp_id)s""".format(
+                       columns=', '.join(staged_columns), staged_columns=', '.join('s.' + column for column in staged_columns), staging=groups_staging),
+                       {'first_id': first_corrected_group_id, 'first_ramp_id': first_corrected_ramp_id, 'ramp_len': ramp_len,
+                        'corrected_exp_id': corrected_exp_id, 'exp_id': exp_id})
+        if cursor.rowcount != number_of_ramps * ramp_len:
+            raise ValueError('%d of %d staged corrected groups match a raw group of exposure %s' % (cursor.rowcount, number_of_ramps * ramp_len, exp_id))
+    if commit:
+        connection.commit()
+    cursor.close()
+    return corrected_exp_id
+
+
+""" Return the ramp_ids and group_ids of a raw exposure, in the order the ramps/groups columns are built (integration, then pixel, then group).
+    Each exposure's ramps and groups are written as one contiguous id block (see reserve_id_block), so the ids are returned as ranges starting
+    at the first id of each block - we only check the block bounds against the expected number of ramps and groups. Exposures whose ids are not
+    contiguous (e.g. loaded concurrently by older versions of this code) fall back to querying every id into an array, ordered by ramp_id - ramps
+    are always written in (integration, position) order, while pixel ids are not increasing in position order for every subarray.
+    Use take_ids to pick the ids of a chunk from either form. With include_groups=False (groups stored as a view, see is_view) group_ids is None."""
+@measured('id_query')
+def get_exposure_ramp_and_group_ids(exp_id, number_of_ramps, ramp_len, connection, include_groups=True):
+    cursor = connection.cursor()
+    cursor.execute("SELECT min(ramp_id), max(ramp_id), count(*) FROM ramps WHERE exp_id = %s", (exp_id,))
+    first_ramp_id, last_ramp_id, ramp_count = cursor.fetchone()
+    if ramp_count != number_of_ramps:
+        raise ValueError('Exposure %s has %s ramps in the DB, %s expected from the FITS file' % (exp_id, ramp_count, number_of_ramps))
+    if last_ramp_id - first_ramp_id + 1 == number_of_ramps:
+        ramp_ids = range(first_ramp_id, first_ramp_id + number_of_ramps)
+    else:
+        cursor.execute("SELECT ramp_id FROM ramps WHERE exp_id = %s ORDER BY ramp_id", (exp_id,))
+        ramp_ids = np.array([row[0] for row in cursor.fetchall()])
+    group_ids = None
+    if include_groups:
+        cursor.execute("""SELECT (SELECT min(group_id) FROM groups WHERE ramp_id = %s), (SELECT max(group_id) FROM groups WHERE ramp_id = %s)""",
+                       (first_ramp_id, last_ramp_id))
+        first_group_id, last_group_id = cursor.fetchone()
+        if isinstance(ramp_ids, range) and last_group_id - first_group_id + 1 == number_of_ramps * ramp_len:
+            group_ids = range(first_group_id, first_group_id + number_of_ramps * ramp_len)
+        else:
+            cursor.execute("""SELECT g.group_id FROM groups g JOIN ramps r ON r.ramp_id = g.ramp_id WHERE r.exp_id = %s
+                              ORDER BY r.ramp_id, g.group_number""", (exp_id,))
+            group_ids = np.array([row[0] for row in cursor.fetchall()])
+    cursor.close()
+    return ramp_ids, group_ids
+
+
+""" True if table_name is a view rather than a table - in compact_groups mode (see miridb.load_miri_tables) groups and correctedgroups are
+    views over the ramp arrays, so the ingest functions do not write them"""
+def is_view(table_name, connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = %s::regclass", (table_name,))
+    relkind = cursor.fetchone()[0]
+    cursor.close()
+    return relkind in ('v', 'm')
+
+
+""" Column types used when the tables are created with narrow_types=True (see miridb.load_miri_tables), by postgresql type OID, and the NumPy
+    dtype they hold exactly. Raw values are 16-bit unsigned ADC counts, stored in a signed smallint minus RAW_ZERO_POINT (the same offset FITS
+    uses to store them as int16 with BZERO = 32768, see shift_raw_values), SCI/ERR values and slopes are float32 and are stored as real. The
+    32-bit DQ values stay integer. prepare_copy refuses to write a buffer that does not cast safely to its column's dtype here."""
+narrow_type_mapping = {
+ 21: np.dtype(np.int16),     # smallint: ramps.ramp, groups.raw_value
+ 700: np.dtype(np.float32)}  # real: slope, corrected and error values
+
+RAW_ZERO_POINT = 32768
+
+
+""" Offset subtracted from the raw values stored in the ramps/groups tables: RAW_ZERO_POINT if the ramp arrays are smallint (narrow_types),
+    0 otherwise. Add it back to the stored values to get the raw ADC counts."""
+def get_raw_zero_point(connection):
+    (type_oid, elem_oid), = get_column_types('ramps', ['ramp'], connection)
+    return RAW_ZERO_POINT if elem_oid == 21 else 0
+
+
+""" Shift raw values by zero_point (see get_raw_zero_point) before they are written. uint16 values are shifted with an exact bit flip;
+    any other integer dtype is range checked, since a value outside the smallint range would otherwise wrap silently in the COPY buffer."""
+def shift_raw_values(raw_values, zero_point):
+    if zero_point == 0:
+        return raw_values
+    if raw_values.dtype == np.uint16 and zero_point == RAW_ZERO_POINT:
+        return (raw_values ^ np.uint16(RAW_ZERO_POINT)).view(np.int16)
+    shifted = raw_values.astype(np.int64) - zero_point
+    if shifted.size and (shifted.min() < -2**15 or shifted.max() >= 2**15):
+        raise ValueError('Raw values between %d and %d do not fit a smallint column with zero point %d' % (raw_values.min(), raw_values.max(), zero_point))
+    return shifted.astype(np.int16)
+
+
+""" Raise a ValueError if any buffer of column_data would lose precision in its narrow column (see narrow_type_mapping) - the COPY
+    would otherwise round or wrap it silently. table_types are the column types of the table (binarycopy.get_table_types)."""
+def check_narrow_column_types(column_data, table_name, table_types):
+    for column, values in column_data.items():
+        type_oid, elem_oid = table_types[column]
+        narrow_dtype = narrow_type_mapping.get(type_oid if elem_oid is None else elem_oid)
+        if narrow_dtype is not None and not np.can_cast(np.asarray(values).dtype, narrow_dtype, casting='safe'):
+            raise ValueError('%s.%s holds %s values, %s values would not be stored exactly' % (table_name, column, narrow_dtype, np.asarray(values).dtype))
+
+
+""" True if table_name exists (as a table or a view)"""
+def table_exists(table_name, connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT to_regclass(%s)", (table_name,))
+    exists = cursor.fetchone()[0] is not None
+    cursor.close()
+    return exists
+
+
+""" Ids at the given (0-based) positions of a block returned by get_exposure_ramp_and_group_ids"""
+def take_ids(ids, positions):
+    if isinstance(ids, range):
+        return ids.start + positions
+    return ids[positions]
+
+
+""" Split an exposure cube of dimensions (nints, ngroups, nrows, ncols) into the chunks ingested by one COPY each. With chunk_rows=None the whole
+    exposure is a single chunk. Otherwise each chunk holds chunk_rows detector rows of a single integration, so the memory used per chunk
+    does not depend on NINTS or on the size of the array. Yields (integration slice, row slice, positions of the chunk's ramps in the exposure),
+    where ramp positions follow the exposure-wide order (integration, then row-major pixel)."""
+def iterate_ramp_chunks(cube_shape, chunk_rows=None):
+    nints, ngroups, nrows, ncols = cube_shape
+    if chunk_rows is None:
+        chunks_to_ingest = [(slice(0, nints), slice(0, nrows))]
+    else:
+        chunks_to_ingest = [(slice(integration, integration + 1), slice(row_start, min(row_start + chunk_rows, nrows)))
+                            for integration in range(nints) for row_start in range(0, nrows, chunk_rows)]
+    for int_slice, row_slice in chunks_to_ingest:
+        ramp_positions = (np.arange(int_slice.start, int_slice.stop)[:, np.newaxis] * (nrows * ncols)
+                          + np.arange(row_slice.start * ncols, row_slice.stop * ncols)[np.newaxis, :]).reshape(-1)
+        yield int_slice, row_slice, ramp_positions
+
+
+""" Default number of significant digits written for floating point array elements: 9 digits reproduce every float32 value
+    (the pipeline products) exactly, and 15 digits is what the float64 arithmetic in format_float_fields can guarantee."""
+default_float_digits = {2: 5, 4: 9, 8: 15}
+
+
+""" ASCII digits of every number from 0 to 9999, four characters per entry, so integers can be written four decimal places at a time with
+    a single table lookup. Each entry is viewed as one uint32. The table holds three variants: zero padded ('0042'), space padded ('  42'),
+    and blank ('    ', for leading blocks of a right-aligned number)."""
+digit_block_table = np.frombuffer(''.join(['%04d' % k for k in range(10000)] + ['%4d' % k for k in range(10000)] + ['    '] * 10000).encode(),
+                                  dtype=np.uint8).view(np.uint32)
+
+
+""" Right-align integers in fixed-width ASCII fields - returns a uint8 array with one extra trailing dimension of size width.
+    Leading characters are spaces (which postgresql ignores around array elements), or zeros with zero_pad=True.
+    width has to leave room for a minus sign if any value is negative."""
+def format_integer_fields(values, width, zero_pad=False):
+    remaining = np.abs(values.astype(np.int64 if width > 9 else np.int32))
+    num_blocks = -(-width // 4)
+    blocks = np.empty(values.shape + (num_blocks,), dtype=np.uint32)
+    for block in range(num_blocks - 1, -1, -1):
+        block_values = remaining % 10000
+        remaining //= 10000
+        if zero_pad:
+            blocks[..., block] = digit_block_table[block_values]
+        else:
+            """ zero padded while more significant digits follow, otherwise space padded - or blank if this block and all before it are zero"""
+            table_variant = (remaining == 0) * (1 + ((block_values == 0) & (block != num_blocks - 1)))
+            blocks[..., block] = digit_block_table[block_values + 10000 * table_variant]
+    fields = blocks.view(np.uint8)[..., 4 * num_blocks - width:]
+    negative = np.nonzero(values < 0)
+    if not zero_pad and len(negative[0]):
+        sign_place = (fields[negative] == ord(' ')).sum(axis=-1) - 1
+        fields[negative + (sign_place,)] = ord('-')
+    return fields
+
+
+""" Powers of ten looked up from a table rather than computed element by element with np.power"""
+powers_of_ten = 10.0**np.arange(-200, 201)
+
+
+""" Round magnitudes * 10**shift to integers - the power of ten is applied in two factors so it never overflows a float64"""
+def scale_to_mantissas(magnitudes, shift):
+    half = shift // 2
+    return np.rint(magnitudes * powers_of_ten[half + 200] * powers_of_ten[shift - half + 200]).astype(np.int64)
+
+
+""" Write floats in fixed-width scientific notation with the given number of significant digits, e.g. -1.37000000e+002 for 9 digits.
+    NaN and +/-Infinity are written with the spellings postgresql expects. Returns a uint8 array with one extra trailing dimension."""
+def format_float_fields(values, digits):
+    values = values.astype(np.float64)
+    width = digits + 7
+    finite = np.isfinite(values)
+    magnitudes = np.where(finite, np.abs(values), 0.0)
+    nonzero = magnitudes > 0
+    exponents = np.floor(np.log10(np.where(nonzero, magnitudes, 1.0))).astype(np.int64)
+    """ scale every value to a (digits)-digit integer mantissa. Rounding can carry into an extra digit (e.g. 9.9999999996 -> 10.0000000),
+        and log10 can be off by one next to powers of ten, so those few values are rescaled with the corrected exponent."""
+    mantissas = scale_to_mantissas(magnitudes, digits - 1 - exponents)
+    off_by_one = nonzero & ((mantissas >= 10**digits) | (mantissas < 10**(digits - 1)))
+    if off_by_one.any():
+        exponents[off_by_one] += np.where(mantissas[off_by_one] >= 10**digits, 1, -1)
+        mantissas[off_by_one] = scale_to_mantissas(magnitudes[off_by_one], digits - 1 - exponents[off_by_one])
+        carry = mantissas >= 10**digits
+        mantissas[carry] //= 10
+        exponents[carry] += 1
+    fields = np.empty(values.shape + (width,), dtype=np.uint8)
+    fields[..., 0] = np.where(np.signbit(values), ord('-'), ord(' '))
+    mantissa_digits = format_integer_fields(mantissas, digits, zero_pad=True)
+    fields[..., 1] = mantissa_digits[..., 0]
+    fields[..., 2] = ord('.')
+    fields[..., 3:digits + 2] = mantissa_digits[..., 1:]
+    fields[..., digits + 2] = ord('e')
+    fields[..., digits + 3] = np.where(exponents < 0, ord('-'), ord('+'))
+    fields[..., digits + 4:] = format_integer_fields(exponents, 3, zero_pad=True)
+    for special, spelling in [(np.isnan(values), 'NaN'), (np.isposinf(values), 'Infinity'), (np.isneginf(values), '-Infinity')]:
+        fields[special] = np.frombuffer(spelling.rjust(width).encode(), dtype=np.uint8)
+    return fields
 
 
 """ This function is only necessary because postgresql requires arrays to be in curly braces for ingestion. In python,
 curly braces (i.e. {}) indicate a 'set', which will return an unordered list of unique elemnts, which is not what we want.
-Thus it's necessary to convert the arrays into strings and manually pad them with curly braces. A more elegant solution may exist?"""
-def prep_ramps_for_db(all_ramps):
-    all_ramps_pre = all_ramps.tolist()
-    all_ramps_fin = [str(ramp).replace("[", "{", 1).replace("]", "}", 1) for ramp in all_ramps_pre]
-    return all_ramps_fin
+Thus it's necessary to convert the arrays into strings and manually pad them with curly braces.
+The literals are built directly from the NumPy buffer: every element is written into a fixed-width ASCII field (see format_integer_fields
+and format_float_fields), the fields are joined with commas inside curly braces, and each row of the resulting byte matrix is read as
+one string - no Python object is created per array element. float_digits sets the number of significant digits for float arrays
+(defaults in default_float_digits)."""
+def prep_ramps_for_db(all_ramps, float_digits=None):
+    all_ramps = np.asarray(all_ramps)
+    nrows, ncols = all_ramps.shape
+    if ncols == 0:
+        return np.full(nrows, '{}')
+    if all_ramps.dtype.kind == 'f':
+        fields = format_float_fields(all_ramps, float_digits or default_float_digits[all_ramps.dtype.itemsize])
+    else:
+        largest = max(int(np.abs(all_ramps.astype(np.int64)).max()), 1)
+        fields = format_integer_fields(all_ramps, len(str(largest)) + int((all_ramps < 0).any()))
+    width = fields.shape[-1]
+    literals = np.empty((nrows, 1 + ncols * (width + 1)), dtype=np.uint8)
+    literals[:, 0] = ord('{')
+    element_slots = literals[:, 1:].reshape(nrows, ncols, width + 1)
+    element_slots[:, :, :width] = fields
+    element_slots[:, :, width] = ord(',')
+    literals[:, -1] = ord('}')
+    return literals.view('S%d' % literals.shape[1]).ravel().astype(str)
 
 
-""" Transform image data cube so that each element in the data cube is the ramp for a single pixel"""
+""" Transform image data cube so that each element in the data cube is the ramp for a single pixel - returned as a (transposed) view, no copy is made"""
 def transform_ramp(lvl1_ramp):
-    return np.transpose([frame.flatten() for frame in lvl1_ramp])
+    return lvl1_ramp.reshape(lvl1_ramp.shape[0], -1).T
 
 
-""" Prep data to be fed into the DB"""
+""" Prep data to be fed into the DB. ramp_data has dimensions (nints, ngroups, nrows, ncols). all_ramps has one row per pixel per integration,
+    ordered by integration and then by the row-major pixel order of each frame - the order the pixel_id/intnumber columns and the ramp_id
+    assignment rely on. all_groups is the flat group vector in that same order. The reshape/transpose below are views, so the cube is copied
+    exactly once (into the contiguous all_ramps) and all_groups is a view of all_ramps."""
+@measured('reshape')
 def get_ramps_and_groups_column_data(ramp_data):
-    pixel_data_for_each_ramp = [transform_ramp(ramp) for ramp in ramp_data]
-    all_ramps = np.array(list(itertools.chain.from_iterable(pixel_data_for_each_ramp)))
-    all_groups = all_ramps.flatten()
+    nints, ngroups = ramp_data.shape[:2]
+    ramps_view = ramp_data.reshape(nints, ngroups, -1).transpose(0, 2, 1)
+    all_ramps = np.ascontiguousarray(ramps_view).reshape(-1, ngroups)
+    all_groups = all_ramps.reshape(-1)
     return all_ramps, all_groups
 
 
@@ -106,7 +669,82 @@ def return_dq_flags(dq_val,possible_DQ_vals,dq_value_pose_dict, num_dqs):
             false_list[dq_value_pose_dict[i]] = 1
         return false_list
 
-#@profile
+""" Vectorized replacement for calling return_dq_flags on every group of every ramp. dq_ramps has one row per ramp and one column per group.
+    A single bitwise OR over the whole DQ cube tells us which of the 31 flags occur at all; only those bits are then unpacked, each with one
+    bitwise AND over the cube. Returns two dictionaries keyed by the dq_val_ref flag names:
+     - group-level flags, one bool per group, flattened in the same ramp-major order as the group columns
+     - ramp-level flags, one bool per ramp (True if any group in the ramp has the flag)
+    Flags that never occur are returned as read-only broadcast views of False, so they cost no memory."""
+def decode_dq_flags(dq_ramps):
+    dq_ramps = np.asarray(dq_ramps)
+    number_of_ramps, ramp_len = dq_ramps.shape
+    flags_present = int(np.bitwise_or.reduce(dq_ramps, axis=None)) if dq_ramps.size else 0
+    no_group_flags = np.broadcast_to(False, (number_of_ramps * ramp_len,))
+    no_ramp_flags = np.broadcast_to(False, (number_of_ramps,))
+    group_flags = {}
+    ramp_flags = {}
+    for dq_val, dq_name in dq_val_ref.items():
+        if flags_present & dq_val:
+            flag_matrix = (dq_ramps & dq_ramps.dtype.type(dq_val)) != 0
+            group_flags[dq_name] = flag_matrix.reshape(-1)
+            ramp_flags[dq_name] = flag_matrix.any(axis=1)
+        else:
+            group_flags[dq_name] = no_group_flags
+            ramp_flags[dq_name] = no_ramp_flags
+    return group_flags, ramp_flags
+
+""" Per-pixel accumulators of the pixelstats summary of a corrected exposure (see miridb.load_miri_tables), for an exposure of nints integrations
+    of ramp_len groups and num_pixels pixels. Filled chunk by chunk by accumulate_pixel_stats, from the arrays add_corrected_exposure_to_db
+    already holds in memory, and turned into the pixelstats columns by get_pixel_stats_columns."""
+def init_pixel_stats(nints, ramp_len, num_pixels):
+    return {'ramp_len': ramp_len,
+            'slopes': np.full((nints, num_pixels), np.nan),
+            'corrected_min': np.full(num_pixels, np.nan),
+            'corrected_max': np.full(num_pixels, np.nan),
+            'first_saturated_group': np.full(num_pixels, ramp_len + 1),
+            'dq_flag_counts': np.zeros((num_pixels, len(dq_val_ref)), dtype=np.int32)}
+
+
+""" Add one chunk of a corrected exposure to the pixelstats accumulators. The chunk covers the integrations int_slice of the pixels pixel_slice
+    (positions in the row-major pixel order of the subarray); corrected_ramps and dq_ramps hold one ramp per row, ordered by integration and
+    then pixel (see get_ramps_and_groups_column_data), and slopes one value per ramp."""
+@measured('pixel_stats')
+def accumulate_pixel_stats(pixel_stats, int_slice, pixel_slice, slopes, corrected_ramps, dq_ramps):
+    nints = int_slice.stop - int_slice.start
+    ramp_len = pixel_stats['ramp_len']
+    corrected_ramps = corrected_ramps.reshape(nints, -1, ramp_len)
+    dq_ramps = dq_ramps.reshape(nints, -1, ramp_len)
+    pixel_stats['slopes'][int_slice, pixel_slice] = slopes.reshape(nints, -1)
+    """ fmin/fmax skip NaN values - a pixel is NaN only if all its values are"""
+    for name, reduce in [('corrected_min', np.fmin), ('corrected_max', np.fmax)]:
+        chunk_values = reduce.reduce(reduce.reduce(corrected_ramps, axis=2), axis=0)
+        pixel_stats[name][pixel_slice] = reduce(pixel_stats[name][pixel_slice], chunk_values)
+    """ only the flags present in the chunk are counted"""
+    flags_present = int(np.bitwise_or.reduce(dq_ramps, axis=None)) if dq_ramps.size else 0
+    for k, (dq_val, dq_name) in enumerate(dq_val_ref.items()):
+        if flags_present & dq_val:
+            flag_matrix = (dq_ramps & dq_ramps.dtype.type(dq_val)) != 0
+            pixel_stats['dq_flag_counts'][pixel_slice, k] += flag_matrix.sum(axis=(0, 2), dtype=np.int32)
+            if dq_name == 'saturated':
+                first_saturated = np.where(flag_matrix.any(axis=2), flag_matrix.argmax(axis=2) + 1, ramp_len + 1).min(axis=0)
+                pixel_stats['first_saturated_group'][pixel_slice] = np.minimum(pixel_stats['first_saturated_group'][pixel_slice], first_saturated)
+
+
+""" Columns of the pixelstats rows of a corrected exposure, from its accumulators (see init_pixel_stats) and the pixel ids of the subarray"""
+def get_pixel_stats_columns(pixel_stats, pixel_ids, exp_id, corrected_exp_id):
+    slopes = pixel_stats['slopes']
+    with warnings.catch_warnings():
+        """ pixels whose slopes are all NaN get NaN statistics, without a warning"""
+        warnings.simplefilter('ignore', RuntimeWarning)
+        slope_stats = {'mean_slope': np.nanmean(slopes, axis=0), 'median_slope': np.nanmedian(slopes, axis=0),
+                       'min_slope': np.nanmin(slopes, axis=0), 'max_slope': np.nanmax(slopes, axis=0)}
+    first_saturated_group = pixel_stats['first_saturated_group']
+    return dict({'corrected_exp_id': corrected_exp_id, 'pixel_id': pixel_ids, 'exp_id': exp_id, 'nints': len(slopes)}, **slope_stats,
+                corrected_min=pixel_stats['corrected_min'], corrected_max=pixel_stats['corrected_max'],
+                first_saturated_group=np.where(first_saturated_group > pixel_stats['ramp_len'], 0, first_saturated_group),
+                dq_flag_counts=pixel_stats['dq_flag_counts'])
+
+
 def generate_detectors_pixels_entries():
     """code to generate data to enter into 'pixels' and 'detectors tables'"""
     numrows = 1280
@@ -222,12 +860,11 @@ def insert_pixel_detector_info(connection):
     add_rows_to_table(detectors_vals, 'detectors', connection)
 
 
-""" Determine the subarray being used from FITS header and then use
-    get_pixel_coordinates_for_subarray function to return the associated pixel_ids for that subarray"""
-def generate_pixel_coordinates_from_header(hdr,data_coords,ref_coords_reshape):
-    first_pix = [hdr['SUBSTRT1'],hdr['SUBSTRT2']]
-    size = [hdr['SUBSIZE1'],hdr['SUBSIZE2']]
-    data_pixel_coords_final, reference_pixel_coords_final = get_pixel_coordinates_for_subarray(data_coords, ref_coords_reshape, first_pix, size)
+""" Determine the subarray being used from FITS header and return the associated pixel_ids for that subarray. The ids are computed in closed form
+    and memoized per subarray (see pixelmap.get_subarray_pixel_ids) - they are identical to those of get_pixel_coordinates_for_subarray, so
+    data_coords and ref_coords_reshape (from generate_structured_coordinates) are no longer needed and may be None."""
+def generate_pixel_coordinates_from_header(hdr,data_coords=None,ref_coords_reshape=None):
+    data_pixel_coords_final, reference_pixel_coords_final = get_pixel_ids_from_header(hdr)
     return data_pixel_coords_final, reference_pixel_coords_final
 
 
@@ -288,148 +925,267 @@ def generate_corrected_exposure_row(corrected_header,corrected_exposure_table_co
 
 
 """ Function to prep and insert a raw MIRI exposure (i.e. uncalibrated LVL1 data product) into the database - this includes
-    insertions into the Exposures, Ramps, and Groups tables"""
-#@profile
-def add_raw_exposure_to_db(raw_exposure_filepath, data_genesis, data_coords, ref_coords_reshape, session, connection, exposures, ramps):
-    raw_ramp_hdu = fits.open(raw_exposure_filepath)
-    raw_ramp_header = raw_ramp_hdu[0].header ### raw_ramp_header used by exposure_row AND ramp_rows, group_rows
-    ramp_data = raw_ramp_hdu[1].data
-    raw_ramp_hdu.close()
-    """ primary key generated automatically when rows enter into exposure table"""
-    exposure_table_column_names = complement(exposures.columns.keys(),exposures.primary_key.columns.keys())
-    """ generate the exposure row and insert it into the exposures table"""
-    exposure_row, exposure_table_filename = generate_exposure_row(data_genesis, raw_ramp_header, exposure_table_column_names)
-    exposures.insert().execute(exposure_row)
-    """ generate the indiviadual ramp and group values to be inserted into the DB"""
-    all_ramps, all_groups = get_ramps_and_groups_column_data(ramp_data)
-    all_ramps_enter = prep_ramps_for_db(all_ramps)
-    """ grab number of integrations"""
-    dim_ramp_data = ramp_data.shape
-    int_num = dim_ramp_data[0]
-    """ grab the exp_id associated with the filename exposure_table_filename -  need this exp_id to insert ramps"""
-    exp_id = session.query(exposures.c.exp_id).filter(exposures.c.exp == exposure_table_filename).scalar()
-    ramp_len = dim_ramp_data[1]
-    all_ints = list(range(1,int_num+1))
-    """ here we generate the int number associated with each ramp"""
-    ramp_ints_pre = []
-    num_pixels = dim_ramp_data[2] * dim_ramp_data[3]
-    for i in all_ints:
-        ramp_ints_pre.append([i] * num_pixels)
-    ramp_ints = list(itertools.chain.from_iterable(ramp_ints_pre))
-    """ grab the pixel coordinates for the given subarray - subarray info contined in raw_ramp_header"""
-    data_pixel_coords_final, reference_pixel_coords_final = generate_pixel_coordinates_from_header(raw_ramp_header, data_coords, ref_coords_reshape)
-    """ multiply pixel coords by int_num to get pixel_id values for all the ramps"""
-    all_pix_coords = list(data_pixel_coords_final) * int_num
-    all_exp_ids = [exp_id] * len(all_pix_coords)
-    """ create a dictionary of all the ramp data, convert to a pandas dataframe, and do fast insert with add_rows_to_table function"""
-    ramps_table_dict = {'pixel_id': all_pix_coords, 'exp_id': all_exp_ids, 'intnumber': ramp_ints, 'ramp':all_ramps_enter}
-    df_ramps = pd.DataFrame(ramps_table_dict)
-    add_rows_to_table(df_ramps, 'ramps', connection)
-    """ query for all the ramp_ids associated with a gievn exp_id. ramp_ids are retuened in the order in which they were inserted for that exp_id"""
-    ramp_id_query = session.query(ramps.c.ramp_id).filter(ramps.c.exp_id == exp_id)
-    """ create the ramps_id values to insert into the groups table"""
-    ramp_id_query_vals = [([num[0]] * ramp_len) for num in ramp_id_query]
-    group_ramp_ids = list(itertools.chain.from_iterable(ramp_id_query_vals))
-    """ create the group_number values to insert into the groups table"""
-    all_group_nums = list(itertools.chain.from_iterable([list(range(1,ramp_len+1))] * ramp_id_query.count()))
-    """ create a dictionary of all the group data, convert to a pandas dataframe, and do fast insert with add_rows_to_table function"""
-    groups_table_dict = {'ramp_id': group_ramp_ids, 'group_number': all_group_nums,'raw_value':all_groups}
-    df_groups = pd.DataFrame(groups_table_dict)
-    add_rows_to_table(df_groups, 'groups', connection)
+    insertions into the Exposures, Ramps, and Groups tables.
+    chunk_rows=None prepares and COPYs the whole exposure at once. With chunk_rows set, the exposure is streamed: each integration is read,
+    transformed and COPYed chunk_rows detector rows at a time (see iterate_ramp_chunks), which bounds the peak memory of the ingest.
+    Each chunk's ramps and groups are committed in one transaction. If the DB has an ingeststate table each commit is also a checkpoint, and an
+    interrupted ingest of the file is resumed after its last checkpoint by calling this function again (see ingest_state_columns).
+    The COPYs are prepared (FITS read, transform and encoding) in a background thread, up to prefetch COPYs ahead of the COPY being streamed
+    (see prefetch.py) - prefetch=0 prepares and COPYs in turn. Each prepared COPY holds one table's rows of a chunk, so the extra memory is
+    bounded by chunk_rows."""
+@instrumented('raw_ingest')
+def add_raw_exposure_to_db(raw_exposure_filepath, data_genesis, data_coords, ref_coords_reshape, session, connection, exposures, ramps, copy_format='binary', chunk_rows=None, prefetch=2):
+    with open_fits(raw_exposure_filepath) as raw_ramp_hdu:
+        raw_ramp_header = raw_ramp_hdu[0].header ### raw_ramp_header used by exposure_row AND ramp_rows, group_rows
+        ramp_data = read_image_cube(raw_ramp_hdu, 1)
+        """ primary key generated automatically when rows enter into exposure table"""
+        exposure_table_column_names = complement(exposures.columns.keys(),exposures.primary_key.columns.keys())
+        """ generate the exposure row to insert into the exposures table"""
+        exposure_row, exposure_table_filename = generate_exposure_row(data_genesis, raw_ramp_header, exposure_table_column_names)
+        """ grab number of integrations, groups and pixels"""
+        int_num, ramp_len, num_rows, num_cols = ramp_data.shape
+        number_of_ramps = int_num * num_rows * num_cols
+        ramp_chunks = list(iterate_ramp_chunks(ramp_data.shape, chunk_rows))
+        """ grab the pixel coordinates for the given subarray - subarray info contined in raw_ramp_header"""
+        data_pixel_coords_final, reference_pixel_coords_final = generate_pixel_coordinates_from_header(raw_ramp_header, data_coords, ref_coords_reshape)
+        store_groups = not is_view('groups', connection)
+        raw_zero_point = get_raw_zero_point(connection)
+        """ checkpoints are kept if the DB has an ingeststate table - the exposure is then locked while it is ingested"""
+        use_checkpoints = table_exists('ingeststate', connection)
+        if use_checkpoints and not lock_exposure_ingest(exposure_table_filename, connection):
+            raise RuntimeError('%s is being ingested by another process' % exposure_table_filename)
+        try:
+            ingest_state = find_resumable_ingest(exposure_table_filename, 'raw', chunk_rows, copy_format, len(ramp_chunks), connection) if use_checkpoints else None
+            if ingest_state is not None and ingest_state['stage'] == 'complete':
+                print('%s is already in the DB' % exposure_table_filename)
+                return
+            if ingest_state is None:
+                """ reserve the ramp_id and group_id blocks for this exposure (and their partitions, if the tables are partitioned by exposure) - all ids and foreign keys below are computed from the first id of each block"""
+                first_ramp_id = reserve_id_block('ramps', 'ramp_id', number_of_ramps, connection)
+                first_group_id = reserve_id_block('groups', 'group_id', number_of_ramps * ramp_len, connection) if store_groups else None
+                """ the exposure row, its partitions and its ingest state are committed together"""
+                exp_id = insert_row('exposures', exposure_row, 'exp_id', connection)
+                create_exposure_partition('ramps', exp_id, first_ramp_id, number_of_ramps, connection, commit=False)
+                if store_groups:
+                    create_exposure_partition('groups', exp_id, first_group_id, number_of_ramps * ramp_len, connection, commit=False)
+                ingest_state = {'exp': exposure_table_filename, 'kind': 'raw', 'exp_id': exp_id, 'corrected_exp_id': None, 'stage': 'loading', 'chunk_rows': chunk_rows,
+                                'copy_format': copy_format, 'num_chunks': len(ramp_chunks), 'chunks_done': 0, 'first_ramp_id': first_ramp_id, 'first_group_id': first_group_id}
+                commit_ingest_state(ingest_state, use_checkpoints, connection)
+            else:
+                print('Resuming the ingest of %s after chunk %d of %d' % (exposure_table_filename, ingest_state['chunks_done'], ingest_state['num_chunks']))
+            exp_id, first_ramp_id, first_group_id = ingest_state['exp_id'], ingest_state['first_ramp_id'], ingest_state['first_group_id']
+            table_types = {table_name: get_table_types(table_name, connection) for table_name in ['ramps', 'groups']}
+            """ the chunks are read, transformed and encoded by this generator in a background thread, up to prefetch COPYs ahead of the COPYs below.
+                Yields (chunk number, prepared copy, True if it is the chunk's last copy)"""
+            def prepare_chunk_copies():
+                for chunk_number, (int_slice, row_slice, ramp_positions) in enumerate(ramp_chunks):
+                    if chunk_number < ingest_state['chunks_done']:
+                        continue
+                    """ generate the indiviadual ramp and group values to be inserted into the DB. An unscaled extension is sliced as a view of the
+                        memory-mapped file, which is copied here so its pages are read (and timed) by the fits_read stage"""
+                    with measure('fits_read') as stage:
+                        raw_chunk = shift_raw_values(np.array(ramp_data[int_slice, :, row_slice]), raw_zero_point)
+                        stage['bytes'] = raw_chunk.nbytes
+                    all_ramps, all_groups = get_ramps_and_groups_column_data(raw_chunk)
+                    ramp_ids = first_ramp_id + ramp_positions
+                    """ here we generate the int number and pixel_id associated with each ramp"""
+                    chunk_pixel_coords = data_pixel_coords_final[row_slice.start * num_cols:row_slice.stop * num_cols]
+                    ramp_ints = np.repeat(np.arange(int_slice.start + 1, int_slice.stop + 1), len(chunk_pixel_coords))
+                    all_pix_coords = np.tile(chunk_pixel_coords, int_slice.stop - int_slice.start)
+                    """ create a dictionary of all the ramp data columns and prepare its fast insert (see copy_columns_to_table)"""
+                    ramps_table_dict = {'ramp_id': ramp_ids, 'pixel_id': all_pix_coords, 'exp_id': exp_id, 'intnumber': ramp_ints, 'ramp':all_ramps}
+                    yield chunk_number, prepare_copy(ramps_table_dict, 'ramps', table_types['ramps'], copy_format), not store_groups
+                    if store_groups:
+                        """ create the group_id, ramps_id and group_number values to insert into the groups table"""
+                        group_ids = (first_group_id + ramp_positions[:, np.newaxis] * ramp_len + np.arange(ramp_len)).reshape(-1)
+                        group_ramp_ids = np.repeat(ramp_ids, ramp_len)
+                        all_group_nums = np.tile(np.arange(1, ramp_len+1), len(ramp_ids))
+                        """ create a dictionary of all the group data columns and prepare its fast insert"""
+                        groups_table_dict = {'group_id': group_ids, 'ramp_id': group_ramp_ids, 'group_number': all_group_nums,'raw_value':all_groups}
+                        yield chunk_number, prepare_copy(groups_table_dict, 'groups', table_types['groups'], copy_format), True
+            with PrefetchIterator(prepare_chunk_copies(), prefetch) as chunk_copies:
+                for chunk_number, prepared_copy, end_of_chunk in chunk_copies:
+                    execute_copy(prepared_copy, connection, commit=False)
+                    if end_of_chunk:
+                        """ the chunk's ramps and groups are committed together with its checkpoint"""
+                        ingest_state['chunks_done'] = chunk_number + 1
+                        commit_ingest_state(ingest_state, use_checkpoints, connection)
+            ingest_state['stage'] = 'complete'
+            commit_ingest_state(ingest_state, use_checkpoints, connection)
+        finally:
+            if use_checkpoints:
+                unlock_exposure_ingest(exposure_table_filename, connection)
 
 
 """ Function to prep and insert a corrected MIRI exposure (i.e. a corrected ramp file, "_ramp.fits", output by the JWST Detector1Pipeline) into the database - this includes
-    insertions into the CorrectedExposures, CorrectedRamps, and CorrectedGroups tables"""
-#@profile
-def add_corrected_exposure_to_db(corrected_ramp_fn, session, connection, exposures, groups, ramps, correctedexposures, correctedramps):
-    """ Read in data from FITS file"""
-    corrected_ramp_hdu = fits.open(corrected_ramp_fn)
-    corrected_header = corrected_ramp_hdu[0].header
-    corrected_ramp_data = corrected_ramp_hdu[1].data
-    pix_group_dq_data = corrected_ramp_hdu[3].data
-    pix_err_data = corrected_ramp_hdu[4].data
-    corrected_ramp_hdu.close()
-    """ grab the raw exposure filename - jwst pipeline inserts '_ramp' at the end of the filename"""
-    exposure_table_filename = os.path.basename(corrected_ramp_fn).replace('_ramp.fits','.fits')
-    """ grab exp_id associated with the exposure_table_filename, grab ramp_ids associated with that exp_id"""
-    exp_id = session.query(exposures.c.exp_id).filter(exposures.c.exp == exposure_table_filename).scalar()
-    ramp_ids_pre = session.query(ramps.c.ramp_id).filter(ramps.c.exp_id == exp_id)
-    ramp_ids = [r[0] for r in ramp_ids_pre]
-    """ generate the corrected exposure row for insert into the Corrected Exposures table"""
-    corrected_exposure_table_column_names = complement(correctedexposures.columns.keys(),correctedexposures.primary_key.columns.keys())
-    corrected_exposure_row = generate_corrected_exposure_row(corrected_header,corrected_exposure_table_column_names,exp_id)
-    correctedexposures.insert().execute(corrected_exposure_row)
-    """ lines below transform data so that each element in the list is the ramp for a given pixel"""
-    all_corrected_ramps, all_corrected_groups = get_ramps_and_groups_column_data(corrected_ramp_data)
-    all_dq_ramps, all_dq_groups = get_ramps_and_groups_column_data(pix_group_dq_data)
-    all_err_ramps, all_err_groups = get_ramps_and_groups_column_data(pix_err_data)
-    all_corrected_ramps_enter = prep_ramps_for_db(all_corrected_ramps)
-    all_dq_ramps_enter = prep_ramps_for_db(all_dq_ramps)
-    all_err_ramps_enter = prep_ramps_for_db(all_err_ramps)
+    insertions into the CorrectedExposures, CorrectedRamps, and CorrectedGroups tables.
+    chunk_rows streams the exposure in chunks, as in add_raw_exposure_to_db.
+    With staging=True the corrected ramps and groups are first COPYed, keyed by (pixel_id, intnumber[, group_number]), into UNLOGGED staging
+    tables, and then moved into the permanent tables by merge_staged_corrected_exposure in a single transaction - the foreign keys are resolved
+    by the join in postgresql, and an exposure that fails leaves no rows behind (not even its correctedexposures row).
+    If the DB has a pixelstats table, one summary row per pixel (slope statistics, DQ flag counts, first saturated group, corrected value range)
+    is accumulated from the chunks as they are ingested and written once the corrected ramps are in (see init_pixel_stats).
+    As for add_raw_exposure_to_db, each chunk is committed in one transaction - a checkpoint if the DB has an ingeststate table, so an interrupted
+    ingest is resumed by calling this function again. The pixelstats rows are committed together with the completed ingest state. The COPYs are
+    prepared in a background thread, up to prefetch COPYs ahead, as for add_raw_exposure_to_db."""
+@instrumented('corrected_ingest')
+def add_corrected_exposure_to_db(corrected_ramp_fn, session, connection, exposures, groups, ramps, correctedexposures, correctedramps, copy_format='binary', chunk_rows=None, staging=False, prefetch=2):
     """ code to extract slope data to be inserted into the correctedpixelramps table. If the exposure has >1 integration, *_rateints.fits file is created, which is where
         we pull the slope values for each integration. If exposure is only 1 integration, then the JWST pipeline does not create *_rateints.fits
         file, and we get the slope value for the single intgeration from the *_rate.fits file."""
-    exposure_table_nints = len(corrected_ramp_data)
+    with open_fits(corrected_ramp_fn) as corrected_ramp_hdu:
+        exposure_table_nints = corrected_ramp_hdu[1].header['NAXIS4']
     if exposure_table_nints == 1:
         slope_file = corrected_ramp_fn.replace("_ramp.fits","_rate.fits")
     else:
         slope_file = corrected_ramp_fn.replace("_ramp.fits","_rateints.fits")
-    slope_hdu = fits.open(slope_file)
-    slope_data = slope_hdu[1].data
-    """ .byteswap().newbyteorder() needed in line below to avoid the ValueError described here: https://github.com/astropy/astropy/issues/1156"""
-    slope_data_per_pixel = slope_data.flatten().byteswap().newbyteorder()
-    slope_hdu.close()
-    dims_ramps = all_dq_ramps.shape
-    """ query for the corrected_exp_id based on the corrected exposure filename"""
-    corrected_exp_id = session.query(correctedexposures.c.corrected_exp_id).filter(correctedexposures.c.corrected_exp == corrected_header['FILENAME']).scalar()
-    """ create a constant array of corrected_exp_ids to insert into the ramps table"""
-    corrected_exp_ids = [corrected_exp_id] * dims_ramps[0]
-    """ Defining all possible DQ vals - the three lines below could be moved outside of this function, however they are very fast to execute"""
-    possible_dq_vals = [2**k for k in range(0,31)]
-    dq_value_pose_dict = dict(zip(possible_dq_vals, range(0,len(possible_dq_vals))))
-    num_dqs = len(possible_dq_vals)
-    """ This block of code interprets the values found in the dq_ramps and produces a boolean for each DQ flag for each ramp
-        (True if ramp array contains DQ flag, False otherwise) and a boolean for each DQ flags for each group (True if group DQ int value contains DQ flag, False otherwise)"""
-    number_of_ramps = len(all_dq_ramps)
-    ramp_len = dims_ramps[1]
-    dq_matrices = np.empty((number_of_ramps, len(possible_dq_vals), ramp_len),dtype=int)
-    ramp_dq_vectors = np.empty((number_of_ramps,len(possible_dq_vals)),dtype=bool)
-    for i in range(0,number_of_ramps):
-        new_dq_ramp = np.array([return_dq_flags(flag, possible_dq_vals, dq_value_pose_dict, num_dqs) for flag in all_dq_ramps[i]])
-        dq_matrix = np.transpose(new_dq_ramp)
-        ramp_dq = [1 in row for row in dq_matrix]
-        dq_matrices[i] = dq_matrix
-        ramp_dq_vectors[i] = ramp_dq
-    group_dq_flags = np.concatenate((dq_matrices), axis=1)
-    tf_vals_each_flag = np.transpose(ramp_dq_vectors)
-    dq_names = dq_val_ref.values()
-    dq_group_val_dict = dict(zip(dq_names,group_dq_flags))
-    dq_ramp_val_dict = dict(zip(dq_names,tf_vals_each_flag))
-    """ create first part of corrected ramps dictionary, without the DQ_Flag information"""
-    corrected_ramps_table_dict = {'ramp_id': ramp_ids, 'corrected_exp_id': corrected_exp_ids, 'slope_value': slope_data_per_pixel, 'corrected_ramp': all_corrected_ramps_enter,
-             'dq_ramp': all_dq_ramps_enter, 'err_ramp': all_err_ramps_enter}
-    """ update the corrected ramps dictionary with the DQ_Flag information, and then generate a pandas dataframe from this dictionary,
-        and finally do a fast insert with add_rows_to_table function"""
-    corrected_ramps_table_dict.update(dq_ramp_val_dict)
-    df_corrected_ramps = pd.DataFrame(corrected_ramps_table_dict)
-    add_rows_to_table(df_corrected_ramps, 'correctedramps', connection)
-    """"query for all the group_ids associated with the exp_id, and create the foreign group_ids to insert into the CorrectedGroups table"""
-    group_ids_pre = session.query(groups.c.group_id).join(ramps).filter(ramps.c.exp_id == exp_id)
-    """ the postgresql query returns a list of tuples, all containing 1 element - to get a flat list, we need to perform this next line"""
-    group_ids = [g[0] for g in group_ids_pre] # possible optimization https://dba.stackexchange.com/questions/2973/how-to-insert-values-into-a-table-from-a-select-query-in-postgresql
-    """ query the corrrected ramps table to return all the corrected ramps ids associated with the corrected_exp_id,
-        and make corrected_ramp_id foreign key for each corrected group entry"""
-    corrected_ramp_ids_pre = session.query(correctedramps.c.corr_ramp_id).filter(correctedramps.c.corrected_exp_id == corrected_exp_id)
-    corrected_ramp_ids = [([num[0]] * ramp_len) for num in corrected_ramp_ids_pre]
-    corrected_group_ramp_ids = list(itertools.chain.from_iterable(corrected_ramp_ids))
-    """ create the group numbers to be inserted into the CorrectedGroups table for the 'group_number' column"""
-    all_group_nums = list(itertools.chain.from_iterable([list(range(1,ramp_len+1))] * corrected_ramp_ids_pre.count()))
-    """ create first part of corrected groups dictionary, without the DQ_Flag information"""
-    corrected_groups_table_dict = {'group_id': group_ids,
-                                         'corr_ramp_id':corrected_group_ramp_ids, 'group_number': all_group_nums,
-                                         'corrected_value':all_corrected_groups, 'dq_value':all_dq_groups,'error_value':all_err_groups}
-    """ update the corrected groups dictionary with the DQ_Flag information, and then generate a pandas dataframe from this dictionary,
-        and finally do a fast insert with add_rows_to_table function"""
-    corrected_groups_table_dict.update(dq_group_val_dict)
-    df_corrected_groups = pd.DataFrame(corrected_groups_table_dict)
-    add_rows_to_table(df_corrected_groups, 'correctedgroups', connection)
+    """ Open the FITS files memory-mapped - the data is only read chunk by chunk, below"""
+    with open_fits(corrected_ramp_fn) as corrected_ramp_hdu, open_fits(slope_file) as slope_hdu:
+        corrected_header = corrected_ramp_hdu[0].header
+        corrected_ramp_data = read_image_cube(corrected_ramp_hdu, 1)
+        pix_group_dq_data = read_image_cube(corrected_ramp_hdu, 3)
+        pix_err_data = read_image_cube(corrected_ramp_hdu, 4)
+        """ slope data stays big-endian here - it is converted while being written to the COPY buffer (see copy_columns_to_table)"""
+        slope_data = read_image_cube(slope_hdu, 1).reshape((exposure_table_nints,) + corrected_ramp_data.shape[2:])
+        """ grab the raw exposure filename - jwst pipeline inserts '_ramp' at the end of the filename"""
+        exposure_table_filename = os.path.basename(corrected_ramp_fn).replace('_ramp.fits','.fits')
+        """ grab exp_id associated with the exposure_table_filename"""
+        exp_id = session.query(exposures.c.exp_id).filter(exposures.c.exp == exposure_table_filename).scalar()
+        """ generate the corrected exposure row for insert into the Corrected Exposures table"""
+        corrected_exposure_table_column_names = complement(correctedexposures.columns.keys(),correctedexposures.primary_key.columns.keys())
+        corrected_exposure_row = generate_corrected_exposure_row(corrected_header,corrected_exposure_table_column_names,exp_id)
+        int_num, ramp_len, num_rows, num_cols = corrected_ramp_data.shape
+        number_of_ramps = int_num * num_rows * num_cols
+        store_groups = not is_view('correctedgroups', connection)
+        """ in dq_bitmask mode (see miridb.load_miri_tables) only the DQ words are stored, and the flags are not decoded"""
+        dq_bitmask = 'dq_word' in get_table_columns('correctedramps', connection)
+        """ the per-pixel summary (see init_pixel_stats) is accumulated from the chunks below - DBs created before the pixelstats table existed skip it"""
+        store_pixel_stats = table_exists('pixelstats', connection)
+        if store_pixel_stats:
+            pixel_stats = init_pixel_stats(int_num, ramp_len, num_rows * num_cols)
+        if staging or store_pixel_stats:
+            """ the staging tables and the pixelstats rows are keyed by pixel_id - the pixel ids come from the subarray keywords, as for the raw exposure"""
+            data_pixel_coords_final, reference_pixel_coords_final = generate_pixel_coordinates_from_header(corrected_header)
+        ramp_chunks = list(iterate_ramp_chunks(corrected_ramp_data.shape, chunk_rows))
+        corrected_exp = corrected_header['FILENAME']
+        """ checkpoints are kept if the DB has an ingeststate table - the corrected exposure is then locked while it is ingested. A staged ingest
+            writes nothing to the permanent tables before its merge, so it is not resumed: it simply starts again"""
+        use_checkpoints = table_exists('ingeststate', connection)
+        if use_checkpoints and not lock_exposure_ingest(corrected_exp, connection):
+            raise RuntimeError('%s is being ingested by another process' % corrected_exp)
+        ramps_target, groups_target = None, None
+        try:
+            ingest_state = find_resumable_ingest(corrected_exp, 'corrected', chunk_rows, copy_format, len(ramp_chunks), connection, resumable=not staging) if use_checkpoints else None
+            if ingest_state is not None and ingest_state['stage'] == 'complete':
+                print('%s is already in the DB' % corrected_exp)
+                return
+            if staging:
+                ramps_target, groups_target = create_corrected_staging_tables(exp_id, store_groups, connection)
+                chunks_done = 0
+            else:
+                ramps_target, groups_target = 'correctedramps', 'correctedgroups'
+                """ grab the ramp_ids and group_ids of the raw exposure (the foreign keys of the corrected ramps/groups)"""
+                ramp_ids, group_ids = get_exposure_ramp_and_group_ids(exp_id, number_of_ramps, ramp_len, connection, include_groups=store_groups)
+                if ingest_state is None:
+                    """ reserve the corr_ramp_id and corr_group_id blocks for this corrected exposure - the corrected exposure row, its partitions and its
+                        ingest state are committed together"""
+                    first_corrected_ramp_id = reserve_id_block('correctedramps', 'corr_ramp_id', number_of_ramps, connection)
+                    first_corrected_group_id = reserve_id_block('correctedgroups', 'corr_group_id', number_of_ramps * ramp_len, connection) if store_groups else None
+                    corrected_exp_id = insert_row('correctedexposures', corrected_exposure_row, 'corrected_exp_id', connection)
+                    create_exposure_partition('correctedramps', corrected_exp_id, first_corrected_ramp_id, number_of_ramps, connection, commit=False)
+                    if store_groups:
+                        create_exposure_partition('correctedgroups', corrected_exp_id, first_corrected_group_id, number_of_ramps * ramp_len, connection, commit=False)
+                    ingest_state = {'exp': corrected_exp, 'kind': 'corrected', 'exp_id': exp_id, 'corrected_exp_id': corrected_exp_id, 'stage': 'loading',
+                                    'chunk_rows': chunk_rows, 'copy_format': copy_format, 'num_chunks': len(ramp_chunks), 'chunks_done': 0,
+                                    'first_ramp_id': first_corrected_ramp_id, 'first_group_id': first_corrected_group_id}
+                    commit_ingest_state(ingest_state, use_checkpoints, connection)
+                else:
+                    print('Resuming the ingest of %s after chunk %d of %d' % (corrected_exp, ingest_state['chunks_done'], ingest_state['num_chunks']))
+                corrected_exp_id, chunks_done = ingest_state['corrected_exp_id'], ingest_state['chunks_done']
+                first_corrected_ramp_id, first_corrected_group_id = ingest_state['first_ramp_id'], ingest_state['first_group_id']
+            table_types = {table_name: get_table_types(table_name, connection) for table_name in ([ramps_target, groups_target] if store_groups else [ramps_target])}
+            """ the chunks are read, transformed and encoded by this generator in a background thread, up to prefetch COPYs ahead of the COPYs below.
+                Yields (chunk number, prepared copy, True if it is the chunk's last copy)"""
+            def prepare_chunk_copies():
+                for chunk_number, (int_slice, row_slice, ramp_positions) in enumerate(ramp_chunks):
+                    """ lines below transform data so that each element in the list is the ramp for a given pixel. The SCI, GROUPDQ and ERR
+                        slices are views of the memory-mapped file, copied in the fits_read stage so their pages are read there"""
+                    with measure('fits_read') as stage:
+                        corrected_chunk, dq_chunk = np.array(corrected_ramp_data[int_slice, :, row_slice]), np.array(pix_group_dq_data[int_slice, :, row_slice])
+                        slope_data_per_pixel = np.array(slope_data[int_slice, row_slice]).reshape(-1)
+                        stage['bytes'] = corrected_chunk.nbytes + dq_chunk.nbytes + slope_data_per_pixel.nbytes
+                    all_corrected_ramps, all_corrected_groups = get_ramps_and_groups_column_data(corrected_chunk)
+                    all_dq_ramps, all_dq_groups = get_ramps_and_groups_column_data(dq_chunk)
+                    if store_pixel_stats:
+                        accumulate_pixel_stats(pixel_stats, int_slice, slice(row_slice.start * num_cols, row_slice.stop * num_cols), slope_data_per_pixel, all_corrected_ramps, all_dq_ramps)
+                    """ chunks committed before a resumed ingest was interrupted are only read for the pixelstats summary"""
+                    if chunk_number < chunks_done:
+                        continue
+                    with measure('fits_read') as stage:
+                        err_chunk = np.array(pix_err_data[int_slice, :, row_slice])
+                        stage['bytes'] = err_chunk.nbytes
+                    all_err_ramps, all_err_groups = get_ramps_and_groups_column_data(err_chunk)
+                    """ This interprets the values found in the dq_ramps and produces a boolean for each DQ flag for each ramp
+                        (True if ramp array contains DQ flag, False otherwise) and a boolean for each DQ flags for each group (True if group DQ int value contains DQ flag, False otherwise).
+                        In dq_bitmask mode the ramp's DQ word (OR of its group DQ values) is stored instead, and the groups only keep dq_value"""
+                    with measure('dq_decode'):
+                        if dq_bitmask:
+                            dq_group_val_dict, dq_ramp_val_dict = {}, {'dq_word': np.bitwise_or.reduce(all_dq_ramps, axis=1)}
+                        else:
+                            dq_group_val_dict, dq_ramp_val_dict = decode_dq_flags(all_dq_ramps)
+                    all_group_nums = np.tile(np.arange(1, ramp_len+1), len(ramp_positions))
+                    if staging:
+                        """ key the staged rows by pixel_id and intnumber, exactly as the raw ramps were inserted"""
+                        chunk_pixel_coords = data_pixel_coords_final[row_slice.start * num_cols:row_slice.stop * num_cols]
+                        ramp_keys = {'pixel_id': np.tile(chunk_pixel_coords, int_slice.stop - int_slice.start),
+                                     'intnumber': np.repeat(np.arange(int_slice.start + 1, int_slice.stop + 1), len(chunk_pixel_coords))}
+                        group_keys = {column: np.repeat(values, ramp_len) for column, values in ramp_keys.items()}
+                    else:
+                        group_positions = (ramp_positions[:, np.newaxis] * ramp_len + np.arange(ramp_len)).reshape(-1)
+                        corrected_ramp_ids = first_corrected_ramp_id + ramp_positions
+                        ramp_keys = {'corr_ramp_id': corrected_ramp_ids, 'ramp_id': take_ids(ramp_ids, ramp_positions), 'corrected_exp_id': corrected_exp_id}
+                        """ make corrected_ramp_id foreign key for each corrected group entry"""
+                        if store_groups:
+                            group_keys = {'corr_group_id': first_corrected_group_id + group_positions, 'group_id': take_ids(group_ids, group_positions),
+                                          'corr_ramp_id': np.repeat(corrected_ramp_ids, ramp_len)}
+                    """ create first part of corrected ramps dictionary, without the DQ_Flag information"""
+                    corrected_ramps_table_dict = dict(ramp_keys)
+                    corrected_ramps_table_dict.update({'slope_value': slope_data_per_pixel, 'corrected_ramp': all_corrected_ramps, 'dq_ramp': all_dq_ramps, 'err_ramp': all_err_ramps})
+                    """ update the corrected ramps dictionary with the DQ_Flag information, and prepare its fast insert (see copy_columns_to_table)"""
+                    corrected_ramps_table_dict.update(dq_ramp_val_dict)
+                    yield chunk_number, prepare_copy(corrected_ramps_table_dict, ramps_target, table_types[ramps_target], copy_format), not store_groups
+                    if store_groups:
+                        """ create first part of corrected groups dictionary, without the DQ_Flag information"""
+                        corrected_groups_table_dict = dict(group_keys)
+                        corrected_groups_table_dict.update({'group_number': all_group_nums, 'corrected_value':all_corrected_groups, 'dq_value':all_dq_groups,'error_value':all_err_groups})
+                        """ update the corrected groups dictionary with the DQ_Flag information, and prepare its fast insert"""
+                        corrected_groups_table_dict.update(dq_group_val_dict)
+                        yield chunk_number, prepare_copy(corrected_groups_table_dict, groups_target, table_types[groups_target], copy_format), True
+            with PrefetchIterator(prepare_chunk_copies(), prefetch) as chunk_copies:
+                for chunk_number, prepared_copy, end_of_chunk in chunk_copies:
+                    execute_copy(prepared_copy, connection, commit=False)
+                    if not end_of_chunk:
+                        continue
+                    """ the chunk's corrected ramps and groups are committed together with its checkpoint (staged chunks are only committed)"""
+                    if staging:
+                        with measure('commit'):
+                            connection.commit()
+                    else:
+                        ingest_state['chunks_done'] = chunk_number + 1
+                        commit_ingest_state(ingest_state, use_checkpoints, connection)
+            """ the merge of a staged exposure, the pixelstats rows and the completed ingest state are committed together"""
+            if staging:
+                corrected_exp_id = merge_staged_corrected_exposure(exp_id, corrected_exposure_row, number_of_ramps, ramp_len, ramps_target, groups_target, connection, commit=False)
+                ingest_state = {'exp': corrected_exp, 'kind': 'corrected', 'exp_id': exp_id, 'corrected_exp_id': corrected_exp_id, 'stage': 'loading',
+                                'chunk_rows': chunk_rows, 'copy_format': copy_format, 'num_chunks': len(ramp_chunks), 'chunks_done': len(ramp_chunks),
+                                'first_ramp_id': None, 'first_group_id': None}
+            if store_pixel_stats:
+                copy_columns_to_table(get_pixel_stats_columns(pixel_stats, data_pixel_coords_final, exp_id, corrected_exp_id), 'pixelstats', connection, copy_format, commit=False)
+            ingest_state['stage'] = 'complete'
+            commit_ingest_state(ingest_state, use_checkpoints, connection)
+        finally:
+            connection.rollback()
+            if staging:
+                drop_tables([ramps_target, groups_target], connection)
+            if use_checkpoints:
+                unlock_exposure_ingest(corrected_exp, connection)
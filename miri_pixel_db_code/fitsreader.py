@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 14:02:17 2026
+
+@author: MIRI Pixel DB developers
+
+The methods in this package read the image extensions of MIRI FITS files (LVL1 exposures, pipeline ready files and JWST pipeline
+products) without loading them into memory. Files are memory-mapped and opened with do_not_scale_image_data, so astropy never builds
+a scaled in-memory copy of a whole extension: the BZERO/BSCALE scaling is applied to each slice as it is read (see ImageCube).
+Data stays in the big-endian byte order of the file - conversion to native order happens once, when values are written into the
+outgoing COPY buffer.
+"""
+from astropy.io import fits
+import numpy as np
+
+
+""" Open a FITS file with its image extensions memory-mapped and unscaled. Use with a 'with' statement - slices of an ImageCube
+    must be taken before the file is closed."""
+def open_fits(file_path):
+    return fits.open(file_path, memmap=True, do_not_scale_image_data=True)
+
+
+""" Lazily sliced, lazily scaled view of a FITS image extension. Indexing an ImageCube reads only the requested part of the file
+    and applies the extension's BZERO/BSCALE to that part only. Unscaled data is returned as a view of the file, in the file's byte order.
+    Unsigned integers stored with the FITS convention (e.g. uint16 stored as int16 with BZERO = 32768) are restored with an exact
+    bit flip instead of floating point arithmetic, so raw ramps keep their integer dtype."""
+class ImageCube(object):
+    def __init__(self, raw_data, bzero=0, bscale=1):
+        self.raw_data = raw_data
+        self.bzero = bzero
+        self.bscale = bscale
+        self.shape = raw_data.shape
+        self.ndim = raw_data.ndim
+        if raw_data.dtype.kind == 'i' and bscale == 1 and bzero == 2**(8 * raw_data.dtype.itemsize - 1):
+            self.dtype = np.dtype('u%d' % raw_data.dtype.itemsize)
+        elif bzero == 0 and bscale == 1:
+            self.dtype = raw_data.dtype
+        else:
+            self.dtype = np.dtype(np.float32) if raw_data.dtype.itemsize <= 2 else np.dtype(np.float64)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        raw_slice = self.raw_data[index].view(np.ndarray)
+        if self.dtype.kind == 'u' and self.raw_data.dtype.kind == 'i':
+            return raw_slice.view(raw_slice.dtype.str.replace('i', 'u')) ^ self.dtype.type(self.bzero)
+        if self.bzero == 0 and self.bscale == 1:
+            return raw_slice
+        return raw_slice * self.dtype.type(self.bscale) + self.dtype.type(self.bzero)
+
+    def reshape(self, *shape):
+        return ImageCube(self.raw_data.reshape(*shape), self.bzero, self.bscale)
+
+
+""" Return an ImageCube for an extension (name or index) of a FITS file opened with open_fits"""
+def read_image_cube(hdulist, extension):
+    hdu = hdulist[extension]
+    return ImageCube(hdu.data, hdu.header.get('BZERO', 0), hdu.header.get('BSCALE', 1))
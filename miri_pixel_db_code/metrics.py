@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 02:07:52 2026
+
+@author: MIRI Pixel DB developers
+
+The methods in this package record where the time of an ingest goes, without having to re-instrument the code. The ingest functions of
+exposuresdb, pipefits and miridb_script are split into stages - FITS read, reshape, DQ decode, pixel stats, serialize, COPY, commit, ID query -
+and every stage records its wall time, CPU time (of the thread running it), rows written, bytes read or written, and the peak memory of the
+process. Metrics are off by default. Turn them on with the MIRIDB_METRICS environment variable (the path of the log), the --metrics=path
+option of miridb_script.py, or enable_metrics(path).
+
+The metrics are written to a JSON-lines log, one line per stage per scope - a scope is one call of an instrumented function (e.g. the raw
+ingest of an exposure, see instrumented), and its stages are aggregated over the calls made while it runs (e.g. every chunk's COPY). Each scope
+also writes a 'total' line: its wall time and the CPU time of the whole process. Stages running in the background thread of a PrefetchIterator
+overlap with the stages of the main thread, so the wall times of the stages of a scope can add up to more than its total - and the bookkeeping
+between the stages (ids, keys) is not measured, so they can also add up to less. Processes append to the same log, so a parallel ingest can log
+to one file. Summarize a log with:
+
+    $ python metrics.py log_path
+
+Stages are marked with the measure context manager, or the measured decorator for a whole function:
+
+    with measure('copy') as stage:
+        ... COPY the rows ...
+        stage['rows'] = number_of_rows
+"""
+import os
+import sys
+import json
+import time
+import resource
+import threading
+from datetime import datetime
+from functools import wraps
+from contextlib import contextmanager
+
+""" Environment variable holding the path of the metrics log - metrics are recorded when it is set"""
+metrics_environment_variable = 'MIRIDB_METRICS'
+
+""" Counters of a stage, summed over its calls"""
+stage_counters = ['calls', 'wall_seconds', 'cpu_seconds', 'rows', 'bytes']
+
+""" The path of the log (None when metrics are off), and the stack of open scopes (see metrics_scope) - shared by the threads of a process"""
+metrics_state = {'log_path': os.environ.get(metrics_environment_variable) or None, 'scopes': []}
+metrics_lock = threading.Lock()
+
+
+""" Turn metrics on, appending to the JSON-lines log at log_path. The environment variable is set too, so processes started from this one
+    (e.g. the workers of a parallel ingest) log to the same file."""
+def enable_metrics(log_path):
+    metrics_state['log_path'] = log_path
+    os.environ[metrics_environment_variable] = log_path
+
+
+def disable_metrics():
+    metrics_state['log_path'] = None
+    os.environ.pop(metrics_environment_variable, None)
+
+
+def metrics_enabled():
+    return metrics_state['log_path'] is not None
+
+
+""" Peak resident memory of this process, in MB. On Linux this is VmHWM, which starts again from zero when a process is spawned - ru_maxrss
+    keeps the peak of the process that forked it. ru_maxrss is in kB on Linux and in bytes on macOS."""
+def get_peak_rss_mb():
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / 2**20 if sys.platform == 'darwin' else peak_rss / 2**10
+
+
+""" Append records (dictionaries) to the metrics log - one write per call, so the lines of concurrent processes do not interleave"""
+def write_metrics(records):
+    lines = ''.join(json.dumps(record) + '\n' for record in records)
+    with open(metrics_state['log_path'], 'a') as log_file:
+        log_file.write(lines)
+
+
+""" Add the measurement of one call of a stage to the innermost open scope, or log it on its own if there is none"""
+def record_stage(stage, measurement):
+    with metrics_lock:
+        if metrics_state['scopes']:
+            stages = metrics_state['scopes'][-1]['stages']
+            totals = stages.setdefault(stage, dict.fromkeys(stage_counters, 0))
+            for counter in stage_counters:
+                totals[counter] += measurement[counter]
+            totals['peak_rss_mb'] = measurement['peak_rss_mb']
+            return
+    write_metrics([dict(measurement, time=datetime.now().isoformat(), pid=os.getpid(), scope=None, exposure=None, stage=stage)])
+
+
+""" Measure a stage: yields a dictionary in which the stage can count the rows it writes ('rows') and the bytes it reads or writes ('bytes').
+    When metrics are off the stage runs unmeasured."""
+@contextmanager
+def measure(stage):
+    counts = {'rows': 0, 'bytes': 0}
+    if not metrics_enabled():
+        yield counts
+        return
+    start, start_cpu = time.perf_counter(), time.thread_time()
+    yield counts
+    record_stage(stage, {'calls': 1, 'wall_seconds': time.perf_counter() - start, 'cpu_seconds': time.thread_time() - start_cpu,
+                         'rows': counts['rows'], 'bytes': counts['bytes'], 'peak_rss_mb': get_peak_rss_mb()})
+
+
+""" Open a scope (e.g. 'raw_ingest') for an exposure: the stages measured until it closes - in any thread - are aggregated, and logged when
+    it closes, followed by the scope's total. When metrics are off nothing is recorded."""
+@contextmanager
+def metrics_scope(scope, exposure=None):
+    if not metrics_enabled():
+        yield
+        return
+    scope_state = {'stages': {}}
+    with metrics_lock:
+        metrics_state['scopes'].append(scope_state)
+    start, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        wall_seconds, cpu_seconds = time.perf_counter() - start, time.process_time() - start_cpu
+        with metrics_lock:
+            metrics_state['scopes'].remove(scope_state)
+        header = {'time': datetime.now().isoformat(), 'pid': os.getpid(), 'scope': scope, 'exposure': exposure}
+        records = [dict(header, stage=stage, **totals) for stage, totals in scope_state['stages'].items()]
+        records.append(dict(header, stage='total', calls=1, wall_seconds=wall_seconds, cpu_seconds=cpu_seconds,
+                            rows=sum(totals['rows'] for stage, totals in scope_state['stages'].items() if stage == 'copy'), bytes=0,
+                            peak_rss_mb=get_peak_rss_mb()))
+        if metrics_enabled():
+            write_metrics(records)
+
+
+""" Decorator running every call of a function in a metrics scope - the exposure is the file name of the function's positional argument
+    exposure_argument (the FITS file it works on)"""
+def instrumented(scope, exposure_argument=0):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not metrics_enabled():
+                return function(*args, **kwargs)
+            exposure = os.path.basename(args[exposure_argument]) if len(args) > exposure_argument and isinstance(args[exposure_argument], str) else None
+            with metrics_scope(scope, exposure):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+""" Decorator measuring every call of a function as a stage (see measure)"""
+def measured(stage):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not metrics_enabled():
+                return function(*args, **kwargs)
+            with measure(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+""" Read a metrics log back, as a list of records"""
+def read_metrics(log_path):
+    with open(log_path) as log_file:
+        return [json.loads(line) for line in log_file if line.strip()]
+
+
+""" Sum the records of a metrics log by (scope, stage) - e.g. to see the share of COPY in the raw ingest of a whole campaign. Returns a
+    dictionary of (scope, stage) -> counters, with the largest peak_rss_mb."""
+def summarize_metrics(records):
+    summary = {}
+    for record in records:
+        totals = summary.setdefault((record['scope'], record['stage']), dict.fromkeys(stage_counters + ['peak_rss_mb'], 0))
+        for counter in stage_counters:
+            totals[counter] += record[counter]
+        totals['peak_rss_mb'] = max(totals['peak_rss_mb'], record['peak_rss_mb'])
+    return summary
+
+
+""" To summarize a metrics log from the command line, do:
+    $ python metrics.py log_path
+"""
+if __name__ == '__main__':
+    summary = summarize_metrics(read_metrics(sys.argv[1]))
+    print('%-20s %-14s %8s %12s %12s %14s %14s %10s' % ('scope', 'stage', 'calls', 'wall (s)', 'cpu (s)', 'rows', 'MB', 'peak MB'))
+    for (scope, stage), totals in sorted(summary.items(), key=lambda item: (str(item[0][0]), item[0][1] == 'total', item[0][1])):
+        print('%-20s %-14s %8d %12.3f %12.3f %14d %14.1f %10.0f' % (scope, stage, totals['calls'], totals['wall_seconds'], totals['cpu_seconds'],
+                                                                   totals['rows'], totals['bytes'] / 1e6, totals['peak_rss_mb']))
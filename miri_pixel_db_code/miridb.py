@@ -7,11 +7,14 @@ Created on Mon Sep 17 10:28:20 2019
 
 The methods in this package are used to define/create the tables in the MIRI Pixel DB. Other methods are provided to interact with / perform operations on the DB.
 """
-from sqlalchemy import create_engine, Column, String, Boolean, Float, ForeignKey, Integer, DateTime, UniqueConstraint
+from sqlalchemy import create_engine, text, Column, String, Boolean, Float, REAL, ForeignKey, Integer, SmallInteger, DateTime, UniqueConstraint, Index, DDL, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship, backref
 from sqlalchemy.dialects.postgresql import ARRAY
 import numpy as np
+from exposuresdb import dq_val_ref, exposure_partitions, get_raw_zero_point
+from pixelmap import get_full_frame_positions, get_subarray_positions
+from binarycopy import get_column_types, copy_query_to_columns
 
 
 """Method to delete a table from the DB"""
@@ -25,6 +28,25 @@ def delete_table(table_name_to_be_deleted, base, connection_string):
     except AttributeError:
         print("%s table does not exist, so it cannot be deleted" % table_name_to_be_deleted)
 
+""" Delete an exposure, its corrected exposure(s) and all their ramps and groups from the DB. When the DB is partitioned by exposure
+    (load_miri_tables(base, partition_by_exposure=True)) the exposure's partitions are dropped first, children before parents, so nothing has to
+    be deleted row by row - the delete of the exposures row then cascades only into tables that are not partitioned."""
+def delete_exposure(engine, exposure_name):
+    with engine.begin() as con:
+        exp_id = con.execute(text('SELECT exp_id FROM exposures WHERE exp = :exp'), exp=exposure_name).scalar()
+        if exp_id is None:
+            print("%s is not in the DB, so it cannot be deleted" % exposure_name)
+            return
+        corrected_exp_ids = [row[0] for row in con.execute(text('SELECT corrected_exp_id FROM correctedexposures WHERE exp_id = :exp_id'), exp_id=exp_id)]
+        partitions = [(table_name, exposure_partitions[table_name] % corrected_exp_id) for table_name in ['correctedgroups', 'correctedramps'] for corrected_exp_id in corrected_exp_ids]
+        partitions += [(table_name, exposure_partitions[table_name] % exp_id) for table_name in ['groups', 'ramps']]
+        for table_name, partition in partitions:
+            """ a partition referenced by a foreign key cannot be dropped while attached - detaching checks that no rows still reference it"""
+            if con.execute(text('SELECT to_regclass(:partition)'), partition=partition).scalar() is not None:
+                con.execute('ALTER TABLE %s DETACH PARTITION %s' % (table_name, partition))
+                con.execute('DROP TABLE %s' % partition)
+        con.execute(text('DELETE FROM exposures WHERE exp_id = :exp_id'), exp_id=exp_id)
+
 """example: psql_string = 'SELECT pg_size_pretty( pg_database_size(\'postgres\') )' """
 def enter_psql_command(engine, psql_string):
     with engine.connect() as con:
@@ -88,7 +110,280 @@ def init_db(engine):
     cursor = connection.cursor()
     return session, base, connection, cursor
 
-def load_miri_tables(base):
+""" In compact_groups mode the group values are only stored once, in the ramp arrays (ramps.ramp, and correctedramps.corrected_ramp/dq_ramp/err_ramp),
+    and groups/correctedgroups are views that unnest these arrays - one row per group, with the same columns as the groups/correctedgroups tables.
+    Group ids are derived from the ramp ids: group_id = ramp_id*group_id_multiplier + group_number (and likewise corr_group_id from corr_ramp_id),
+    so they are stable and correctedgroups.group_id still matches groups.group_id. Views are not indexed - filter on ramp_id/corr_ramp_id
+    (or join through ramps/correctedramps) rather than on the group ids."""
+group_id_multiplier = 65536
+
+def compact_groups_views():
+    groups_view = """CREATE OR REPLACE VIEW groups AS
+        SELECT r.ramp_id::bigint * %d + g.group_number AS group_id, r.ramp_id, g.group_number::integer AS group_number, g.raw_value
+        FROM ramps r CROSS JOIN LATERAL unnest(r.ramp) WITH ORDINALITY AS g(raw_value, group_number)""" % group_id_multiplier
+    dq_flag_columns = ''.join(',\n        (g.dq_value & %d) <> 0 AS %s' % (dq_val, dq_name) for dq_val, dq_name in dq_val_ref.items())
+    corrected_groups_view = """CREATE OR REPLACE VIEW correctedgroups AS
+        SELECT cr.corr_ramp_id::bigint * %d + g.group_number AS corr_group_id, cr.ramp_id::bigint * %d + g.group_number AS group_id,
+        cr.corr_ramp_id, g.group_number::integer AS group_number, g.corrected_value, g.dq_value, g.error_value%s
+        FROM correctedramps cr CROSS JOIN LATERAL unnest(cr.corrected_ramp, cr.dq_ramp, cr.err_ramp)
+        WITH ORDINALITY AS g(corrected_value, dq_value, error_value, group_number)""" % (group_id_multiplier, group_id_multiplier, dq_flag_columns)
+    return {'groups': groups_view, 'correctedgroups': corrected_groups_view}
+
+
+""" In dq_bitmask mode the DQ flags of corrected ramps and groups are stored as integer DQ words only, and the flag columns are decoded by the
+    correctedrampflags and correctedgroupflags views (the columns of correctedramps/correctedgroups, plus one boolean per dq_val_ref flag).
+    Partial indexes on correctedramps(corrected_exp_id) for the indexed_dq_flags answer "all ramps with flag X in exposure Y" without scanning
+    the exposure. In compact_groups mode the correctedgroups view already decodes the group flags, so no correctedgroupflags view is needed."""
+default_indexed_dq_flags = ['do_not_use', 'saturated', 'jump_det', 'dead', 'hot', 'warm', 'nonlinear']
+
+def dq_flag_views(compact_groups=False):
+    views = {'correctedrampflags': 'CREATE OR REPLACE VIEW correctedrampflags AS SELECT t.*%s FROM correctedramps t'
+                                   % ''.join(',\n        (t.dq_word & %d) <> 0 AS %s' % (dq_val, dq_name) for dq_val, dq_name in dq_val_ref.items())}
+    if not compact_groups:
+        views['correctedgroupflags'] = ('CREATE OR REPLACE VIEW correctedgroupflags AS SELECT t.*%s FROM correctedgroups t'
+                                        % ''.join(',\n        (t.dq_value & %d) <> 0 AS %s' % (dq_val, dq_name) for dq_val, dq_name in dq_val_ref.items()))
+    return views
+
+
+""" Return the (corr_ramp_id, ramp_id) of every corrected ramp of a corrected exposure with the given DQ flag (a dq_val_ref name) set in
+    any of its groups. Works on both schemas: in dq_bitmask mode the DQ word is tested (with the bit written as a constant, so the partial
+    index of an indexed flag is used), otherwise the flag column."""
+def get_corrected_ramps_with_dq_flag(engine, dq_flag, corrected_exp_id):
+    dq_bits = {dq_name: dq_val for dq_val, dq_name in dq_val_ref.items()}
+    if dq_flag not in dq_bits:
+        raise ValueError('Unknown DQ flag %r - expected one of the dq_val_ref names' % dq_flag)
+    with engine.connect() as con:
+        has_dq_word = con.execute(text("""SELECT count(*) FROM information_schema.columns WHERE table_name = 'correctedramps'
+                                          AND column_name = 'dq_word'""")).scalar() > 0
+        flag_condition = '(dq_word & %d) <> 0' % dq_bits[dq_flag] if has_dq_word else dq_flag
+        return con.execute(text('SELECT corr_ramp_id, ramp_id FROM correctedramps WHERE corrected_exp_id = :corrected_exp_id AND %s ORDER BY corr_ramp_id'
+                                % flag_condition), corrected_exp_id=corrected_exp_id).fetchall()
+
+
+""" Pixel ids of the pixels given either as pixel_ids or as (row, col) pairs (1-based, as in the pixels table), as a list of ints"""
+def resolve_pixel_ids(con, pixel_ids=None, rows_cols=None):
+    if (pixel_ids is None) == (rows_cols is None):
+        raise ValueError('Give either pixel_ids or rows_cols')
+    if pixel_ids is not None:
+        return [int(pixel_id) for pixel_id in pixel_ids]
+    rows, cols = np.asarray(rows_cols, dtype=int).reshape(-1, 2).T
+    return [row[0] for row in con.execute(text("""SELECT p.pixel_id FROM pixels p JOIN unnest(CAST(:rows AS integer[]), CAST(:cols AS integer[]))
+                                                  AS rc(row_id, col_id) USING (row_id, col_id)"""), rows=rows.tolist(), cols=cols.tolist())]
+
+
+""" Arrays returned by get_pixel_history, with the value used to pad ramps shorter than the longest ramp returned"""
+pixel_history_padding = {'raw_ramp': -1, 'corrected_ramp': np.nan, 'err_ramp': np.nan, 'dq_ramp': 0}
+
+""" Scalar and ramp columns of the get_pixel_history query - (name, dtype, position in the row) - and the values of NULL scalars (ramps without
+    a corrected ramp)"""
+pixel_history_scalar_columns = [('pixel_id', int, 0), ('exp_id', int, 1), ('t0', 'datetime64[us]', 2), ('intnumber', int, 3), ('corrected_exp_id', int, 5),
+                                ('slope_value', float, 6), ('dq_word', np.uint32, 7)]
+pixel_history_ramp_columns = [('raw_ramp', np.int32, 4), ('corrected_ramp', float, 8), ('err_ramp', float, 9), ('dq_ramp', np.uint32, 10)]
+pixel_history_nulls = {'corrected_exp_id': -1, 'slope_value': np.nan, 'dq_word': 0}
+
+""" Convert a batch of rows of the get_pixel_history query into its arrays - the 2-D ramp arrays are padded to the longest ramp of the batch"""
+def get_pixel_history_batch(rows):
+    columns = list(zip(*rows)) if rows else [[]] * 11
+    batch = {}
+    for name, dtype, position in pixel_history_scalar_columns:
+        batch[name] = np.array([value if value is not None else pixel_history_nulls.get(name) for value in columns[position]], dtype=dtype)
+    ramps_by_column = {name: [ramp if ramp is not None else [] for ramp in columns[position]] for name, dtype, position in pixel_history_ramp_columns}
+    batch['ngroups'] = np.array([len(ramp) for ramp in ramps_by_column['raw_ramp']], dtype=int)
+    max_ngroups = batch['ngroups'].max() if len(batch['ngroups']) else 0
+    for name, dtype, position in pixel_history_ramp_columns:
+        ramps = np.full((len(ramps_by_column[name]), max_ngroups), pixel_history_padding[name], dtype=dtype)
+        """ ramps of the same length are copied in one assignment - there is one length per exposure, and usually just one overall"""
+        ramp_lengths = np.array([len(ramp) for ramp in ramps_by_column[name]], dtype=int)
+        for ramp_length in np.unique(ramp_lengths[ramp_lengths > 0]):
+            positions = np.flatnonzero(ramp_lengths == ramp_length)
+            ramps[positions, :ramp_length] = [ramps_by_column[name][k] for k in positions]
+        batch[name] = ramps
+    return batch
+
+""" Return the history of a set of pixels across every exposure in the DB, as a dictionary of NumPy arrays with one entry per ramp, ordered by
+    exposure t0 (then exposure, integration and pixel). Pixels are given either as pixel_ids or as (row, col) pairs (1-based, as in the pixels table).
+    Scalar entries: pixel_id, exp_id, t0, intnumber, ngroups, corrected_exp_id, slope_value, dq_word (the OR of the ramp's group DQ values).
+    Ramp entries are 2-D, padded to the longest ramp with pixel_history_padding (ngroups holds the length of each ramp): raw_ramp (ADC counts,
+    in every schema), corrected_ramp, err_ramp and dq_ramp. A raw ramp that has no corrected ramp gets corrected_exp_id -1, and a raw ramp with
+    several corrected versions appears once per version. Rows are streamed from a server-side cursor fetch_size at a time, and each batch is
+    converted to arrays as soon as it is fetched (see get_pixel_history_batch), so only fetch_size rows are ever held as Python objects - the
+    size of the result is only limited by the memory of the returned arrays."""
+def get_pixel_history(engine, pixel_ids=None, rows_cols=None, fetch_size=1000):
+    with engine.connect() as con:
+        pixel_ids = resolve_pixel_ids(con, pixel_ids, rows_cols)
+        raw_zero_point = get_raw_zero_point(con.connection)
+        has_dq_word = 'dq_word' in [row[0] for row in con.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'correctedramps'")]
+        dq_word = 'cr.dq_word' if has_dq_word else '(SELECT bit_or(d) FROM unnest(cr.dq_ramp) d)'
+        result = con.execution_options(stream_results=True).execute(text("""SELECT r.pixel_id, r.exp_id, e.t0, r.intnumber, r.ramp, cr.corrected_exp_id,
+                                              cr.slope_value, %s, cr.corrected_ramp, cr.err_ramp, cr.dq_ramp
+                                              FROM ramps r JOIN exposures e ON e.exp_id = r.exp_id LEFT JOIN correctedramps cr ON cr.ramp_id = r.ramp_id
+                                              WHERE r.pixel_id = ANY(CAST(:pixel_ids AS integer[]))
+                                              ORDER BY e.t0, r.exp_id, r.intnumber, r.pixel_id, cr.corrected_exp_id""" % dq_word),
+                                         pixel_ids=pixel_ids)
+        batches = []
+        while True:
+            rows = result.fetchmany(fetch_size)
+            if not rows:
+                break
+            batches.append(get_pixel_history_batch(rows))
+    if not batches:
+        batches.append(get_pixel_history_batch([]))
+    history = {name: np.concatenate([batch[name] for batch in batches]) for name, dtype, position in pixel_history_scalar_columns}
+    history['ngroups'] = np.concatenate([batch['ngroups'] for batch in batches])
+    max_ngroups = max(batch['raw_ramp'].shape[1] for batch in batches)
+    """ the ramps of each batch are padded to the longest ramp of all the batches - and released once copied, so the batches and the result
+        only overlap one column at a time"""
+    for name, dtype, position in pixel_history_ramp_columns:
+        history[name] = np.concatenate([np.pad(batch[name], ((0, 0), (0, max_ngroups - batch[name].shape[1])), constant_values=pixel_history_padding[name])
+                                        for batch in batches])
+        for batch in batches:
+            del batch[name]
+    history['raw_ramp'][np.arange(max_ngroups) < history['ngroups'][:, np.newaxis]] += raw_zero_point
+    return history
+
+
+""" dtype of each pixelstats column (see load_miri_tables) as returned by get_pixel_stats and get_exposure_pixel_stats, in get_pixel_stats column order -
+    dq_flag_counts holds one integer count per DQ flag"""
+pixel_stats_dtypes = {'pixel_id': int, 'exp_id': int, 'corrected_exp_id': int, 'nints': int, 'mean_slope': float, 'median_slope': float,
+                      'min_slope': float, 'max_slope': float, 'corrected_min': float, 'corrected_max': float, 'first_saturated_group': int,
+                      'dq_flag_counts': int}
+
+""" Per-pixel statistics columns of pixelstats, one value per row - the columns get_exposure_pixel_stats can return"""
+pixel_stats_value_columns = ['nints', 'mean_slope', 'median_slope', 'min_slope', 'max_slope', 'corrected_min', 'corrected_max', 'first_saturated_group']
+
+""" Return the pixelstats summary rows (see exposuresdb.init_pixel_stats) of a set of pixels - given as pixel_ids or (row, col) pairs - across every
+    corrected exposure, as a dictionary of NumPy arrays ordered by exposure t0. dq_flag_counts is 2-D, with one column per DQ flag in dq_val_ref order."""
+def get_pixel_stats(engine, pixel_ids=None, rows_cols=None):
+    columns = list(pixel_stats_dtypes)
+    with engine.connect() as con:
+        pixel_ids = resolve_pixel_ids(con, pixel_ids, rows_cols)
+        rows = con.execute(text("""SELECT e.t0, %s FROM pixelstats s JOIN exposures e ON e.exp_id = s.exp_id WHERE s.pixel_id = ANY(CAST(:pixel_ids AS integer[]))
+                                   ORDER BY e.t0, s.exp_id, s.corrected_exp_id, s.pixel_id""" % ', '.join('s.' + column for column in columns)),
+                           pixel_ids=pixel_ids).fetchall()
+    values = list(zip(*rows)) if rows else [[]] * (len(columns) + 1)
+    pixel_stats = {'t0': np.array(values[0], dtype='datetime64[us]')}
+    for column, column_values in zip(columns, values[1:]):
+        pixel_stats[column] = np.array(column_values, dtype=pixel_stats_dtypes[column])
+    pixel_stats['dq_flag_counts'] = pixel_stats['dq_flag_counts'].reshape(len(rows), len(dq_val_ref))
+    return pixel_stats
+
+
+""" Total number of groups flagged with dq_flag (a dq_val_ref name, e.g. 'jump_det') per pixel, over every corrected exposure in the DB - optionally
+    only for the given pixel_ids. Read from the pixelstats summary, so no corrected group is scanned. Returns (pixel_ids, totals) arrays."""
+def get_dq_flag_totals(engine, dq_flag, pixel_ids=None):
+    dq_flag_positions = {dq_name: k + 1 for k, dq_name in enumerate(dq_val_ref.values())}
+    if dq_flag not in dq_flag_positions:
+        raise ValueError('Unknown DQ flag %r - expected one of the dq_val_ref names' % dq_flag)
+    pixel_condition = 'WHERE pixel_id = ANY(CAST(:pixel_ids AS integer[]))' if pixel_ids is not None else ''
+    with engine.connect() as con:
+        rows = con.execute(text('SELECT pixel_id, sum(dq_flag_counts[%d]) FROM pixelstats %s GROUP BY pixel_id ORDER BY pixel_id'
+                                % (dq_flag_positions[dq_flag], pixel_condition)),
+                           pixel_ids=None if pixel_ids is None else [int(pixel_id) for pixel_id in pixel_ids]).fetchall()
+    return np.array([row[0] for row in rows], dtype=int), np.array([row[1] for row in rows], dtype=np.int64)
+
+
+""" One pixelstats column (e.g. 'median_slope', 'first_saturated_group') for every pixel of a corrected exposure. Returns (pixel_ids, values) arrays."""
+def get_exposure_pixel_stats(engine, corrected_exp_id, column='median_slope'):
+    if column not in pixel_stats_value_columns:
+        raise ValueError('Unknown pixelstats column %r' % column)
+    with engine.connect() as con:
+        rows = con.execute(text('SELECT pixel_id, %s FROM pixelstats WHERE corrected_exp_id = :corrected_exp_id ORDER BY pixel_id' % column),
+                           corrected_exp_id=int(corrected_exp_id)).fetchall()
+    return np.array([row[0] for row in rows], dtype=int), np.array([row[1] for row in rows], dtype=pixel_stats_dtypes[column])
+
+
+""" Ramp array columns that get_exposure_cube can rebuild, and the table holding each"""
+exposure_cube_columns = {'ramp': 'ramps', 'corrected_ramp': 'correctedramps', 'err_ramp': 'correctedramps', 'dq_ramp': 'correctedramps'}
+
+""" Rebuild an exposure as a (nints, ngroups, nrows, ncols) NumPy cube from its ramp arrays - column is 'ramp' (raw ADC counts, in every schema)
+    or one of the corrected arrays 'corrected_ramp', 'err_ramp', 'dq_ramp', read from corrected_exposure_name (by default the exposure's latest
+    corrected exposure). rows, cols and integrations are optional slices of the cube's row, column and integration axes (0-based, as in
+    the FITS cube) limiting it to a sub-region and/or integration range. The ramps are transferred with one binary COPY and scattered into the cube by the position of their
+    pixel in the subarray (see pixelmap.get_subarray_positions) - there is no per-row Python work. Positions without a ramp are 0 (NaN for
+    floating point columns)."""
+def get_exposure_cube(engine, exposure_name, column='ramp', corrected_exposure_name=None, rows=slice(None), cols=slice(None), integrations=slice(None)):
+    if column not in exposure_cube_columns:
+        raise ValueError('Unknown column %r - expected one of %s' % (column, list(exposure_cube_columns)))
+    with engine.connect() as con:
+        exposure = con.execute(text('SELECT exp_id, ngroups, nints FROM exposures WHERE exp = :exp'), exp=exposure_name).fetchone()
+        if exposure is None:
+            raise ValueError('%s is not in the DB' % exposure_name)
+        exp_id, ngroups, nints = exposure
+        if exposure_cube_columns[column] == 'correctedramps':
+            corrected_exp_id = con.execute(text("""SELECT corrected_exp_id FROM correctedexposures WHERE exp_id = :exp_id
+                                                   AND (corrected_exp = :name OR CAST(:name AS varchar) IS NULL) ORDER BY corrected_exp_id DESC LIMIT 1"""),
+                                           exp_id=exp_id, name=corrected_exposure_name).scalar()
+            if corrected_exp_id is None:
+                raise ValueError('%s has no corrected exposure %s' % (exposure_name, corrected_exposure_name or ''))
+    connection = engine.raw_connection()
+    try:
+        ramp_key_types = get_column_types('ramps', ['pixel_id', 'intnumber'], connection)
+        """ the pixel index: the subarray position of every pixel of the exposure, from the pixel ids of its first integration"""
+        exposure_pixel_ids, = copy_query_to_columns('SELECT pixel_id FROM ramps WHERE exp_id = %d AND intnumber = (SELECT min(intnumber) FROM ramps WHERE exp_id = %d)'
+                                                    % (exp_id, exp_id), ramp_key_types[:1], [0], connection)
+        full_rows, full_cols = get_full_frame_positions(exposure_pixel_ids)
+        origin = (full_rows.min(), full_cols.min())
+        pixel_rows, pixel_cols = get_subarray_positions(exposure_pixel_ids, origin)
+        row_range = range(pixel_rows.max() + 1)[rows]
+        col_range = range(pixel_cols.max() + 1)[cols]
+        int_range = range(1, nints + 1)[integrations]
+        conditions = ["r.intnumber = ANY('{%s}'::integer[])" % ','.join(map(str, int_range))] if len(int_range) < nints else []
+        if len(row_range) < pixel_rows.max() + 1 or len(col_range) < pixel_cols.max() + 1:
+            in_region = np.isin(pixel_rows, row_range) & np.isin(pixel_cols, col_range)
+            conditions.append("r.pixel_id = ANY('{%s}'::integer[])" % ','.join(map(str, exposure_pixel_ids[in_region])))
+        if exposure_cube_columns[column] == 'ramps':
+            query = 'SELECT r.pixel_id, r.intnumber, r.ramp FROM ramps r WHERE r.exp_id = %d' % exp_id
+        else:
+            query = ('SELECT r.pixel_id, r.intnumber, cr.%s FROM correctedramps cr JOIN ramps r ON r.ramp_id = cr.ramp_id WHERE cr.corrected_exp_id = %d'
+                     % (column, corrected_exp_id))
+        column_types = ramp_key_types + get_column_types(exposure_cube_columns[column], [column], connection)
+        ramp_pixel_ids, intnumbers, ramp_values = copy_query_to_columns(' AND '.join([query] + conditions), column_types, [0, 0, ngroups], connection)
+        raw_zero_point = get_raw_zero_point(connection) if column == 'ramp' else 0
+    finally:
+        connection.close()
+    """ cube index of every subarray row, subarray column and intnumber inside the requested slices"""
+    cube_indexes = []
+    for index_range, size in [(int_range, nints + 1), (row_range, pixel_rows.max() + 1), (col_range, pixel_cols.max() + 1)]:
+        lookup = np.full(size, -1)
+        lookup[list(index_range)] = np.arange(len(index_range))
+        cube_indexes.append(lookup)
+    value_dtype = np.dtype({'ramp': np.int32, 'dq_ramp': np.uint32}.get(column, ramp_values.dtype.newbyteorder('=')))
+    cube = np.full((len(int_range), ngroups, len(row_range), len(col_range)), np.nan if value_dtype.kind == 'f' else 0, dtype=value_dtype)
+    ramp_rows, ramp_cols = get_subarray_positions(ramp_pixel_ids, origin)
+    cube[cube_indexes[0][intnumbers], :, cube_indexes[1][ramp_rows], cube_indexes[2][ramp_cols]] = ramp_values.astype(value_dtype) + raw_zero_point
+    return cube
+
+
+""" Define the MIRI Pixel DB tables on base. With compact_groups=True the groups and correctedgroups tables are replaced by views over the
+    ramp arrays (see compact_groups_views) - the views are created/dropped with base.metadata.create_all()/drop_all().
+    With partition_by_exposure=True the ramps, groups, correctedramps and correctedgroups tables are created as partitioned tables
+    RANGE-partitioned on their primary key (see exposuresdb.exposure_partitions) - the ingest functions then create one partition per exposure, and
+    delete_exposure drops them. Unique constraints are then created on each partition (a constraint on a partitioned table would have to include
+    the partition key) - this is equivalent, as the constrained columns always identify a single exposure.
+    With dq_bitmask=True the 31 DQ flag columns of correctedramps/correctedgroups are not stored: rows keep their integer DQ word (correctedgroups.dq_value,
+    and correctedramps.dq_word, the OR of the ramp's group DQ values) - see dq_flag_views and get_corrected_ramps_with_dq_flag.
+    With narrow_types=True raw values are stored as smallint and corrected values (slopes, corrected values and errors) as real, matching the
+    16-bit ADC counts and float32 pipeline products they come from - exposuresdb.narrow_type_mapping lists the dtype each narrow column
+    holds exactly, and the ingest refuses buffers that do not fit it. Raw values (ramps.ramp, groups.raw_value) are then stored minus
+    exposuresdb.RAW_ZERO_POINT: add get_raw_zero_point() back to read ADC counts."""
+def load_miri_tables(base, compact_groups=False, partition_by_exposure=False, dq_bitmask=False, indexed_dq_flags=default_indexed_dq_flags, narrow_types=False):
+    views = {}
+    if compact_groups:
+        views.update(compact_groups_views())
+    if dq_bitmask:
+        views.update(dq_flag_views(compact_groups))
+    for view_name, view_sql in views.items():
+        event.listen(base.metadata, 'after_create', DDL(view_sql))
+        event.listen(base.metadata, 'before_drop', DDL('DROP VIEW IF EXISTS %s' % view_name))
+
+    """ column types of the raw and corrected values - see narrow_types above, and exposuresdb.RAW_ZERO_POINT"""
+    raw_type = SmallInteger if narrow_types else Integer
+    value_type = REAL if narrow_types else Float
+
+    def partitioned_table_args(id_column):
+        if partition_by_exposure:
+            return {'extend_existing': True, 'postgresql_partition_by': 'RANGE (%s)' % id_column}
+        return {'extend_existing': True}
 
     class Detectors(base):
         """ORM for the detectors table"""
@@ -162,111 +457,165 @@ def load_miri_tables(base):
     class Ramps(base):
         """ORM for the Ramps table"""
         __tablename__ = 'ramps'
-        __table_args__ = {'extend_existing': True}
+        __table_args__ = partitioned_table_args('ramp_id')
         ramp_id = Column(Integer(), primary_key=True, autoincrement=True)   #new
         pixel_id = Column(Integer(),ForeignKey('pixels.pixel_id'))
         exp_id = Column(Integer(),ForeignKey('exposures.exp_id',ondelete="cascade"), index = True)
         intnumber = Column(Integer())
-        ramp = Column(ARRAY(Integer, dimensions = 1))
-        UniqueConstraint(exp_id, pixel_id, intnumber, name='unique_ramp_constraint')
-        groups_rel = relationship("Groups", backref=backref('ramps', passive_deletes = True))
+        ramp = Column(ARRAY(raw_type, dimensions = 1))
+        if not partition_by_exposure:
+            UniqueConstraint(exp_id, pixel_id, intnumber, name='unique_ramp_constraint')
+        if not compact_groups:
+            groups_rel = relationship("Groups", backref=backref('ramps', passive_deletes = True))
+
+    if not compact_groups:
+        class Groups(base):
+            """ORM for the Groups table"""
+            __tablename__ = 'groups'
+            __table_args__ = partitioned_table_args('group_id')
+            group_id = Column(Integer(), primary_key=True, autoincrement=True, nullable=False)   #new
+            ramp_id = Column(Integer(),ForeignKey('ramps.ramp_id',ondelete="cascade"), index = True)
+            group_number = Column(Integer())
+            raw_value = Column(raw_type())
+            if not partition_by_exposure:
+                UniqueConstraint(ramp_id, group_number, name = 'unique_group_constraint')
 
-    class Groups(base):
-        """ORM for the Groups table"""
-        __tablename__ = 'groups'
-        __table_args__ = {'extend_existing': True}
-        group_id = Column(Integer(), primary_key=True, autoincrement=True, nullable=False)   #new
-        ramp_id = Column(Integer(),ForeignKey('ramps.ramp_id',ondelete="cascade"), index = True)
-        group_number = Column(Integer())
-        raw_value = Column(Integer())
-        UniqueConstraint(ramp_id, group_number, name = 'unique_group_constraint')
 
     class CorrectedRamps(base):
         """ORM for the CorrectedRamps table"""
         __tablename__ = 'correctedramps'
-        __table_args__ = {'extend_existing': True}
+        __table_args__ = partitioned_table_args('corr_ramp_id')
         corr_ramp_id = Column(Integer(), primary_key=True, autoincrement=True)   #new
         ramp_id = Column(Integer(),ForeignKey('ramps.ramp_id', ondelete="cascade"), index = True)
         corrected_exp_id = Column(Integer(), ForeignKey('correctedexposures.corrected_exp_id', ondelete="cascade"), index = True)
-        slope_value = Column(Float())
-        corrected_ramp = Column(ARRAY(Float, dimensions = 1))
+        slope_value = Column(value_type())
+        corrected_ramp = Column(ARRAY(value_type, dimensions = 1))
         dq_ramp = Column(ARRAY(Integer, dimensions = 1))
-        err_ramp = Column(ARRAY(Float, dimensions = 1))
-        do_not_use = Column(Boolean())
-        saturated = Column(Boolean())
-        jump_det = Column(Boolean())
-        dropout = Column(Boolean())
-        reserved_16 = Column(Boolean())
-        reserved_32 = Column(Boolean())
-        reserved_64 = Column(Boolean())
-        reserved_128 = Column(Boolean())
-        unreliable_error = Column(Boolean())
-        non_science = Column(Boolean())
-        dead = Column(Boolean())
-        hot = Column(Boolean())
-        warm = Column(Boolean())
-        low_qe = Column(Boolean())
-        rc = Column(Boolean())
-        telegraph = Column(Boolean())
-        nonlinear = Column(Boolean())
-        bad_ref_pixel = Column(Boolean())
-        no_flat_field = Column(Boolean())
-        no_gain_value = Column(Boolean())
-        no_lin_corr = Column(Boolean())
-        no_sat_check = Column(Boolean())
-        unreliable_bias = Column(Boolean())
-        unreliable_dark = Column(Boolean())
-        unreliable_slope = Column(Boolean())
-        unreliable_flat = Column(Boolean())
-        open = Column(Boolean())
-        adj_open = Column(Boolean())
-        unreliable_reset = Column(Boolean())
-        msa_failed_open = Column(Boolean())
-        other_bad_pixel = Column(Boolean())
-        UniqueConstraint(corrected_exp_id, ramp_id, name='unique_corrected_ramp_constraint')
-        corr_groups_rel = relationship("CorrectedGroups", backref=backref('correctedramps', passive_deletes=True))
-
-
-    class CorrectedGroups(base):
-        """ORM for the CorrectedGroups table"""
-        __tablename__ = 'correctedgroups'
+        err_ramp = Column(ARRAY(value_type, dimensions = 1))
+        if dq_bitmask:
+            dq_word = Column(Integer()) # bitwise OR of dq_ramp - see dq_bitmask in load_miri_tables
+        else:
+            do_not_use = Column(Boolean())
+            saturated = Column(Boolean())
+            jump_det = Column(Boolean())
+            dropout = Column(Boolean())
+            reserved_16 = Column(Boolean())
+            reserved_32 = Column(Boolean())
+            reserved_64 = Column(Boolean())
+            reserved_128 = Column(Boolean())
+            unreliable_error = Column(Boolean())
+            non_science = Column(Boolean())
+            dead = Column(Boolean())
+            hot = Column(Boolean())
+            warm = Column(Boolean())
+            low_qe = Column(Boolean())
+            rc = Column(Boolean())
+            telegraph = Column(Boolean())
+            nonlinear = Column(Boolean())
+            bad_ref_pixel = Column(Boolean())
+            no_flat_field = Column(Boolean())
+            no_gain_value = Column(Boolean())
+            no_lin_corr = Column(Boolean())
+            no_sat_check = Column(Boolean())
+            unreliable_bias = Column(Boolean())
+            unreliable_dark = Column(Boolean())
+            unreliable_slope = Column(Boolean())
+            unreliable_flat = Column(Boolean())
+            open = Column(Boolean())
+            adj_open = Column(Boolean())
+            unreliable_reset = Column(Boolean())
+            msa_failed_open = Column(Boolean())
+            other_bad_pixel = Column(Boolean())
+        if not partition_by_exposure:
+            UniqueConstraint(corrected_exp_id, ramp_id, name='unique_corrected_ramp_constraint')
+        if not compact_groups:
+            corr_groups_rel = relationship("CorrectedGroups", backref=backref('correctedramps', passive_deletes=True))
+
+    if dq_bitmask:
+        dq_bits = {dq_name: dq_val for dq_val, dq_name in dq_val_ref.items()}
+        for dq_flag in indexed_dq_flags:
+            Index('ix_correctedramps_%s' % dq_flag, CorrectedRamps.__table__.c.corrected_exp_id, postgresql_where=text('(dq_word & %d) <> 0' % dq_bits[dq_flag]))
+
+    if not compact_groups:
+        class CorrectedGroups(base):
+            """ORM for the CorrectedGroups table"""
+            __tablename__ = 'correctedgroups'
+            __table_args__ = partitioned_table_args('corr_group_id')
+            corr_group_id = Column(Integer(), primary_key=True, autoincrement=True)   #new
+            group_id = Column(Integer(),ForeignKey('groups.group_id', ondelete="cascade"), index = True)
+            corr_ramp_id = Column(Integer(),ForeignKey('correctedramps.corr_ramp_id',ondelete="cascade"), index = True)
+            group_number = Column(Integer())
+            corrected_value = Column(value_type())
+            dq_value = Column(Integer())
+            error_value = Column(value_type())
+            if not dq_bitmask:
+                do_not_use = Column(Boolean())
+                saturated = Column(Boolean())
+                jump_det = Column(Boolean())
+                dropout = Column(Boolean())
+                reserved_16 = Column(Boolean())
+                reserved_32 = Column(Boolean())
+                reserved_64 = Column(Boolean())
+                reserved_128 = Column(Boolean())
+                unreliable_error = Column(Boolean())
+                non_science = Column(Boolean())
+                dead = Column(Boolean())
+                hot = Column(Boolean())
+                warm = Column(Boolean())
+                low_qe = Column(Boolean())
+                rc = Column(Boolean())
+                telegraph = Column(Boolean())
+                nonlinear = Column(Boolean())
+                bad_ref_pixel = Column(Boolean())
+                no_flat_field = Column(Boolean())
+                no_gain_value = Column(Boolean())
+                no_lin_corr = Column(Boolean())
+                no_sat_check = Column(Boolean())
+                unreliable_bias = Column(Boolean())
+                unreliable_dark = Column(Boolean())
+                unreliable_slope = Column(Boolean())
+                unreliable_flat = Column(Boolean())
+                open = Column(Boolean())
+                adj_open = Column(Boolean())
+                unreliable_reset = Column(Boolean())
+                msa_failed_open = Column(Boolean())
+                other_bad_pixel = Column(Boolean())
+            if not partition_by_exposure:
+                UniqueConstraint(corr_ramp_id, group_id, name = 'unique_corrected_group_constraint')
+
+    class PixelStats(base):
+        """ORM for the PixelStats table - one summary row per pixel per corrected exposure, written by add_corrected_exposure_to_db
+        (see exposuresdb.accumulate_pixel_stats)"""
+        __tablename__ = 'pixelstats'
+        __table_args__ = {'extend_existing': True}
+        corrected_exp_id = Column(Integer(), ForeignKey('correctedexposures.corrected_exp_id', ondelete="cascade"), primary_key=True)
+        pixel_id = Column(Integer(), ForeignKey('pixels.pixel_id'), primary_key=True, index = True)
+        exp_id = Column(Integer(), ForeignKey('exposures.exp_id', ondelete="cascade"), index = True)
+        nints = Column(Integer())
+        mean_slope = Column(Float())
+        median_slope = Column(Float())
+        min_slope = Column(Float())
+        max_slope = Column(Float())
+        corrected_min = Column(Float())
+        corrected_max = Column(Float())
+        first_saturated_group = Column(Integer()) # 0 if the pixel never saturated
+        dq_flag_counts = Column(ARRAY(Integer, dimensions = 1)) # number of groups with each DQ flag set, in dq_val_ref order
+
+    class IngestState(base):
+        """ORM for the IngestState table - the checkpoints of the raw and corrected exposures being ingested (see exposuresdb.record_ingest_state).
+        exp is the exposure (kind 'raw') or corrected exposure (kind 'corrected') file name; first_ramp_id/first_group_id are the first ids of
+        the ramp and group blocks reserved for it (corr_ramp_id/corr_group_id blocks for a corrected exposure)"""
+        __tablename__ = 'ingeststate'
         __table_args__ = {'extend_existing': True}
-        corr_group_id = Column(Integer(), primary_key=True, autoincrement=True)   #new
-        group_id = Column(Integer(),ForeignKey('groups.group_id', ondelete="cascade"), index = True)
-        corr_ramp_id = Column(Integer(),ForeignKey('correctedramps.corr_ramp_id',ondelete="cascade"), index = True)
-        group_number = Column(Integer())
-        corrected_value = Column(Float())
-        dq_value = Column(Integer())
-        error_value = Column(Float())
-        do_not_use = Column(Boolean())
-        saturated = Column(Boolean())
-        jump_det = Column(Boolean())
-        dropout = Column(Boolean())
-        reserved_16 = Column(Boolean())
-        reserved_32 = Column(Boolean())
-        reserved_64 = Column(Boolean())
-        reserved_128 = Column(Boolean())
-        unreliable_error = Column(Boolean())
-        non_science = Column(Boolean())
-        dead = Column(Boolean())
-        hot = Column(Boolean())
-        warm = Column(Boolean())
-        low_qe = Column(Boolean())
-        rc = Column(Boolean())
-        telegraph = Column(Boolean())
-        nonlinear = Column(Boolean())
-        bad_ref_pixel = Column(Boolean())
-        no_flat_field = Column(Boolean())
-        no_gain_value = Column(Boolean())
-        no_lin_corr = Column(Boolean())
-        no_sat_check = Column(Boolean())
-        unreliable_bias = Column(Boolean())
-        unreliable_dark = Column(Boolean())
-        unreliable_slope = Column(Boolean())
-        unreliable_flat = Column(Boolean())
-        open = Column(Boolean())
-        adj_open = Column(Boolean())
-        unreliable_reset = Column(Boolean())
-        msa_failed_open = Column(Boolean())
-        other_bad_pixel = Column(Boolean())
-        UniqueConstraint(corr_ramp_id, group_id, name = 'unique_corrected_group_constraint')
+        exp = Column(String(255), primary_key=True, nullable=False)
+        kind = Column(String(255))
+        exp_id = Column(Integer(), ForeignKey('exposures.exp_id', ondelete="cascade"), index = True)
+        corrected_exp_id = Column(Integer(), ForeignKey('correctedexposures.corrected_exp_id', ondelete="cascade"), index = True)
+        stage = Column(String(255)) # 'loading' while chunks are being written, then 'complete'
+        chunk_rows = Column(Integer()) # chunk_rows of the ingest (NULL: whole exposure in one chunk) - resuming needs the same chunks
+        copy_format = Column(String(255)) # 'binary' or 'text' - resuming needs the same format
+        num_chunks = Column(Integer())
+        chunks_done = Column(Integer())
+        first_ramp_id = Column(Integer())
+        first_group_id = Column(Integer())
+        updated = Column(DateTime)
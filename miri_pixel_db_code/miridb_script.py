@@ -9,14 +9,24 @@ This is a python script that, when called, will take a LVL1 FITS exposure and ad
     1) Creates a pipeline ready FITS file (if one does not already exist) for LVL1 exposure if it is 'JPL' or 'OTIS' ground test data
     2) Adds the raw exposure info to the DB
     3) Checks if a *_ramp.fits file exists - if not it will run the JWST Detector1Pipeline to create the *_ramp.fits and *_rateint.fits (or *_rate.fits if single integration)
-    4) Adds the corrected exposure info to the DB """
+    4) Adds the corrected exposure info to the DB
+The script can also be given a directory of LVL1 FITS exposures, or a manifest file listing them, in which case every exposure is
+ingested by a pool of worker processes (see ingest_exposures_in_parallel). Steps 1) and 3) can be run ahead of the ingest for a whole
+campaign, across every core and resumably, with pipebatch.py. With --metrics=path the time of every step, and of the stages of each ingest,
+is logged to path (see metrics.py). Exposures are ingested default_chunk_rows detector rows at a time (see --chunk-rows below)."""
 
 from sqlalchemy import Table
-from exposuresdb import generate_structured_coordinates, insert_pixel_detector_info, add_raw_exposure_to_db, add_corrected_exposure_to_db
+from exposuresdb import insert_pixel_detector_info, add_raw_exposure_to_db, add_corrected_exposure_to_db
+from pixelmap import preload_subarray_pixel_ids
 from miridb import init_db, load_miri_tables, load_engine
-from pipefits import create_pipeline_ready_file, generate_corrected_ramp, run_jwst_pipeline_jpl8
+from pipefits import create_pipeline_ready_file, run_detector1_pipeline
+from bulkload import bulk_load_session
+from metrics import instrumented, enable_metrics
+from multiprocessing import Pool
+import glob
 import os
 import time
+import traceback
 
 """ Function to add a exposure to the DB.
     For JPL8 data, we override the reference files used for:
@@ -25,51 +35,144 @@ import time
      - rscd
     This method is specific to JPL8 data because of the specific JPL8 reference file overrides provided, and we currently skip the dark correction for JPL8..
     Future development: This could be handled more intelligently by just supplying a config file that specify reference file overrides - in doing so we could generalize this method and use it for all LVL1 FITS exposure data.
-    Look into supplying .pmap file?"""
-def add_raw_and_corrected_exposure_to_db(data_genesis, data_origin, full_data_path, data_coords, ref_coords_reshape, session, connection, exposures, ramps, groups, correctedexposures, correctedramps, reference_directory):
+    Look into supplying .pmap file?
+    The wall clock and CPU time of each ingest is printed; with metrics on, the whole exposure is also logged as an 'exposure' scope.
+    Both ingests stream the exposure chunk_rows detector rows at a time (see exposuresdb.iterate_ramp_chunks)."""
+@instrumented('exposure', exposure_argument=2)
+def add_raw_and_corrected_exposure_to_db(data_genesis, data_origin, full_data_path, data_coords, ref_coords_reshape, session, connection, exposures, ramps, groups, correctedexposures, correctedramps, reference_directory, chunk_rows=None):
     """ Create pipeline ready file for LVL1 exposure """
     data_directory = os.path.dirname(full_data_path) + '/'
     create_pipeline_ready_file(full_data_path, data_genesis, data_directory)
     raw_exposure_filepath = full_data_path.replace(".fits","_pipe.fits")
     """ Add raw exposure to DB"""
     print('Start adding raw exposure to DB')
-    start = time.process_time()
-    add_raw_exposure_to_db(raw_exposure_filepath, data_genesis, data_coords, ref_coords_reshape, session, connection, exposures, ramps)
-    print('Finished adding raw exposure to DB: ' + str(time.process_time() - start))
+    start, start_cpu = time.time(), time.process_time()
+    add_raw_exposure_to_db(raw_exposure_filepath, data_genesis, data_coords, ref_coords_reshape, session, connection, exposures, ramps, chunk_rows=chunk_rows)
+    print('Finished adding raw exposure to DB: %.2f s (%.2f s CPU)' % (time.time() - start, time.process_time() - start_cpu))
     """ Call JWST pipeline if *_ramp.fits file does not exist"""
     corrected_ramp_fn = raw_exposure_filepath.replace(".fits","_ramp.fits")
     if not os.path.exists(corrected_ramp_fn):
-        if data_origin == 'jpl8':
-            run_jwst_pipeline_jpl8(raw_exposure_filepath, reference_directory, data_directory)
-        elif data_origin == 'test':
-            generate_corrected_ramp(raw_exposure_filepath, skip_dark = True, output_path = data_directory)
-        # elif data_origin == 'jpl9'
-        # elif data_origin == 'OTIS'
-        # elif data_origin == 'Flight'
+        run_detector1_pipeline(raw_exposure_filepath, data_origin, reference_directory, data_directory)
     else:
         print('Corrected Ramp File Already Exists, so JWST pipeline was not executed.')
     """ Add corrected exposure to DB """
     print('Start adding corrected exposure to DB')
-    start = time.process_time()
-    add_corrected_exposure_to_db(corrected_ramp_fn, session, connection, exposures, groups, ramps, correctedexposures, correctedramps)
-    print('Finished adding corrected exposure to DB: ' + str(time.process_time() - start))
+    start, start_cpu = time.time(), time.process_time()
+    add_corrected_exposure_to_db(corrected_ramp_fn, session, connection, exposures, groups, ramps, correctedexposures, correctedramps, chunk_rows=chunk_rows)
+    print('Finished adding corrected exposure to DB: %.2f s (%.2f s CPU)' % (time.time() - start, time.process_time() - start_cpu))
 
 
 
+""" Detector rows per ingest chunk: a chunk of a FULL exposure is then 32 * 1032 ramps of one integration, whatever the NINTS of the exposure or the
+    size of its _ramp.fits file, so the memory used by an ingest stays bounded. It is also the granularity of the ingest checkpoints."""
+default_chunk_rows = 32
+
+
+""" Load in the tables that will be queried during ingest"""
+def load_ingest_tables(engine, base):
+    return [Table(table_name,  base.metadata, autoload=True, autoload_with=engine) for table_name in ['exposures', 'ramps', 'groups', 'correctedexposures', 'correctedramps']]
+
+
+""" Generated files (pipeline ready files and JWST pipeline products) live next to the LVL1 exposures - these are not exposures to ingest"""
+generated_file_suffixes = ('_pipe.fits', '_ramp.fits', '_rate.fits', '_rateints.fits', '_trapsfilled.fits')
+
+
+""" Return the LVL1 exposure paths to ingest: every FITS file in a directory (skipping generated files), or every line of a manifest
+    file (blank lines and lines starting with # are skipped, relative paths are taken relative to the manifest)"""
+def collect_exposure_paths(data_path):
+    if os.path.isdir(data_path):
+        all_fits = sorted(glob.glob(os.path.join(data_path, '*.fits')))
+        return [path for path in all_fits if not path.endswith(generated_file_suffixes)]
+    manifest_directory = os.path.dirname(os.path.abspath(data_path))
+    with open(data_path) as manifest:
+        lines = [line.strip() for line in manifest]
+    return [os.path.join(manifest_directory, line) for line in lines if line and not line.startswith('#')]
+
+
+""" Each worker process gets its own engine, session and connection (these cannot be shared across processes). The subarray pixel ids are
+    memoized once per worker (forked workers inherit those of the parent)."""
+ingest_worker_state = {}
+
+def init_ingest_worker(connection_string, data_coords, ref_coords_reshape):
+    engine = load_engine(connection_string)
+    session, base, connection, cursor = init_db(engine)
+    load_miri_tables(base)
+    exposures, ramps, groups, correctedexposures, correctedramps = load_ingest_tables(engine, base)
+    preload_subarray_pixel_ids()
+    ingest_worker_state.update({'session': session, 'connection': connection, 'exposures': exposures, 'ramps': ramps, 'groups': groups,
+                                'correctedexposures': correctedexposures, 'correctedramps': correctedramps,
+                                'data_coords': data_coords, 'ref_coords_reshape': ref_coords_reshape})
+
+
+""" Ingest a single exposure in a worker process - failures are caught and reported, so one bad exposure does not stop the batch"""
+def ingest_exposure_in_worker(ingest_args):
+    data_genesis, data_origin, full_data_path, reference_directory, chunk_rows = ingest_args
+    state = ingest_worker_state
+    start = time.time()
+    try:
+        add_raw_and_corrected_exposure_to_db(data_genesis, data_origin, full_data_path, state['data_coords'], state['ref_coords_reshape'], state['session'],
+                                             state['connection'], state['exposures'], state['ramps'], state['groups'], state['correctedexposures'],
+                                             state['correctedramps'], reference_directory, chunk_rows)
+        return {'exposure': full_data_path, 'status': 'ingested', 'seconds': time.time() - start, 'error': None, 'pid': os.getpid()}
+    except Exception:
+        state['connection'].rollback()
+        state['session'].rollback()
+        return {'exposure': full_data_path, 'status': 'failed', 'seconds': time.time() - start, 'error': traceback.format_exc(), 'pid': os.getpid()}
+
+
+""" Ingest many exposures across a pool of num_processes worker processes. Results are printed as each exposure finishes and returned
+    as a list of dictionaries (exposure, status, seconds, error, pid). With bulk_load=True the whole batch is loaded in a bulk-load session
+    (see bulkload.py): indexes and foreign keys are dropped for the load, and rebuilt/validated once at the end. Each exposure is ingested
+    chunk_rows detector rows at a time."""
+def ingest_exposures_in_parallel(data_genesis, data_origin, exposure_paths, reference_directory, connection_string, data_coords, ref_coords_reshape, num_processes, bulk_load=False,
+                                 chunk_rows=default_chunk_rows):
+    if bulk_load:
+        with bulk_load_session(load_engine(connection_string)):
+            return ingest_exposures_in_parallel(data_genesis, data_origin, exposure_paths, reference_directory, connection_string, data_coords,
+                                                ref_coords_reshape, num_processes, chunk_rows=chunk_rows)
+    ingest_args = [(data_genesis, data_origin, path, reference_directory, chunk_rows) for path in exposure_paths]
+    results = []
+    with Pool(processes=num_processes, initializer=init_ingest_worker, initargs=(connection_string, data_coords, ref_coords_reshape)) as pool:
+        for result in pool.imap_unordered(ingest_exposure_in_worker, ingest_args):
+            results.append(result)
+            print('[%d/%d] %s %s in %.1f s' % (len(results), len(ingest_args), result['status'], result['exposure'], result['seconds']))
+            if result['error']:
+                print(result['error'])
+    num_failed = len([result for result in results if result['status'] == 'failed'])
+    print('Finished batch: %d exposures ingested, %d failed' % (len(results) - num_failed, num_failed))
+    return results
+
+
 """ To run this script from the command line, do:
-    $ python  miridb_script_file_location data_origin full_data_path reference_directory connection_string
+    $ python  miridb_script_file_location data_origin full_data_path reference_directory connection_string [num_processes] [bulk] [--metrics=path] [--chunk-rows=N]
     where:
     miridb_script_file_location = miridb_script.py (or filepath to miridb_script.py)
     data_origin = JPL8, JPL9, OTIS, Flight etc. Right now only JPL8 supported.
+    full_data_path = a LVL1 FITS exposure, or - for batch mode - a directory of LVL1 FITS exposures or a manifest file listing one exposure per line
     reference_directory = directory location of the folder conatining the reference files be used as overrides in the JWST Detector1Pipeline.
     password = password to access the MIRI Pixel DB - ask developers for access (J. Brendan Hagan <hagan@stsci.edu>, Sarah Kendrew <sarah.kendrew@esa.int>)
+    num_processes = (optional, batch mode only) number of worker processes, defaults to the number of CPUs
+    bulk = (optional, batch mode only) pass the word bulk to load the batch in a bulk-load session (see bulkload.py)
+    --metrics=path = (optional, anywhere on the command line) append the stage metrics of every ingest, in every worker, to the JSON-lines log
+                     at path - summarize it with python metrics.py path
+    --chunk-rows=N = (optional, anywhere on the command line) ingest exposures N detector rows at a time, defaults to default_chunk_rows. An
+                     unfinished ingest is only resumed with the chunk_rows it was started with
+    In batch mode the script exits with status 1 if any exposure failed to ingest.
 """
 import sys
 if __name__ == '__main__':
+    metrics_options = [arg for arg in sys.argv if arg.startswith('--metrics=')]
+    chunk_rows_options = [arg for arg in sys.argv if arg.startswith('--chunk-rows=')]
+    sys.argv = [arg for arg in sys.argv if arg not in metrics_options + chunk_rows_options]
+    if metrics_options:
+        enable_metrics(metrics_options[-1][len('--metrics='):])
+    chunk_rows = int(chunk_rows_options[-1][len('--chunk-rows='):]) if chunk_rows_options else default_chunk_rows
     data_origin = sys.argv[1].lower()
     full_data_path = sys.argv[2]
     reference_directory = sys.argv[3]
     connection_string = sys.argv[4]
+    num_processes = int(sys.argv[5]) if len(sys.argv) > 5 else os.cpu_count()
+    bulk_load = len(sys.argv) > 6 and sys.argv[6].lower() == 'bulk'
 
     engine = load_engine(connection_string)
     session, base, connection, cursor = init_db(engine)
@@ -83,18 +186,25 @@ if __name__ == '__main__':
         insert_pixel_detector_info(connection)
 
     """ Load in tables that will be queried """
-    exposures = Table('exposures',  base.metadata, autoload=True, autoload_with=engine)
-    ramps = Table('ramps',  base.metadata, autoload=True, autoload_with=engine)
-    groups = Table('groups',  base.metadata, autoload=True, autoload_with=engine)
-    correctedexposures = Table('correctedexposures',  base.metadata, autoload=True, autoload_with=engine)
-    correctedramps = Table('correctedramps',  base.metadata, autoload=True, autoload_with=engine)
+    exposures, ramps, groups, correctedexposures, correctedramps = load_ingest_tables(engine, base)
 
-    """ data_coords and ref_coords_reshape variables the same for every exposure (and all subarrays)"""
-    data_coords, ref_coords_reshape = generate_structured_coordinates()
+    """ the pixel ids of every subarray are computed in closed form (see pixelmap.py), so the structured coordinates are not needed - the ids of the
+        named subarrays are memoized here, before any worker process is forked"""
+    preload_subarray_pixel_ids()
+    data_coords, ref_coords_reshape = None, None
 
-    """ Parallelization could happen here, over 'full_data_path' and 'reference_directory' variable - would need to make some modifications to this script"""
+    """ A directory or manifest of exposures is ingested in parallel, across num_processes worker processes"""
     if data_origin == 'jpl8' or data_origin == 'test':
         data_genesis = 'JPL'
-        add_raw_and_corrected_exposure_to_db(data_genesis, data_origin, full_data_path, data_coords, ref_coords_reshape, session, connection, exposures, ramps, groups, correctedexposures, correctedramps, reference_directory)
+        if os.path.isdir(full_data_path) or not full_data_path.endswith('.fits'):
+            exposure_paths = collect_exposure_paths(full_data_path)
+            results = ingest_exposures_in_parallel(data_genesis, data_origin, exposure_paths, reference_directory, connection_string, data_coords, ref_coords_reshape, num_processes, bulk_load,
+                                                   chunk_rows)
+            """ a batch with failed exposures exits with status 1, so schedulers and CI notice"""
+            if any(result['status'] == 'failed' for result in results):
+                sys.exit(1)
+        else:
+            add_raw_and_corrected_exposure_to_db(data_genesis, data_origin, full_data_path, data_coords, ref_coords_reshape, session, connection, exposures, ramps, groups, correctedexposures, correctedramps, reference_directory,
+                                                 chunk_rows)
     else:
         print('Method to add ' + data_origin + ' exposure not yet supported with this script')
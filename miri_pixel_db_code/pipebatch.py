@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 23:02:51 2026
+
+@author: MIRI Pixel DB developers
+
+The methods in this package prepare a whole campaign of LVL1 exposures for ingest: each exposure goes through the batch_stages - the pipeline
+ready file (pipefits.create_pipeline_ready_file), then the Detector1Pipeline (*_ramp.fits and *_rateints.fits) - and every stage of every
+exposure is scheduled on a pool of worker processes, one process per core by default.
+
+Progress is kept in a JSON state file (by default pipebatch_state.json in the campaign directory), written by the parent process after every
+stage starts and finishes, so a batch can be stopped at any point and run again: completed stages are skipped, and the outputs of a stage that
+was started but never recorded as completed (an interrupted run, or a failure) are removed before the stage is run again. Failed stages are
+retried up to max_retries times per run. Exposures seen for the first time whose outputs already exist (prepared before the batch runner was
+used) are taken as done, like miridb_script does. Usage:
+
+    $ python pipebatch.py data_origin campaign_path reference_directory [num_processes]
+"""
+import os
+import json
+import time
+import queue
+import traceback
+from multiprocessing import Pool
+from pipefits import create_pipeline_ready_file, run_detector1_pipeline
+from miridb_script import collect_exposure_paths
+
+""" Stages run on each exposure, in order"""
+batch_stages = ['pipe', 'detector1']
+
+""" data_genesis of the LVL1 files of each supported data origin"""
+data_genesis_of_origin = {'jpl8': 'JPL', 'test': 'JPL'}
+
+""" Suffixes of the Detector1Pipeline products written next to the pipeline ready file"""
+detector1_suffixes = ['_ramp.fits', '_rateints.fits', '_rate.fits', '_trapsfilled.fits']
+
+
+""" Files written by a stage of an exposure - the first one is the file whose existence marks the stage as done"""
+def get_stage_outputs(stage, exposure_path):
+    pipeline_ready_file = exposure_path.replace('.fits', '_pipe.fits')
+    if stage == 'pipe':
+        return [pipeline_ready_file]
+    return [pipeline_ready_file.replace('.fits', suffix) for suffix in detector1_suffixes]
+
+
+""" Run one stage of an exposure in a worker process. With clean=True the stage's outputs left by an earlier, unfinished attempt are removed
+    first. Failures are caught and reported, so one bad exposure does not stop the batch."""
+def run_batch_stage(stage_args):
+    stage, exposure_path, data_origin, reference_directory, clean = stage_args
+    output_dir = os.path.dirname(exposure_path) + '/'
+    outputs = get_stage_outputs(stage, exposure_path)
+    start = time.time()
+    try:
+        if clean:
+            for output_path in outputs:
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+        if stage == 'pipe':
+            create_pipeline_ready_file(exposure_path, data_genesis_of_origin[data_origin], output_dir)
+        elif not os.path.exists(outputs[0]):
+            run_detector1_pipeline(get_stage_outputs('pipe', exposure_path)[0], data_origin, reference_directory, output_dir)
+        if not os.path.exists(outputs[0]):
+            raise RuntimeError('%s stage did not write %s' % (stage, outputs[0]))
+        return {'exposure': exposure_path, 'stage': stage, 'status': 'completed', 'seconds': time.time() - start, 'error': None, 'pid': os.getpid()}
+    except Exception:
+        return {'exposure': exposure_path, 'stage': stage, 'status': 'failed', 'seconds': time.time() - start, 'error': traceback.format_exc(), 'pid': os.getpid()}
+
+
+""" Default location of the state file of a campaign: in the campaign directory, or next to the manifest file listing the exposures"""
+def default_state_path(campaign_path):
+    campaign_directory = campaign_path if os.path.isdir(campaign_path) else os.path.dirname(os.path.abspath(campaign_path))
+    return os.path.join(campaign_directory, 'pipebatch_state.json')
+
+
+""" Read the state file of a batch - a dictionary of exposure path -> {'completed': [stages], 'attempts': {stage: n}, 'seconds': {stage: s},
+    'error': last error or None}. A missing state file is an empty batch."""
+def read_batch_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as state_file:
+        return json.load(state_file)
+
+
+""" Write the state file under a temporary name and rename it, so an interrupted write never leaves a truncated state file"""
+def write_batch_state(state_path, state):
+    with open(state_path + '.tmp', 'w') as state_file:
+        json.dump(state, state_file, indent=1, sort_keys=True)
+    os.replace(state_path + '.tmp', state_path)
+
+
+""" The first stage an exposure has not completed, or None if it is done"""
+def next_batch_stage(exposure_state):
+    for stage in batch_stages:
+        if stage not in exposure_state['completed']:
+            return stage
+    return None
+
+
+""" Prepare every exposure of a campaign (a directory of LVL1 FITS exposures or a manifest file, see miridb_script.collect_exposure_paths) for
+    ingest, across num_processes worker processes (default: one per core). Each stage is a separate task, so the Detector1Pipeline run of an
+    exposure is scheduled as soon as its pipeline ready file is written. Returns the state of the batch (see read_batch_state)."""
+def run_pipeline_batch(data_origin, campaign_path, reference_directory, num_processes=None, max_retries=2, state_path=None):
+    if data_origin not in data_genesis_of_origin:
+        raise ValueError('Method to prepare ' + data_origin + ' exposures not yet supported')
+    state_path = state_path or default_state_path(campaign_path)
+    state = read_batch_state(state_path)
+    exposure_paths = collect_exposure_paths(campaign_path)
+    for exposure_path in exposure_paths:
+        state.setdefault(exposure_path, {'completed': [], 'attempts': {}, 'seconds': {}, 'error': None})
+    results = queue.Queue()
+    retries = {}
+    num_completed = len([path for path in exposure_paths if next_batch_stage(state[path]) is None])
+    print('Batch of %d exposures: %d already prepared' % (len(exposure_paths), num_completed))
+    with Pool(processes=num_processes or os.cpu_count()) as pool:
+        """ a stage that was attempted before but not completed has left partial outputs, which are removed by the worker. The attempt is
+            recorded before the stage is submitted, so this also holds when the batch is killed while the stage runs."""
+        def submit(exposure_path):
+            exposure_state = state[exposure_path]
+            stage = next_batch_stage(exposure_state)
+            clean = exposure_state['attempts'].get(stage, 0) > 0
+            exposure_state['attempts'][stage] = exposure_state['attempts'].get(stage, 0) + 1
+            write_batch_state(state_path, state)
+            failure = lambda error: results.put({'exposure': exposure_path, 'stage': stage, 'status': 'failed', 'seconds': 0, 'error': repr(error), 'pid': None})
+            pool.apply_async(run_batch_stage, [(stage, exposure_path, data_origin, reference_directory, clean)], callback=results.put, error_callback=failure)
+        num_running = 0
+        for exposure_path in exposure_paths:
+            if next_batch_stage(state[exposure_path]) is not None:
+                submit(exposure_path)
+                num_running += 1
+        while num_running > 0:
+            result = results.get()
+            num_running -= 1
+            exposure_path, stage = result['exposure'], result['stage']
+            exposure_state = state[exposure_path]
+            exposure_state['seconds'][stage] = result['seconds']
+            exposure_state['error'] = result['error']
+            if result['status'] == 'completed':
+                exposure_state['completed'].append(stage)
+            else:
+                retries[exposure_path, stage] = retries.get((exposure_path, stage), 0) + 1
+            print('%s %s %s in %.1f s' % (stage, result['status'], exposure_path, result['seconds']))
+            if result['error']:
+                print(result['error'])
+            if result['status'] == 'completed' and next_batch_stage(exposure_state) is None:
+                num_completed += 1
+                print('[%d/%d] prepared %s' % (num_completed, len(exposure_paths), exposure_path))
+            if next_batch_stage(exposure_state) is not None and retries.get((exposure_path, stage), 0) <= max_retries:
+                submit(exposure_path)
+                num_running += 1
+            else:
+                write_batch_state(state_path, state)
+    num_failed = len([path for path in exposure_paths if next_batch_stage(state[path]) is not None])
+    print('Finished batch: %d exposures prepared, %d failed' % (len(exposure_paths) - num_failed, num_failed))
+    return state
+
+
+""" To run this script from the command line, do:
+    $ python pipebatch.py data_origin campaign_path reference_directory [num_processes]
+    where:
+    data_origin = JPL8 (or test) - the data origins miridb_script supports
+    campaign_path = a directory of LVL1 FITS exposures or a manifest file listing one exposure per line
+    reference_directory = directory location of the folder containing the reference files used as overrides in the JWST Detector1Pipeline
+    num_processes = (optional) number of worker processes, defaults to the number of CPUs
+    Run it again with the same arguments to resume an interrupted batch or retry the exposures that failed.
+"""
+import sys
+if __name__ == '__main__':
+    data_origin = sys.argv[1].lower()
+    campaign_path = sys.argv[2]
+    reference_directory = sys.argv[3]
+    num_processes = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    state = run_pipeline_batch(data_origin, campaign_path, reference_directory, num_processes)
+    """ a batch with exposures that are not fully prepared exits with status 1, so schedulers and CI notice"""
+    if any(next_batch_stage(state[exposure_path]) is not None for exposure_path in collect_exposure_paths(campaign_path)):
+        sys.exit(1)
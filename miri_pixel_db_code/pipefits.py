@@ -10,7 +10,11 @@ This methods found in this package are used to prep JPL and OTIS ground test dat
 
 from astropy.io import fits
 import os.path
+import tempfile
 import numpy as np
+from fitsreader import open_fits, read_image_cube
+from pixelmap import subarray_definitions
+from metrics import measure, instrumented
 from jwst.pipeline import Detector1Pipeline
 
 def chunks(l, n):
@@ -18,21 +22,35 @@ def chunks(l, n):
     for i in range(0, len(l), n):
         yield l[i:i + n]
 
-### This function splits the reference pixels at the top of an image and creates a REFOUT extension to store them
-def split_data_and_refout(hdulist):
-    hdr = hdulist[0].header
+### Number of detector data rows in an LVL1 frame - the rows after them (the last 20% of NAXIS2) hold the reference output pixels
+def get_detector_rows(hdr):
     ROWSTART = hdr['ROWSTART']
     ROWSTOP = ROWSTART + hdr['NAXIS2']*0.8 - 1
     nrows = ROWSTOP - ROWSTART + 1
     # make sure they're integers with a nearest integer calculation
-    nrows = int(nrows + 0.5)
-    fulldata = hdulist[0].data
-    detectordata = fulldata[:, :nrows]
-    refoutdata = fulldata[:, nrows:]
-    refout = np.array([np.array(list(chunks(dat.flatten(),nrows))).transpose() for dat in refoutdata])
+    return int(nrows + 0.5)
+
+### Reorganize the reference output rows of a block of frames (nframes, nrefrows, ncols) into REFOUT images of nrows rows: the reference
+### output pixels of each frame are read in runs of nrows pixels, and each run becomes a column. Returns a view.
+def reshape_refout(refoutdata, nrows):
+    return refoutdata.reshape(refoutdata.shape[0], -1, nrows).transpose(0, 2, 1)
+
+### Detector rows, and shapes (nints, ngroups, rows, columns) of the SCI and REFOUT data, of an LVL1 cube of shape (nframes, NAXIS2, NAXIS1)
+def get_pipeline_ready_shapes(hdr, cube_shape):
+    nrows = get_detector_rows(hdr)
+    nframes, nallrows, ncols = cube_shape
     number_ramps = hdr['NGROUP']
-    ramp_data = np.array(list(chunks(detectordata,number_ramps)))
-    ref_pix_ramp_data = np.array(list(chunks(refout,number_ramps)))
+    sci_shape = (nframes // number_ramps, number_ramps, nrows, ncols)
+    refout_shape = (nframes // number_ramps, number_ramps, nrows, (nallrows - nrows) * ncols // nrows)
+    return nrows, sci_shape, refout_shape
+
+### This function splits the reference pixels at the top of an image and creates a REFOUT extension to store them
+def split_data_and_refout(hdulist):
+    hdr = hdulist[0].header
+    fulldata = read_image_cube(hdulist, 0)[:]
+    nrows, sci_shape, refout_shape = get_pipeline_ready_shapes(hdr, fulldata.shape)
+    ramp_data = fulldata[:, :nrows].reshape(sci_shape)
+    ref_pix_ramp_data = np.ascontiguousarray(reshape_refout(fulldata[:, nrows:], nrows)).reshape(refout_shape)
     primaryhdu = fits.PrimaryHDU(header = hdr)
     scihdu = fits.ImageHDU(name = 'SCI')
     scihdu.data = ramp_data
@@ -41,64 +59,139 @@ def split_data_and_refout(hdulist):
     new_hdu_list = fits.HDUList(hdus = [primaryhdu,scihdu,refhdu])
     return new_hdu_list
 
-def Generate_JPL_Pipeline_Ready_File(file_path, output_dir):
-    jpl_hdu = fits.open(file_path)
-    #data_dir = os.path.dirname(file_path) + '/'
-    ### expected NAXIS1, NAXIS2 keywords for subarray data (dimensions include reference pixels)
-    subarray_keywords = [[[1032, 1280], 'FULL'],
-                         [[288, 280], 'MASK1065'],
-                         [[256, 320], 'SUB256'],
-                         [[288, 280], 'MASK1140'],
-                         [[320, 380], 'MASKLYOT'],
-                         [[512, 640], 'BRIGHTSKY'],
-                         [[72, 80], 'SUB64'],
-                         [[136, 160], 'SUB128'],
-                         [[72, 520], 'SLITLESSPRISM'],
-                         [[288, 280], 'MASK1550']]
-    detector_info = {'MIRIMAGE':493, 'MIRIFULONG':494, 'MIRIFUSHORT':495} ### need to force JPL data to be one of these in order to work for JWST pipeline
-    jpl_hdr = jpl_hdu[0].header
-    NAXIS1 = jpl_hdr['NAXIS1']
-    NAXIS2 = jpl_hdr['NAXIS2']
-    orig_size_jpl = [NAXIS1,NAXIS2]
+### Same HDUs as split_data_and_refout, without reading the data: the SCI and REFOUT extensions hold zero-memory placeholders with the shape and
+### dtype of their data, so their headers are complete. Edit the headers, then write the file with write_pipeline_ready_file.
+def pipeline_ready_hdus(hdulist):
+    hdr = hdulist[0].header
+    cube = read_image_cube(hdulist, 0)
+    nrows, sci_shape, refout_shape = get_pipeline_ready_shapes(hdr, cube.shape)
+    primaryhdu = fits.PrimaryHDU(header = hdr)
+    scihdu = fits.ImageHDU(name = 'SCI')
+    scihdu.data = np.broadcast_to(np.zeros(1, dtype=cube.dtype), sci_shape)
+    refhdu = fits.ImageHDU(name = 'REFOUT')
+    refhdu.data = np.broadcast_to(np.zeros(1, dtype=cube.dtype), refout_shape)
+    return fits.HDUList(hdus = [primaryhdu,scihdu,refhdu])
+
+### Convert data to the on-disk representation described by an extension header: big-endian, and unsigned integers shifted by BZERO (unsigned
+### bytes are stored as they are)
+def encode_fits_data(data, hdr):
+    if data.dtype.kind == 'u' and data.dtype.itemsize > 1:
+        data = (data ^ data.dtype.type(hdr['BZERO'])).view(data.dtype.str.replace('u', 'i'))
+    return data.astype(data.dtype.newbyteorder('>'), copy=False)
+
+### Write the HDUs of hdulist to output_path, streaming the data of each HDU from data_blocks: one iterable of arrays per HDU, written in order
+### (blocks of the first axis of its data), or an empty one for an HDU without data. The data of the HDUs is only used for their headers, so it
+### can be a placeholder (see pipeline_ready_hdus) and memory use is bounded by the largest block. As with HDUList.writeto, an existing
+### output_path raises FileExistsError (an OSError) unless overwrite=True. The file is written to a temporary file in the same directory and renamed to output_path
+### once complete, so an interrupted write never leaves a truncated file behind.
+def write_streamed_fits(hdulist, data_blocks, output_path, overwrite=False):
+    if os.path.exists(output_path) and not overwrite:
+        raise FileExistsError('File %r already exists.' % output_path)
+    hdulist.update_extend()
+    file_descriptor, temporary_path = tempfile.mkstemp(suffix='.part', prefix=os.path.basename(output_path) + '.', dir=os.path.dirname(os.path.abspath(output_path)))
     try:
-        SUBARRAY = subarray_keywords[list(np.array(subarray_keywords)[:,0]).index(orig_size_jpl)][1]
-    except ValueError:
-        SUBARRAY = 'GENERIC'
-    jpl_hdr.rename_keyword('NGROUPS','NGROUP')
-    hdu_object_list = split_data_and_refout(jpl_hdu)
-    jpl_hdu.close()
-    hdr = hdu_object_list[0].header
-    hdr.rename_keyword('DATE_END','DATE-END') ### this keyword not needed for feeding to JWST pipeline - used later for inserting into database
-    hdr.rename_keyword('TIME_END','TIME-END') ### this keyword not needed for feeding to JWST pipeline - used later for inserting into database
-    hdr.rename_keyword('DATE_OBS','DATE-OBS')
-    hdr.rename_keyword('TIME_OBS','TIME-OBS')
-    hdr.rename_keyword('NINT','NINTS')
-    hdr.rename_keyword('NFRAME','NFRAMES')
-    hdr.rename_keyword('NGROUP','NGROUPS')
-    NREFIMG = int(NAXIS2*0.2)
-    '''JPL data incorrectly uses COLSTART value - see http://poppy.as.arizona.edu/dhas/ for more details: "...it was determined that for JPL testing the COLSTART keyword in the header is incorrect. This version of the DHAS fixes the COLSTART value in the software. It does not update the COLSTART in the RAW DATA. "'''
-    if hdr['ORIGIN'] == 'JPL':
-        hdr['COLSTART'] = int(0.2*hdr['COLSTART'] + 0.8) ### COLSTART correction for JPL data
-        hdr['GROUPGAP'] = 0   ### HARD-CODED - is this always 0? GROUPGAP is "The number of dropped frames in between groups."
-        hdr['DET_JPL'] = hdr['DETECTOR'] ### keep 'DETECTOR' keyword from JPL, store in new keyword 'DET_JPL'
-        hdr['DETECTOR'] = 'MIRIMAGE' ### HARD-CODED
-        hdr['READPATT'] = 'FAST'     ### HARD-CODED
-        hdr['SCAIDJPL'] = hdr['SCA_ID'] ### keep 'SCA_ID' keyword from JPL, store in new keyword 'SCAIDJPL'
-        hdr['SCA_ID'] = detector_info[hdr['DETECTOR']]    ### taken from HARD-CODED 'DETECTOR' keyword
-        hdr['OBS_ID'] = str(hdr['OBS_ID']) ### 'OBS_ID' is integer in JPL data, pipeline expects string
-    hdr['SUBARRAY'] = SUBARRAY
-    hdr['SUBSTRT2'] = hdr['ROWSTART']
-    hdr['SUBSTRT1'] = (hdr['COLSTART']*4 - 3) ### int((COLSTART - 1)*0.8 + 1) <-- SUBSTRT1 formula using JPL 'COLSTART' as is.
-    hdr['SUBSIZE1'] = NAXIS1
-    hdr['SUBSIZE2'] = NAXIS2 - NREFIMG
-    hdr_filename = os.path.basename(file_path)
-    pipeline_ready_file = hdr_filename.replace(".fits", "_pipe.fits")
-    #pipeline_ready_file = hdr['FILENAME'].replace(".fits","_pipe.fits")
-    hdr['FILENAME'] = pipeline_ready_file
-    output_path = output_dir + pipeline_ready_file
-    #data_dir + pipeline_ready_file
-    hdu_object_list.writeto(output_path)
-    hdu_object_list.close()
+        with os.fdopen(file_descriptor, 'wb') as output_file:
+            write_streamed_hdus(hdulist, data_blocks, output_file)
+        os.chmod(temporary_path, 0o666 & ~get_umask())
+        os.replace(temporary_path, output_path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+### The file mode creation mask of the process (mkstemp creates files readable by their owner only)
+def get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+### Write the headers and streamed data of the HDUs of hdulist to an open binary file (see write_streamed_fits)
+def write_streamed_hdus(hdulist, data_blocks, output_file):
+    for hdu, blocks in zip(hdulist, data_blocks):
+        output_file.write(hdu.header.tostring().encode('ascii'))
+        data_size = 0
+        for block in blocks:
+            with measure('serialize') as stage:
+                data = np.ascontiguousarray(encode_fits_data(block, hdu.header))
+                stage['bytes'] = data.nbytes
+            with measure('fits_write') as stage:
+                output_file.write(data.data)
+                stage['bytes'] = data.nbytes
+            data_size += data.nbytes
+        ### FITS data units are padded with zeros to a multiple of 2880 bytes
+        if data_size:
+            output_file.write(bytes(-data_size % 2880))
+
+### Write the pipeline ready file of an LVL1 exposure (hdulist, opened with open_fits) from the HDUs returned by pipeline_ready_hdus. The SCI and
+### REFOUT data are streamed one integration at a time, straight from the memory-mapped LVL1 cube, so memory use does not depend on the size of
+### the exposure. The file is byte-for-byte what split_data_and_refout(hdulist).writeto(output_path) writes.
+def write_pipeline_ready_file(hdulist, pipeline_hdus, output_path):
+    cube = read_image_cube(hdulist, 0)
+    nints, number_ramps, nrows, ncols = pipeline_hdus['SCI'].data.shape
+    def integrations(select):
+        for integration in range(nints):
+            with measure('fits_read') as stage:
+                frames = np.array(cube[integration * number_ramps:(integration + 1) * number_ramps])
+                stage['bytes'] = frames.nbytes
+            yield select(frames)
+    write_streamed_fits(pipeline_hdus, [[], integrations(lambda frames: frames[:, :nrows]),
+                                        integrations(lambda frames: reshape_refout(frames[:, nrows:], nrows))], output_path)
+
+def Generate_JPL_Pipeline_Ready_File(file_path, output_dir):
+    with open_fits(file_path) as jpl_hdu:
+        #data_dir = os.path.dirname(file_path) + '/'
+        ### expected NAXIS1, NAXIS2 keywords for subarray data (dimensions include reference pixels)
+        subarray_keywords = [[[1032, 1280], 'FULL'],
+                             [[288, 280], 'MASK1065'],
+                             [[256, 320], 'SUB256'],
+                             [[288, 280], 'MASK1140'],
+                             [[320, 380], 'MASKLYOT'],
+                             [[512, 640], 'BRIGHTSKY'],
+                             [[72, 80], 'SUB64'],
+                             [[136, 160], 'SUB128'],
+                             [[72, 520], 'SLITLESSPRISM'],
+                             [[288, 280], 'MASK1550']]
+        detector_info = {'MIRIMAGE':493, 'MIRIFULONG':494, 'MIRIFUSHORT':495} ### need to force JPL data to be one of these in order to work for JWST pipeline
+        jpl_hdr = jpl_hdu[0].header
+        NAXIS1 = jpl_hdr['NAXIS1']
+        NAXIS2 = jpl_hdr['NAXIS2']
+        orig_size_jpl = [NAXIS1,NAXIS2]
+        try:
+            SUBARRAY = subarray_keywords[list(np.array(subarray_keywords)[:,0]).index(orig_size_jpl)][1]
+        except ValueError:
+            SUBARRAY = 'GENERIC'
+        jpl_hdr.rename_keyword('NGROUPS','NGROUP')
+        hdu_object_list = pipeline_ready_hdus(jpl_hdu)
+        hdr = hdu_object_list[0].header
+        hdr.rename_keyword('DATE_END','DATE-END') ### this keyword not needed for feeding to JWST pipeline - used later for inserting into database
+        hdr.rename_keyword('TIME_END','TIME-END') ### this keyword not needed for feeding to JWST pipeline - used later for inserting into database
+        hdr.rename_keyword('DATE_OBS','DATE-OBS')
+        hdr.rename_keyword('TIME_OBS','TIME-OBS')
+        hdr.rename_keyword('NINT','NINTS')
+        hdr.rename_keyword('NFRAME','NFRAMES')
+        hdr.rename_keyword('NGROUP','NGROUPS')
+        NREFIMG = int(NAXIS2*0.2)
+        '''JPL data incorrectly uses COLSTART value - see http://poppy.as.arizona.edu/dhas/ for more details: "...it was determined that for JPL testing the COLSTART keyword in the header is incorrect. This version of the DHAS fixes the COLSTART value in the software. It does not update the COLSTART in the RAW DATA. "'''
+        if hdr['ORIGIN'] == 'JPL':
+            hdr['COLSTART'] = int(0.2*hdr['COLSTART'] + 0.8) ### COLSTART correction for JPL data
+            hdr['GROUPGAP'] = 0   ### HARD-CODED - is this always 0? GROUPGAP is "The number of dropped frames in between groups."
+            hdr['DET_JPL'] = hdr['DETECTOR'] ### keep 'DETECTOR' keyword from JPL, store in new keyword 'DET_JPL'
+            hdr['DETECTOR'] = 'MIRIMAGE' ### HARD-CODED
+            hdr['READPATT'] = 'FAST'     ### HARD-CODED
+            hdr['SCAIDJPL'] = hdr['SCA_ID'] ### keep 'SCA_ID' keyword from JPL, store in new keyword 'SCAIDJPL'
+            hdr['SCA_ID'] = detector_info[hdr['DETECTOR']]    ### taken from HARD-CODED 'DETECTOR' keyword
+            hdr['OBS_ID'] = str(hdr['OBS_ID']) ### 'OBS_ID' is integer in JPL data, pipeline expects string
+        hdr['SUBARRAY'] = SUBARRAY
+        hdr['SUBSTRT2'] = hdr['ROWSTART']
+        hdr['SUBSTRT1'] = (hdr['COLSTART']*4 - 3) ### int((COLSTART - 1)*0.8 + 1) <-- SUBSTRT1 formula using JPL 'COLSTART' as is.
+        hdr['SUBSIZE1'] = NAXIS1
+        hdr['SUBSIZE2'] = NAXIS2 - NREFIMG
+        hdr_filename = os.path.basename(file_path)
+        pipeline_ready_file = hdr_filename.replace(".fits", "_pipe.fits")
+        #pipeline_ready_file = hdr['FILENAME'].replace(".fits","_pipe.fits")
+        hdr['FILENAME'] = pipeline_ready_file
+        output_path = output_dir + pipeline_ready_file
+        #data_dir + pipeline_ready_file
+        write_pipeline_ready_file(jpl_hdu, hdu_object_list, output_path)
 
 
 def run_jwst_pipeline_jpl8(raw_exposure_filepath, reference_directory, pipeline_directory):
@@ -109,50 +202,37 @@ def run_jwst_pipeline_jpl8(raw_exposure_filepath, reference_directory, pipeline_
     generate_corrected_ramp(raw_exposure_filepath, linearity_override = linearity_override_file, saturation_override = saturation_override_file, rscd_override = rscd_override_file, skip_dark = True, output_path = pipeline_directory)
 
 def Generate_OTIS_Pipeline_Ready_File(file_path):
-    hdu_object_list_pre = fits.open(file_path)
-    data_dir = os.path.dirname(file_path) + '/'
-    hdr_pre = hdu_object_list_pre[0].header
-    first_pix = [int(hdr_pre['COLCORNR']),int(hdr_pre['ROWCORNR'])]
-    size = [hdr_pre['NAXIS1'],hdr_pre['NAXIS2']-hdr_pre['NREFIMG']]
-    subarray_name = grab_subname(first_pix,size)
-    hdu_object_list = split_data_and_refout(hdu_object_list_pre)
-    hdu_object_list_pre.close()
-    hdr = hdu_object_list[0].header
-    ### editing fits headers to feed to the jwst pipeline
-    hdr.rename_keyword('READOUT','READPATT')
-    hdr['SUBARRAY'] = subarray_name
-    hdr['SUBSTRT1'] = first_pix[0]
-    hdr['SUBSTRT2'] = first_pix[1]
-    hdr['SUBSIZE1'] = size[0]
-    hdr['SUBSIZE2'] = size[1]
-    hdr['EXP_TYPE'] = 'MIR_IMAGE'
-    hdr.rename_keyword('NINT','NINTS')
-    hdr.rename_keyword('NFRAME','NFRAMES')
-    hdr.rename_keyword('NGROUP','NGROUPS')
-    pipeline_ready_file = hdr['FILENAME'].replace(".fits","_pipe.fits")
-    output_path = data_dir + pipeline_ready_file
-    hdu_object_list.writeto(output_path)
-    print(output_path)
-    hdu_object_list.close()
+    with open_fits(file_path) as hdu_object_list_pre:
+        data_dir = os.path.dirname(file_path) + '/'
+        hdr_pre = hdu_object_list_pre[0].header
+        first_pix = [int(hdr_pre['COLCORNR']),int(hdr_pre['ROWCORNR'])]
+        size = [hdr_pre['NAXIS1'],hdr_pre['NAXIS2']-hdr_pre['NREFIMG']]
+        subarray_name = grab_subname(first_pix,size)
+        hdu_object_list = pipeline_ready_hdus(hdu_object_list_pre)
+        hdr = hdu_object_list[0].header
+        ### editing fits headers to feed to the jwst pipeline
+        hdr.rename_keyword('READOUT','READPATT')
+        hdr['SUBARRAY'] = subarray_name
+        hdr['SUBSTRT1'] = first_pix[0]
+        hdr['SUBSTRT2'] = first_pix[1]
+        hdr['SUBSIZE1'] = size[0]
+        hdr['SUBSIZE2'] = size[1]
+        hdr['EXP_TYPE'] = 'MIR_IMAGE'
+        hdr.rename_keyword('NINT','NINTS')
+        hdr.rename_keyword('NFRAME','NFRAMES')
+        hdr.rename_keyword('NGROUP','NGROUPS')
+        pipeline_ready_file = hdr['FILENAME'].replace(".fits","_pipe.fits")
+        output_path = data_dir + pipeline_ready_file
+        write_pipeline_ready_file(hdu_object_list_pre, hdu_object_list, output_path)
+        print(output_path)
 
 def grab_subname(first_pix,size):
-    pixel_info_dict = {
-        'FULL' : [[1, 1], [1032, 1024]],
-        'ILLUM' : [[360, 1], [668, 1024]],
-        'BRIGHTSKY' : [[457, 51], [512, 512]],
-        'SUB256' : [[413, 51], [256, 256]],
-        'SUB128' : [[1, 889], [136, 128]],
-        'SUB64' : [[1, 779], [72, 64]],
-        'SLITLESSPRISM' : [[1, 529], [72, 416]],
-        'MASK1065' : [[1, 19], [288, 224]],
-        'MASK1140' : [[1, 245], [288, 224]],
-        'MASK1550' : [[1, 467], [288, 224]],
-        'MASKLYOT' : [[1, 717], [320, 304]]
-    }
+    pixel_info_dict = subarray_definitions
     sub_info = [first_pix,size]
     subarray_name = list(pixel_info_dict.keys())[list(pixel_info_dict.values()).index(sub_info)]
     return subarray_name
 
+@instrumented('pipeline_ready_file')
 def create_pipeline_ready_file(full_data_path, data_genesis, output_dir):
     ### generate a pipeline ready file
     try:
@@ -164,9 +244,25 @@ def create_pipeline_ready_file(full_data_path, data_genesis, output_dir):
             Generate_OTIS_Pipeline_Ready_File(full_data_path)
         else:
             print('Unexpected data_genesis for this method - OTIS or JPL LVL1 data expected')
-    except OSError:
+    ### only an existing output is skipped - any other OSError (e.g. a full disk) is raised to the caller
+    except FileExistsError:
         print('Pipeline ready fits file has already been generated for this file')
 
+""" Run the Detector1Pipeline on a pipeline ready file with the settings of its data origin, writing the *_ramp.fits and *_rateints.fits (or
+*_rate.fits) files to output_dir. Returns False if the data origin is not supported yet."""
+@instrumented('detector1_pipeline')
+def run_detector1_pipeline(raw_exposure_filepath, data_origin, reference_directory, output_dir):
+    if data_origin == 'jpl8':
+        run_jwst_pipeline_jpl8(raw_exposure_filepath, reference_directory, output_dir)
+    elif data_origin == 'test':
+        generate_corrected_ramp(raw_exposure_filepath, skip_dark = True, output_path = output_dir)
+    # elif data_origin == 'jpl9'
+    # elif data_origin == 'OTIS'
+    # elif data_origin == 'Flight'
+    else:
+        return False
+    return True
+
 """ This function calls the calwebb_detector1 pipeline step  - currently written with JPL data in mind, hence the various options for reference file overrides and skipping pipeline steps.
 Read more here: https://jwst-pipeline.readthedocs.io/en/latest/jwst/pipeline/calwebb_detector1.html
 skip pipeline steps: https://stsci-ins.basecamphq.com/projects/11477312-jwst-pipeline/posts/101399961/comments"""
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 21:12:36 2026
+
+@author: MIRI Pixel DB developers
+
+The methods in this package map MIRI subarrays to the pixel_ids of the pixels table, in closed form. The pixel ids of a subarray were
+originally found by building the whole 1024 x 1290 full frame array with a reference pixel column inserted after every 4th data column
+(see exposuresdb.generate_structured_coordinates and exposuresdb.get_pixel_coordinates_for_subarray), slicing the subarray out of it and
+removing every 5th column of the slice. The same ids are computed here arithmetically - including the behaviour of that slicing for
+subarrays whose first column is not a multiple of 4, where reference pixel ids end up in the data columns - and memoized per subarray,
+so each process computes the ids of a subarray once.
+"""
+from functools import lru_cache
+import numpy as np
+
+""" Dimensions of the pixels table: 1024 rows of data pixels followed by 256 rows holding the reference output pixels, 1032 columns each"""
+numrows = 1280
+numcols = 1032
+num_data_rows = 1024
+
+""" [SUBSTRT1, SUBSTRT2], [SUBSIZE1, SUBSIZE2] of the MIRI subarrays"""
+subarray_definitions = {
+    'FULL' : [[1, 1], [1032, 1024]],
+    'ILLUM' : [[360, 1], [668, 1024]],
+    'BRIGHTSKY' : [[457, 51], [512, 512]],
+    'SUB256' : [[413, 51], [256, 256]],
+    'SUB128' : [[1, 889], [136, 128]],
+    'SUB64' : [[1, 779], [72, 64]],
+    'SLITLESSPRISM' : [[1, 529], [72, 416]],
+    'MASK1065' : [[1, 19], [288, 224]],
+    'MASK1140' : [[1, 245], [288, 224]],
+    'MASK1550' : [[1, 467], [288, 224]],
+    'MASKLYOT' : [[1, 717], [320, 304]]
+}
+
+
+""" Pixel ids at the given (row, column) positions of the full frame array with reference columns (0-based) - column 5k+4 holds the k-th
+    block of 1024 reference output pixel ids, the other columns the data pixels of row row"""
+def get_full_frame_pixel_ids(full_rows, full_cols):
+    full_rows = np.asarray(full_rows, dtype=np.int64)
+    full_cols = np.asarray(full_cols, dtype=np.int64)
+    blocks, offsets = np.divmod(full_cols, 5)
+    data_ids = full_rows * numcols + 4 * blocks + offsets + 1
+    ref_ids = num_data_rows * numcols + blocks * num_data_rows + full_rows + 1
+    return np.where(offsets == 4, ref_ids, data_ids)
+
+
+""" Inverse of get_full_frame_pixel_ids: returns the (row, column) of each pixel id in the full frame array with reference columns"""
+def get_full_frame_positions(pixel_ids):
+    pixel_indexes = np.asarray(pixel_ids, dtype=np.int64) - 1
+    rows, cols = np.divmod(pixel_indexes, numcols)
+    ref_indexes = pixel_indexes - num_data_rows * numcols
+    is_ref = rows >= num_data_rows
+    full_rows = np.where(is_ref, ref_indexes % num_data_rows, rows)
+    full_cols = np.where(is_ref, 5 * (ref_indexes // num_data_rows) + 4, cols + cols // 4)
+    return full_rows, full_cols
+
+
+""" (row, column) of each pixel id in the data array of a subarray whose first pixel has full frame position origin (see get_full_frame_positions) -
+    the origin of an exposure is the minimum full frame row and column of its pixels"""
+def get_subarray_positions(pixel_ids, origin):
+    full_rows, full_cols = get_full_frame_positions(pixel_ids)
+    offsets = full_cols - origin[1]
+    return full_rows - origin[0], offsets - (offsets + 1) // 5
+
+
+""" Data and reference pixel ids of the subarray with first pixel first_pix = (SUBSTRT1, SUBSTRT2) and size = (SUBSIZE1, SUBSIZE2), both flattened
+    in row-major order - the same ids as exposuresdb.get_pixel_coordinates_for_subarray. Memoized per subarray: the returned arrays are read-only."""
+@lru_cache(maxsize=None)
+def get_subarray_pixel_ids(first_pix, size):
+    first_col, first_row = first_pix[0] - 1, first_pix[1] - 1
+    """ the subarray's corners in the full frame array with reference columns (see exposuresdb.ref_mapping), clipped to the array like a slice"""
+    start_col, stop_col = [min(col + col // 4, numcols + numcols // 4) for col in (first_col, first_col + size[0])]
+    full_rows = np.arange(first_row, min(first_row + size[1], num_data_rows))
+    full_cols = np.arange(start_col, max(start_col, stop_col))
+    is_ref_col = (full_cols - start_col) % 5 == 4
+    data_pixel_ids = get_full_frame_pixel_ids(full_rows[:, np.newaxis], full_cols[~is_ref_col]).reshape(-1)
+    reference_pixel_ids = get_full_frame_pixel_ids(full_rows[:, np.newaxis], full_cols[is_ref_col]).reshape(-1)
+    data_pixel_ids.setflags(write=False)
+    reference_pixel_ids.setflags(write=False)
+    return data_pixel_ids, reference_pixel_ids
+
+
+""" Data and reference pixel ids of the subarray described by the SUBSTRT1/2 and SUBSIZE1/2 keywords of a FITS header"""
+def get_pixel_ids_from_header(hdr):
+    return get_subarray_pixel_ids((hdr['SUBSTRT1'], hdr['SUBSTRT2']), (hdr['SUBSIZE1'], hdr['SUBSIZE2']))
+
+
+""" Compute the pixel ids of every named subarray - call before starting worker processes, so the (forked) workers inherit the memoized ids"""
+def preload_subarray_pixel_ids():
+    for first_pix, size in subarray_definitions.values():
+        get_subarray_pixel_ids(tuple(first_pix), tuple(size))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 23:48:09 2026
+
+@author: MIRI Pixel DB developers
+
+The methods in this package overlap the two halves of an ingest: preparing a COPY (reading the FITS slices, transforming them and encoding
+the COPY payload) is CPU work, while the COPY itself mostly waits on postgresql. A PrefetchIterator runs the preparing generator in a
+background thread and hands its items to the thread that owns the connection through a bounded queue, so the next payload is prepared while
+the current one is streamed - the wall clock time of an exposure approaches the larger of the two rather than their sum. The queue bound
+(depth) is the backpressure: at most depth prepared items wait for the COPY, which bounds the extra memory used. NumPy and psycopg2 release
+the GIL in their inner loops and network waits, so the two threads do run concurrently. Usage:
+
+    with PrefetchIterator(prepare_copies(), depth=2) as prepared_copies:
+        for prepared_copy in prepared_copies:
+            ... COPY it ...
+
+Only the consuming thread may use the DB connection - the generator must not.
+"""
+import queue
+import threading
+
+""" Marks the end of the items in the queue of a PrefetchIterator"""
+end_of_items = object()
+
+
+""" Iterate over the items of a generator computed up to depth items ahead, in a background thread. An exception raised by the generator is
+    raised again, with its traceback, by the next() call that would have returned the failing item. Leaving the with block (or calling close)
+    stops the background thread and waits for it, so the generator never outlives the resources it reads from (e.g. an open FITS file).
+    With depth=0 no thread is started and the generator is simply iterated, which is useful to compare against."""
+class PrefetchIterator(object):
+    def __init__(self, generator, depth=2):
+        self.generator = generator
+        self.depth = depth
+        self.finished = False
+        if depth > 0:
+            self.queue = queue.Queue(maxsize=depth)
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(target=self.produce, name='prefetch', daemon=True)
+            self.thread.start()
+
+    """ Background thread: put (item, None) for every item, then (None, exception) if the generator failed, or (None, end_of_items)"""
+    def produce(self):
+        try:
+            for item in self.generator:
+                if not self.put((item, None)):
+                    return
+        except BaseException as error:
+            self.put((None, error))
+            return
+        self.put((None, end_of_items))
+
+    """ Put an entry in the queue, waiting while it is full - returns False without putting it once the iterator is closed"""
+    def put(self, entry):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished:
+            raise StopIteration
+        if self.depth == 0:
+            return next(self.generator)
+        item, error = self.queue.get()
+        if error is end_of_items:
+            self.finished = True
+            raise StopIteration
+        if error is not None:
+            self.finished = True
+            raise error
+        return item
+
+    """ Stop the background thread (the items it had prepared are discarded) and close the generator"""
+    def close(self):
+        self.finished = True
+        if self.depth > 0:
+            self.stopped.set()
+            self.thread.join()
+        self.generator.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 19:05:44 2026
+
+@author: MIRI Pixel DB developers
+
+The methods in this package put a local on-disk cache in front of the read API in miridb (get_pixel_history and get_exposure_cube).
+Results are stored as .npz files, keyed by the query parameters plus the ids of the exposures and corrected exposures the result was read
+from - an exposure that is deleted and ingested again gets new ids, so its old cache entries can never be returned. An ingest commits its rows
+chunk by chunk under ids that do not change when it completes, so a result that depends on an exposure whose ingest has not completed (see
+get_unfinished_ingest_ids) is returned without being cached. Entries whose exposures no longer exist are pruned, and the cache is kept under
+max_bytes by evicting the least recently used entries (a hit refreshes the modification time of its file). Usage:
+
+    history = cached_pixel_history(engine, rows_cols=[(779, 2)])
+    cube = cached_exposure_cube(engine, exposure_name, 'corrected_ramp')
+"""
+import os
+import json
+import hashlib
+import numpy as np
+from sqlalchemy import text
+from miridb import get_pixel_history, get_exposure_cube
+from exposuresdb import table_exists, get_unfinished_ingests
+
+""" Where cache entries are written unless a cache_dir is given, and the size bound of the cache"""
+default_cache_dir = os.environ.get('MIRI_PIXEL_DB_CACHE', os.path.join(os.path.expanduser('~'), '.miri_pixel_db_cache'))
+default_max_bytes = 10 * 2**30
+
+
+""" Name of the cache entry of a query - a hash of the database, the query and its parameters, and the exposure/corrected exposure ids it depends on"""
+def cache_key(engine, query_name, parameters, dependencies):
+    key = json.dumps([repr(engine.url), query_name, parameters, dependencies], sort_keys=True, default=repr)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+""" Read a cache entry as a dictionary of arrays, or return None if it is not cached. A hit marks the entry as most recently used."""
+def read_cache_entry(cache_dir, key):
+    entry_path = os.path.join(cache_dir, key + '.npz')
+    try:
+        with np.load(entry_path, allow_pickle=False) as entry:
+            result = {name: entry[name] for name in entry.files}
+    except (OSError, ValueError):
+        return None
+    os.utime(entry_path)
+    return result
+
+
+""" Write a cache entry (a dictionary of arrays) and the json file recording its dependencies, then evict entries until the cache fits max_bytes.
+    Files are written under a temporary name and renamed, so concurrent readers never see a partial entry."""
+def write_cache_entry(cache_dir, key, result, dependencies, max_bytes):
+    os.makedirs(cache_dir, exist_ok=True)
+    entry_path = os.path.join(cache_dir, key + '.npz')
+    with open(entry_path + '.tmp', 'wb') as entry_file:
+        np.savez(entry_file, **result)
+    with open(os.path.join(cache_dir, key + '.json.tmp'), 'w') as dependencies_file:
+        json.dump(dependencies, dependencies_file)
+    os.replace(os.path.join(cache_dir, key + '.json.tmp'), os.path.join(cache_dir, key + '.json'))
+    os.replace(entry_path + '.tmp', entry_path)
+    evict_cache_entries(cache_dir, max_bytes)
+
+
+""" Remove a cache entry and its dependencies file"""
+def remove_cache_entry(cache_dir, key):
+    for suffix in ['.npz', '.json']:
+        try:
+            os.remove(os.path.join(cache_dir, key + suffix))
+        except FileNotFoundError:
+            pass
+
+
+""" Evict least recently used entries until the .npz files of the cache add up to at most max_bytes"""
+def evict_cache_entries(cache_dir, max_bytes):
+    entries = []
+    for file_name in os.listdir(cache_dir):
+        if file_name.endswith('.npz'):
+            stat = os.stat(os.path.join(cache_dir, file_name))
+            entries.append((stat.st_mtime, stat.st_size, file_name[:-len('.npz')]))
+    total_bytes = sum(size for mtime, size, key in entries)
+    for mtime, size, key in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        remove_cache_entry(cache_dir, key)
+        total_bytes -= size
+
+
+""" Remove the entries of this database that depend on an exposure or corrected exposure that is no longer in it (deleted, or deleted and
+    ingested again under new ids). Returns the number of entries removed."""
+def prune_cache(engine, cache_dir=None):
+    cache_dir = cache_dir or default_cache_dir
+    if not os.path.isdir(cache_dir):
+        return 0
+    with engine.connect() as con:
+        exp_ids = set(row[0] for row in con.execute('SELECT exp_id FROM exposures'))
+        corrected_exp_ids = set(row[0] for row in con.execute('SELECT corrected_exp_id FROM correctedexposures'))
+    removed = 0
+    for file_name in os.listdir(cache_dir):
+        if not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(cache_dir, file_name)) as dependencies_file:
+                dependencies = json.load(dependencies_file)
+        except (OSError, ValueError):
+            continue
+        if dependencies['database'] != repr(engine.url):
+            continue
+        if not exp_ids.issuperset(dependencies['exp_ids']) or not corrected_exp_ids.issuperset(dependencies['corrected_exp_ids']):
+            remove_cache_entry(cache_dir, file_name[:-len('.json')])
+            removed += 1
+    return removed
+
+
+""" Delete every entry of the cache"""
+def clear_cache(cache_dir=None):
+    cache_dir = cache_dir or default_cache_dir
+    if os.path.isdir(cache_dir):
+        for file_name in os.listdir(cache_dir):
+            if file_name.endswith(('.npz', '.json', '.tmp')):
+                os.remove(os.path.join(cache_dir, file_name))
+
+
+""" The exposure and corrected exposure ids whose ingest has not completed, read from the ingeststate table (see exposuresdb.ingest_state_columns)
+    through the SQLAlchemy connection con - queries of these exposures can return the rows of the chunks committed so far. Both sets are empty
+    if the DB has no ingeststate table. A staged corrected ingest has no corrected_exp_id until its rows are merged in one transaction."""
+def get_unfinished_ingest_ids(con):
+    unfinished_ids = {'exp_ids': set(), 'corrected_exp_ids': set()}
+    if table_exists('ingeststate', con.connection):
+        for ingest_state in get_unfinished_ingests(con.connection):
+            if ingest_state['kind'] == 'raw':
+                unfinished_ids['exp_ids'].add(ingest_state['exp_id'])
+            elif ingest_state['corrected_exp_id'] is not None:
+                unfinished_ids['corrected_exp_ids'].add(ingest_state['corrected_exp_id'])
+    return unfinished_ids
+
+
+""" Return the cached result of a query, or run it (query_function()) and cache its result. dependencies are the exposure and corrected exposure
+    ids the result is read from - on a miss, entries depending on exposures that no longer exist are pruned before the new entry is written.
+    unfinished_ids are the ids whose ingest has not completed (see get_unfinished_ingest_ids): a query depending on one of them is run, but
+    neither read from nor written to the cache."""
+def cached_query(engine, query_name, parameters, dependencies, query_function, cache_dir, max_bytes, unfinished_ids=None):
+    if unfinished_ids and (unfinished_ids['exp_ids'].intersection(dependencies['exp_ids']) or
+                           unfinished_ids['corrected_exp_ids'].intersection(dependencies['corrected_exp_ids'])):
+        return query_function()
+    cache_dir = cache_dir or default_cache_dir
+    dependencies = dict(dependencies, database=repr(engine.url))
+    key = cache_key(engine, query_name, parameters, dependencies)
+    result = read_cache_entry(cache_dir, key)
+    if result is None:
+        result = query_function()
+        prune_cache(engine, cache_dir)
+        write_cache_entry(cache_dir, key, result, dependencies, max_bytes if max_bytes is not None else default_max_bytes)
+    return result
+
+
+""" get_pixel_history through the cache. The result depends on every exposure and corrected exposure in the DB, so ingesting or deleting any of
+    them makes the next call a miss - and nothing is cached while any of them is being ingested."""
+def cached_pixel_history(engine, pixel_ids=None, rows_cols=None, cache_dir=None, max_bytes=None):
+    with engine.connect() as con:
+        unfinished_ids = get_unfinished_ingest_ids(con)
+        dependencies = {'exp_ids': [row[0] for row in con.execute('SELECT exp_id FROM exposures ORDER BY exp_id')],
+                        'corrected_exp_ids': [row[0] for row in con.execute('SELECT corrected_exp_id FROM correctedexposures ORDER BY corrected_exp_id')]}
+    parameters = {'pixel_ids': None if pixel_ids is None else [int(pixel_id) for pixel_id in pixel_ids],
+                  'rows_cols': None if rows_cols is None else np.asarray(rows_cols, dtype=int).reshape(-1, 2).tolist()}
+    return cached_query(engine, 'pixel_history', parameters, dependencies,
+                        lambda: get_pixel_history(engine, pixel_ids=pixel_ids, rows_cols=rows_cols), cache_dir, max_bytes, unfinished_ids)
+
+
+""" get_exposure_cube through the cache. The result depends on the exposure and its corrected exposures, so re-ingesting the exposure or adding
+    a corrected exposure makes the next call a miss. Nothing is cached while the exposure or one of its corrected exposures is being ingested."""
+def cached_exposure_cube(engine, exposure_name, column='ramp', corrected_exposure_name=None, rows=slice(None), cols=slice(None), integrations=slice(None),
+                         cache_dir=None, max_bytes=None):
+    with engine.connect() as con:
+        unfinished_ids = get_unfinished_ingest_ids(con)
+        exposure_ids = con.execute(text("""SELECT e.exp_id, array_remove(array_agg(c.corrected_exp_id ORDER BY c.corrected_exp_id), NULL) FROM exposures e
+                                           LEFT JOIN correctedexposures c ON c.exp_id = e.exp_id WHERE e.exp = :exp GROUP BY e.exp_id"""), exp=exposure_name).fetchone()
+    if exposure_ids is None:
+        raise ValueError('%s is not in the DB' % exposure_name)
+    dependencies = {'exp_ids': [exposure_ids[0]], 'corrected_exp_ids': exposure_ids[1]}
+    parameters = {'exposure_name': exposure_name, 'column': column, 'corrected_exposure_name': corrected_exposure_name,
+                  'slices': [(index_slice.start, index_slice.stop, index_slice.step) for index_slice in [rows, cols, integrations]]}
+    query_function = lambda: {'cube': get_exposure_cube(engine, exposure_name, column, corrected_exposure_name, rows, cols, integrations)}
+    return cached_query(engine, 'exposure_cube', parameters, dependencies, query_function, cache_dir, max_bytes, unfinished_ids)['cube']
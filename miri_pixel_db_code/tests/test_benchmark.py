@@ -0,0 +1,50 @@
+'''
+Unit tests for the synthetic exposures and report comparison of benchmark.py - the synthetic LVL1 file must become a pipeline ready file of the
+requested subarray, and the synthetic corrected files must have the layout add_corrected_exposure_to_db reads. No DB is needed.
+'''
+import os
+import sys
+sys.path.append("..")
+import numpy as np
+import pytest
+from astropy.io import fits
+''' benchmark.py imports pipefits, which imports the JWST calibration pipeline '''
+pytest.importorskip('jwst')
+from pixelmap import subarray_definitions
+from pipefits import create_pipeline_ready_file
+from benchmark import generate_lvl1_exposure, generate_corrected_exposure, synthetic_ramps, compare_benchmarks
+
+@pytest.mark.parametrize('subarray, nints', [('SUB256', 2), ('SUB64', 1)])
+def test_synthetic_exposure(tmp_path, subarray, nints):
+    ngroups = 3
+    (substrt1, substrt2), (subsize1, subsize2) = subarray_definitions[subarray]
+    lvl1_path = generate_lvl1_exposure(str(tmp_path), subarray, nints, ngroups)
+    with fits.open(lvl1_path) as lvl1_hdu:
+        assert lvl1_hdu[0].data.shape == (nints * ngroups, subsize2 * 5 // 4, subsize1)
+        expected_frames = synthetic_ramps(0, nints - 1, ngroups, subsize2 * 5 // 4, subsize1).clip(0, 65535).astype(np.uint16)
+        assert np.array_equal(lvl1_hdu[0].data[-ngroups:], expected_frames)
+    create_pipeline_ready_file(lvl1_path, 'JPL', str(tmp_path) + '/')
+    pipeline_ready_file = lvl1_path.replace('.fits', '_pipe.fits')
+    with fits.open(pipeline_ready_file) as pipe_hdu:
+        hdr = pipe_hdu[0].header
+        assert [[hdr['SUBSTRT1'], hdr['SUBSTRT2']], [hdr['SUBSIZE1'], hdr['SUBSIZE2']]] == subarray_definitions[subarray]
+    corrected_ramp_file = generate_corrected_exposure(pipeline_ready_file)
+    slope_file = corrected_ramp_file.replace('_ramp.fits', '_rateints.fits' if nints > 1 else '_rate.fits')
+    with fits.open(corrected_ramp_file) as corrected_ramp_hdu, fits.open(slope_file) as slope_hdu:
+        assert corrected_ramp_hdu[0].header['FILENAME'] == os.path.basename(corrected_ramp_file)
+        assert [hdu.name for hdu in corrected_ramp_hdu] == ['PRIMARY', 'SCI', 'PIXELDQ', 'GROUPDQ', 'ERR']
+        assert corrected_ramp_hdu['SCI'].data.shape == corrected_ramp_hdu['GROUPDQ'].data.shape == (nints, ngroups, subsize2, subsize1)
+        assert corrected_ramp_hdu['GROUPDQ'].data.dtype == np.uint8 and corrected_ramp_hdu['GROUPDQ'].data.any()
+        assert np.all(corrected_ramp_hdu['SCI'].data[:, 0] == 0)
+        assert slope_hdu['SCI'].data.shape == ((nints, subsize2, subsize1) if nints > 1 else (subsize2, subsize1))
+
+def test_compare_benchmarks():
+    def report(raw_seconds, pipefits_seconds, ramps_bytes):
+        return {'cases': [{'exposure': 'BENCH_SUB64_2x5_pipe.fits', 'table_bytes': {'ramps': ramps_bytes},
+                           'stages': {'raw_ingest': {'seconds': raw_seconds, 'cpu_seconds': 1.0, 'peak_rss_mb': 100.0},
+                                      'pipefits': {'seconds': pipefits_seconds, 'cpu_seconds': 0.01, 'peak_rss_mb': 100.0}}}]}
+    comparisons = compare_benchmarks(report(10.0, 0.01, 1000), report(12.0, 0.02, 1000))
+    regressions = [(comparison['stage'], comparison['metric']) for comparison in comparisons if comparison['regression']]
+    ''' the pipefits timing doubled, but is too short to be compared '''
+    assert regressions == [('raw_ingest', 'seconds')]
+    assert len(comparisons) == 7
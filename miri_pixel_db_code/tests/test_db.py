@@ -22,12 +22,17 @@ The exposure chosen for testing is a SUB64 JPL8 exposure. The SUB64 exposure is
 We call the miridb_script.py file to add this exposure to the DB.
 
 '''
-from sqlalchemy import Table
+from sqlalchemy import Table, create_engine, text
 import sys
 sys.path.append("..")
-from miridb import init_db, load_engine
+from miridb import init_db, load_engine, load_miri_tables, delete_exposure
+import exposuresdb
+from exposuresdb import add_raw_exposure_to_db, add_corrected_exposure_to_db, get_ingest_state, clean_up_unfinished_ingests
 import time
 import glob, os
+import numpy as np
+import shutil
+import pytest
 from subprocess import call
 
 def test_db_unit():
@@ -122,3 +127,426 @@ def test_db_unit():
     generated_files = glob.glob(test_folder + '*_pipe*.fits')
     assert len(generated_files) == 0
     print('Finished Test')
+
+
+''' The tests below check the ingest checkpoints (see exposuresdb.ingest_state_columns): an ingest interrupted after some chunks is resumed after
+its last committed chunk and ends with exactly the rows of an uninterrupted ingest, while an ingest that cannot be resumed (other chunk_rows or
+copy_format) is cleaned up and started over. The exposure is ingested in-process, from a pipeline ready file and synthetic corrected files
+(see benchmark.generate_corrected_exposure) written to a temporary directory, and the ingest is interrupted by failing its Nth COPY. '''
+
+class InterruptedIngest(Exception):
+    pass
+
+def load_ingest_db(tmp_path):
+    ''' pipefits (through miridb_script and benchmark) imports the JWST calibration pipeline '''
+    pytest.importorskip('jwst')
+    from exposuresdb import insert_pixel_detector_info
+    from miridb_script import load_ingest_tables
+    from pipefits import create_pipeline_ready_file
+    from benchmark import generate_corrected_exposure
+    connection_string = 'postgresql+psycopg2://postgres@localhost/miri_pixel_db'
+    engine = load_engine(connection_string)
+    session, base, connection, cursor = init_db(engine)
+    load_miri_tables(base)
+    if engine.execute('SELECT count(*) FROM detectors').scalar() == 0:
+        insert_pixel_detector_info(connection)
+    tables = dict(zip(['exposures', 'ramps', 'groups', 'correctedexposures', 'correctedramps'], load_ingest_tables(engine, base)))
+    lvl1_path = str(tmp_path / 'MIRI_5582_89_S_20180308-010230_SCE1.fits')
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exposures', os.path.basename(lvl1_path)), lvl1_path)
+    create_pipeline_ready_file(lvl1_path, 'JPL', str(tmp_path) + '/')
+    pipeline_ready_file = lvl1_path.replace('.fits', '_pipe.fits')
+    corrected_ramp_file = generate_corrected_exposure(pipeline_ready_file)
+    return engine, session, connection, tables, pipeline_ready_file, corrected_ramp_file
+
+''' Run an ingest, failing its COPYs after the first fail_after ones (None: not interrupted). Returns the number of COPYs run '''
+def run_ingest(monkeypatch, ingest, fail_after=None, **ingest_options):
+    execute_copy = exposuresdb.execute_copy
+    copies = []
+    def interrupted_copy(*args, **kwargs):
+        if fail_after is not None and len(copies) >= fail_after:
+            raise InterruptedIngest()
+        copies.append(True)
+        return execute_copy(*args, **kwargs)
+    with monkeypatch.context() as patch:
+        patch.setattr(exposuresdb, 'execute_copy', interrupted_copy)
+        if fail_after is None:
+            ingest(**ingest_options)
+        else:
+            with pytest.raises(InterruptedIngest):
+                ingest(**ingest_options)
+    return len(copies)
+
+''' Fingerprint (md5 and count) of the rows of an exposure and its corrected exposure - ids are taken relative to the first id of their block, so
+an exposure ingested twice has the same fingerprint '''
+def exposure_fingerprint(engine, exp):
+    queries = {'ramps': """SELECT md5(string_agg(row(r.pixel_id, r.intnumber, r.ramp, r.ramp_id - f.first_id)::text, '|' ORDER BY r.ramp_id)), count(*)
+                           FROM ramps r JOIN exposures e USING (exp_id),
+                           (SELECT min(ramp_id) first_id FROM ramps JOIN exposures USING (exp_id) WHERE exp = %(exp)s) f
+                           WHERE e.exp = %(exp)s""",
+               'groups': """SELECT md5(string_agg(row(g.ramp_id - f.first_ramp_id, g.group_number, g.raw_value, g.group_id - f.first_id)::text, '|' ORDER BY g.group_id)), count(*)
+                            FROM groups g JOIN ramps r USING (ramp_id) JOIN exposures e USING (exp_id),
+                            (SELECT min(group_id) first_id, min(r.ramp_id) first_ramp_id FROM groups JOIN ramps r USING (ramp_id) JOIN exposures USING (exp_id) WHERE exp = %(exp)s) f
+                            WHERE e.exp = %(exp)s""",
+               'correctedramps': """SELECT md5(string_agg(row(r.pixel_id, r.intnumber, c.slope_value, c.corrected_ramp, c.dq_ramp, c.err_ramp, c.corr_ramp_id - f.first_id)::text, '|' ORDER BY c.corr_ramp_id)), count(*)
+                                    FROM correctedramps c JOIN ramps r USING (ramp_id) JOIN exposures e USING (exp_id),
+                                    (SELECT min(corr_ramp_id) first_id FROM correctedramps JOIN ramps USING (ramp_id) JOIN exposures USING (exp_id) WHERE exp = %(exp)s) f
+                                    WHERE e.exp = %(exp)s""",
+               'correctedgroups': """SELECT md5(string_agg(row(g.group_number, c.corrected_value, c.dq_value, c.error_value, c.corr_group_id - f.first_id)::text, '|' ORDER BY c.corr_group_id)), count(*)
+                                     FROM correctedgroups c JOIN groups g USING (group_id) JOIN ramps r USING (ramp_id) JOIN exposures e USING (exp_id),
+                                     (SELECT min(corr_group_id) first_id FROM correctedgroups JOIN groups USING (group_id) JOIN ramps USING (ramp_id) JOIN exposures USING (exp_id) WHERE exp = %(exp)s) f
+                                     WHERE e.exp = %(exp)s"""}
+    return {table_name: tuple(engine.execute(query, exp=exp).fetchone()) for table_name, query in queries.items()}
+
+def test_resume_interrupted_ingest(tmp_path, monkeypatch):
+    engine, session, connection, tables, pipeline_ready_file, corrected_ramp_file = load_ingest_db(tmp_path)
+    test_exp = os.path.basename(pipeline_ready_file)
+    corrected_exp = os.path.basename(corrected_ramp_file)
+    raw_ingest = lambda **options: add_raw_exposure_to_db(pipeline_ready_file, 'JPL', None, None, session, connection, tables['exposures'], tables['ramps'], **options)
+    corrected_ingest = lambda **options: add_corrected_exposure_to_db(corrected_ramp_file, session, connection, tables['exposures'], tables['groups'], tables['ramps'],
+                                                                      tables['correctedexposures'], tables['correctedramps'], **options)
+    assert engine.execute('SELECT count(*) FROM exposures WHERE exp = %s', test_exp).scalar() == 0
+    try:
+        ''' the rows of an uninterrupted ingest - 16 detector rows per chunk, so the 5 integrations of the SUB64 exposure are 20 chunks of 1152 ramps '''
+        run_ingest(monkeypatch, raw_ingest, chunk_rows=16)
+        run_ingest(monkeypatch, corrected_ingest, chunk_rows=16)
+        expected_fingerprint = exposure_fingerprint(engine, test_exp)
+        assert [expected_fingerprint[table_name][1] for table_name in ['ramps', 'groups', 'correctedramps', 'correctedgroups']] == [23040, 1152000, 23040, 1152000]
+        delete_exposure(engine, test_exp)
+
+        ''' the raw ingest fails in its 3rd chunk, after the chunk's ramps COPY: only the 2 committed chunks are in the DB '''
+        run_ingest(monkeypatch, raw_ingest, fail_after=5, chunk_rows=16)
+        ingest_state = get_ingest_state(test_exp, connection)
+        assert ingest_state['stage'] == 'loading' and ingest_state['chunks_done'] == 2 and ingest_state['num_chunks'] == 20
+        assert engine.execute('SELECT count(*) FROM ramps WHERE exp_id = %s', ingest_state['exp_id']).scalar() == 2 * 1152
+        ''' resuming writes the remaining chunks, and is interrupted again '''
+        run_ingest(monkeypatch, raw_ingest, fail_after=10, chunk_rows=16)
+        assert get_ingest_state(test_exp, connection)['chunks_done'] == 7
+        run_ingest(monkeypatch, raw_ingest, chunk_rows=16)
+        assert get_ingest_state(test_exp, connection)['stage'] == 'complete'
+        assert get_ingest_state(test_exp, connection)['exp_id'] == ingest_state['exp_id']
+        ''' the corrected ingest is interrupted and resumed the same way '''
+        run_ingest(monkeypatch, corrected_ingest, fail_after=7, chunk_rows=16)
+        corrected_ingest_state = get_ingest_state(corrected_exp, connection)
+        assert corrected_ingest_state['stage'] == 'loading' and corrected_ingest_state['chunks_done'] == 3
+        run_ingest(monkeypatch, corrected_ingest, chunk_rows=16)
+        assert get_ingest_state(corrected_exp, connection)['stage'] == 'complete'
+        assert exposure_fingerprint(engine, test_exp) == expected_fingerprint
+        ''' ingesting a complete exposure again writes nothing '''
+        assert run_ingest(monkeypatch, raw_ingest, chunk_rows=16) == 0 and run_ingest(monkeypatch, corrected_ingest, chunk_rows=16) == 0
+        assert exposure_fingerprint(engine, test_exp) == expected_fingerprint
+    finally:
+        delete_exposure(engine, test_exp)
+        connection.close()
+
+def test_restart_mismatched_ingest(tmp_path, monkeypatch):
+    engine, session, connection, tables, pipeline_ready_file, corrected_ramp_file = load_ingest_db(tmp_path)
+    test_exp = os.path.basename(pipeline_ready_file)
+    raw_ingest = lambda **options: add_raw_exposure_to_db(pipeline_ready_file, 'JPL', None, None, session, connection, tables['exposures'], tables['ramps'], **options)
+    exposure_count = lambda: engine.execute('SELECT count(*) FROM exposures WHERE exp = %s', test_exp).scalar()
+    try:
+        ''' an ingest interrupted with chunk_rows=16 cannot be resumed with chunk_rows=8: it is cleaned up and started over under new ids '''
+        run_ingest(monkeypatch, raw_ingest, fail_after=3, chunk_rows=16)
+        first_exp_id = get_ingest_state(test_exp, connection)['exp_id']
+        run_ingest(monkeypatch, raw_ingest, fail_after=6, chunk_rows=8)
+        ingest_state = get_ingest_state(test_exp, connection)
+        assert ingest_state['exp_id'] != first_exp_id and ingest_state['chunk_rows'] == 8 and ingest_state['chunks_done'] == 3
+        assert exposure_count() == 1
+        assert engine.execute('SELECT count(*) FROM ramps WHERE exp_id = %s', first_exp_id).scalar() == 0
+        assert engine.execute('SELECT count(*) FROM ramps WHERE exp_id = %s', ingest_state['exp_id']).scalar() == 3 * 8 * 72
+        ''' nor can it be resumed with another copy_format '''
+        run_ingest(monkeypatch, raw_ingest, chunk_rows=8, copy_format='text')
+        text_ingest_state = get_ingest_state(test_exp, connection)
+        assert text_ingest_state['exp_id'] != ingest_state['exp_id'] and text_ingest_state['copy_format'] == 'text' and text_ingest_state['stage'] == 'complete'
+        assert exposure_count() == 1
+        assert engine.execute('SELECT count(*) FROM ramps WHERE exp_id = %s', text_ingest_state['exp_id']).scalar() == 23040
+        assert engine.execute('SELECT count(*) FROM groups JOIN ramps USING (ramp_id) WHERE exp_id = %s', text_ingest_state['exp_id']).scalar() == 1152000
+        ''' an unfinished ingest of a file that will not be ingested again is removed by clean_up_unfinished_ingests '''
+        delete_exposure(engine, test_exp)
+        run_ingest(monkeypatch, raw_ingest, fail_after=3, chunk_rows=16)
+        assert clean_up_unfinished_ingests(connection) == [test_exp]
+        assert exposure_count() == 0 and get_ingest_state(test_exp, connection) is None
+    finally:
+        delete_exposure(engine, test_exp)
+        connection.close()
+
+
+''' The tests below compare the schema modes of load_miri_tables, and the query functions, on a small synthetic exposure (2 integrations of 4
+groups of a SUB64 subarray, see benchmark.generate_lvl1_exposure) ingested into scratch DBs. Each scratch DB is created empty for its test, with
+the tables and detector/pixel rows of benchmark.prepare_benchmark_db, and dropped after it. '''
+
+server_connection_string = 'postgresql+psycopg2://postgres@localhost/'
+
+class ScratchDB(object):
+    def __init__(self, connection_string, schema_options):
+        from benchmark import prepare_benchmark_db, connect_stage
+        prepare_benchmark_db(connection_string, schema_options).dispose()
+        self.engine, self.session, self.connection, ingest_tables = connect_stage(connection_string, schema_options)
+        self.tables = dict(zip(['exposures', 'ramps', 'groups', 'correctedexposures', 'correctedramps'], ingest_tables))
+
+    def ingest(self, pipeline_ready_file, corrected_ramp_file, staging=False, **ingest_options):
+        tables = self.tables
+        add_raw_exposure_to_db(pipeline_ready_file, 'JPL', None, None, self.session, self.connection, tables['exposures'], tables['ramps'], **ingest_options)
+        add_corrected_exposure_to_db(corrected_ramp_file, self.session, self.connection, tables['exposures'], tables['groups'], tables['ramps'],
+                                     tables['correctedexposures'], tables['correctedramps'], staging=staging, **ingest_options)
+        ''' the ingest only reads through the session - end its transaction, whose locks would block the partition DDL of delete_exposure '''
+        self.session.commit()
+
+    def rows(self, query, **parameters):
+        return self.engine.execute(text(query), **parameters).fetchall()
+
+    def close(self):
+        self.session.close()
+        self.connection.close()
+        self.engine.dispose()
+
+''' scratch_db(db_name, **schema_options) creates the scratch DB db_name and returns its ScratchDB '''
+@pytest.fixture
+def scratch_db():
+    pytest.importorskip('jwst')
+    admin_engine = create_engine(server_connection_string + 'postgres', isolation_level='AUTOCOMMIT')
+    scratch_dbs = {}
+    def create_scratch_db(db_name, **schema_options):
+        admin_engine.execute('DROP DATABASE IF EXISTS %s' % db_name)
+        admin_engine.execute('CREATE DATABASE %s' % db_name)
+        scratch_dbs[db_name] = ScratchDB(server_connection_string + db_name, schema_options)
+        return scratch_dbs[db_name]
+    yield create_scratch_db
+    for db_name, db in scratch_dbs.items():
+        db.close()
+        admin_engine.execute('DROP DATABASE IF EXISTS %s' % db_name)
+    admin_engine.dispose()
+
+''' Write the synthetic test exposure to tmp_path: its pipeline ready file, and the synthetic corrected files of benchmark.generate_corrected_exposure.
+substrt1 moves the subarray to another first column. Returns the paths of the pipeline ready file and of the *_ramp.fits file '''
+def write_test_exposure(tmp_path, nints=2, ngroups=4, substrt1=None):
+    from astropy.io import fits
+    from pipefits import create_pipeline_ready_file
+    from benchmark import generate_lvl1_exposure, generate_corrected_exposure
+    lvl1_path = generate_lvl1_exposure(str(tmp_path), 'SUB64', nints, ngroups)
+    create_pipeline_ready_file(lvl1_path, 'JPL', str(tmp_path) + '/')
+    pipeline_ready_file = lvl1_path.replace('.fits', '_pipe.fits')
+    if substrt1 is not None:
+        fits.setval(pipeline_ready_file, 'SUBSTRT1', value=substrt1)
+    return pipeline_ready_file, generate_corrected_exposure(pipeline_ready_file)
+
+def test_compact_groups_views(tmp_path, scratch_db):
+    pipeline_ready_file, corrected_ramp_file = write_test_exposure(tmp_path)
+    table_db, compact_db = scratch_db('miri_pixel_db_test_tables'), scratch_db('miri_pixel_db_test_compact', compact_groups=True)
+    for db in [table_db, compact_db]:
+        db.ingest(pipeline_ready_file, corrected_ramp_file)
+    assert [db.rows("SELECT relkind FROM pg_class WHERE relname = 'groups'")[0][0] for db in [table_db, compact_db]] == ['r', 'v']
+    ''' the group ids of the views are derived from the ramp ids, so the groups are compared by ramp and group number - the ramps of both DBs have
+    the same ids, and the views return the same values as the tables '''
+    flag_columns = ''.join(', %s' % dq_name for dq_name in exposuresdb.dq_val_ref.values())
+    queries = ['SELECT ramp_id, pixel_id, intnumber, ramp FROM ramps ORDER BY ramp_id',
+               'SELECT ramp_id, group_number, raw_value FROM groups ORDER BY ramp_id, group_number',
+               'SELECT corr_ramp_id, group_number, corrected_value, dq_value, error_value%s FROM correctedgroups ORDER BY corr_ramp_id, group_number' % flag_columns]
+    for query in queries:
+        table_rows = table_db.rows(query)
+        assert len(table_rows) in (2 * 64 * 72, 2 * 64 * 72 * 4) and compact_db.rows(query) == table_rows
+    ''' correctedgroups.group_id still joins groups.group_id in the views '''
+    join_query = """SELECT c.corr_ramp_id, c.group_number, g.ramp_id, g.group_number FROM correctedgroups c JOIN groups g USING (group_id)
+                    ORDER BY c.corr_ramp_id, c.group_number"""
+    assert compact_db.rows(join_query) == table_db.rows(join_query)
+
+def test_delete_partitioned_exposure(tmp_path, scratch_db):
+    db = scratch_db('miri_pixel_db_test_partitions', partition_by_exposure=True)
+    exposure_files = [write_test_exposure(tmp_path, nints=nints) for nints in [2, 1]]
+    for pipeline_ready_file, corrected_ramp_file in exposure_files:
+        db.ingest(pipeline_ready_file, corrected_ramp_file)
+    ''' each exposure's rows are in its own partitions '''
+    def exposure_ids(pipeline_ready_file):
+        return db.rows("""SELECT e.exp_id, c.corrected_exp_id FROM exposures e JOIN correctedexposures c USING (exp_id) WHERE e.exp = :exp""",
+                       exp=os.path.basename(pipeline_ready_file))[0]
+    def partitions(exp_id, corrected_exp_id):
+        partition_names = [exposuresdb.exposure_partitions[table_name] % exp_id for table_name in ['ramps', 'groups']]
+        partition_names += [exposuresdb.exposure_partitions[table_name] % corrected_exp_id for table_name in ['correctedramps', 'correctedgroups']]
+        return [row[0] for row in db.rows("SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhrelid::regclass::text IN :names ORDER BY 1",
+                                          names=tuple(partition_names))]
+    def exposure_row_counts(exp_id, corrected_exp_id):
+        return [db.rows(query, exp_id=exp_id, corrected_exp_id=corrected_exp_id)[0][0] for query in
+                ['SELECT count(*) FROM ramps WHERE exp_id = :exp_id', 'SELECT count(*) FROM groups JOIN ramps USING (ramp_id) WHERE exp_id = :exp_id',
+                 'SELECT count(*) FROM correctedramps WHERE corrected_exp_id = :corrected_exp_id',
+                 'SELECT count(*) FROM pixelstats WHERE corrected_exp_id = :corrected_exp_id',
+                 'SELECT count(*) FROM ingeststate WHERE exp_id = :exp_id']]
+    deleted_ids, kept_ids = [exposure_ids(pipeline_ready_file) for pipeline_ready_file, corrected_ramp_file in exposure_files]
+    assert len(partitions(*deleted_ids)) == 4 and len(partitions(*kept_ids)) == 4
+    assert exposure_row_counts(*deleted_ids) == [2 * 64 * 72, 2 * 64 * 72 * 4, 2 * 64 * 72, 64 * 72, 2]
+    kept_row_counts = exposure_row_counts(*kept_ids)
+    assert kept_row_counts == [64 * 72, 64 * 72 * 4, 64 * 72, 64 * 72, 2]
+    ''' deleting the first exposure drops its partitions, and its pixelstats and ingeststate rows cascade - the other exposure is untouched '''
+    delete_exposure(db.engine, os.path.basename(exposure_files[0][0]))
+    assert partitions(*deleted_ids) == [] and exposure_row_counts(*deleted_ids) == [0, 0, 0, 0, 0]
+    assert db.rows('SELECT count(*) FROM correctedexposures WHERE corrected_exp_id = :corrected_exp_id', corrected_exp_id=deleted_ids[1])[0][0] == 0
+    assert len(partitions(*kept_ids)) == 4 and exposure_row_counts(*kept_ids) == kept_row_counts
+
+def test_bulk_load_session(tmp_path, scratch_db):
+    from bulkload import bulk_load_tables, begin_bulk_load, end_bulk_load
+    pipeline_ready_file, corrected_ramp_file = write_test_exposure(tmp_path)
+    db = scratch_db('miri_pixel_db_test_bulk_load')
+    def schema_objects():
+        indexes = db.rows("SELECT tablename, indexname, indexdef FROM pg_indexes WHERE tablename IN :tables", tables=tuple(bulk_load_tables))
+        constraints = db.rows("""SELECT c.relname, k.conname, pg_get_constraintdef(k.oid), k.convalidated FROM pg_constraint k JOIN pg_class c ON c.oid = k.conrelid
+                                 WHERE c.relname IN :tables""", tables=tuple(bulk_load_tables))
+        return set(map(tuple, indexes)) | set(map(tuple, constraints))
+    saved_objects = schema_objects()
+    ''' the session drops the indexes and constraints it saved in bulkloadddl, and the ingest runs without them '''
+    saved_ddl = begin_bulk_load(db.engine)
+    assert len(saved_ddl) > 0 and len(db.rows('SELECT * FROM bulkloadddl')) == len(saved_ddl)
+    object_names = lambda: {row[1] for row in schema_objects()}
+    assert object_names().isdisjoint(object_name for table_name, object_name, object_type, definition in saved_ddl)
+    db.ingest(pipeline_ready_file, corrected_ramp_file)
+    ''' a group whose ramp does not exist violates the groups foreign key - it is reported, and kept in bulkloadddl for a retry '''
+    db.engine.execute('INSERT INTO groups (group_id, ramp_id, group_number, raw_value) VALUES (1000000000, 999999999, 1, 0)')
+    groups_foreign_key = [(table_name, object_name) for table_name, object_name, object_type, definition in saved_ddl
+                          if object_type == 'foreign key' and 'REFERENCES ramps' in definition and table_name == 'groups']
+    failures = end_bulk_load(db.engine)
+    assert [(failure['table'], failure['object'], failure['type']) for failure in failures] == [groups_foreign_key[0] + ('foreign key',)]
+    assert 'violates foreign key constraint' in failures[0]['error']
+    assert [tuple(row[:2]) for row in db.rows('SELECT table_name, object_name FROM bulkloadddl')] == groups_foreign_key
+    assert {row[1] for row in saved_objects} - object_names() == {groups_foreign_key[0][1]}
+    ''' once the orphan is removed, ending the session again restores the foreign key - every object is back, validated '''
+    db.engine.execute('DELETE FROM groups WHERE ramp_id = 999999999')
+    assert end_bulk_load(db.engine) == [] and db.rows('SELECT * FROM bulkloadddl') == []
+    assert schema_objects() == saved_objects
+    assert db.rows('SELECT count(*) FROM correctedgroups')[0][0] == 2 * 64 * 72 * 4
+
+def test_staged_corrected_ingest(tmp_path, scratch_db):
+    from astropy.io import fits
+    from pixelmap import get_pixel_ids_from_header
+    ''' a subarray starting at column 360, as ILLUM does: its data pixel ids are not increasing in (row, column) order '''
+    pipeline_ready_file, corrected_ramp_file = write_test_exposure(tmp_path, substrt1=360)
+    data_pixel_ids, reference_pixel_ids = get_pixel_ids_from_header(fits.getheader(pipeline_ready_file))
+    assert not (data_pixel_ids[1:] > data_pixel_ids[:-1]).all()
+    db = scratch_db('miri_pixel_db_test_staging')
+    test_exp = os.path.basename(pipeline_ready_file)
+    ''' the staged ingest (UNLOGGED staging tables merged by INSERT ... SELECT) writes the same rows, with the same relative ids, as the direct one '''
+    db.ingest(pipeline_ready_file, corrected_ramp_file)
+    direct_fingerprint = exposure_fingerprint(db.engine, test_exp)
+    assert [direct_fingerprint[table_name][1] for table_name in ['ramps', 'groups', 'correctedramps', 'correctedgroups']] == [9216, 36864, 9216, 36864]
+    delete_exposure(db.engine, test_exp)
+    db.ingest(pipeline_ready_file, corrected_ramp_file, staging=True)
+    assert exposure_fingerprint(db.engine, test_exp) == direct_fingerprint
+    assert db.rows("SELECT count(*) FROM pg_class WHERE relname LIKE 'staging%%'")[0][0] == 0
+
+def test_dq_bitmask_flags(tmp_path, scratch_db):
+    from miridb import get_corrected_ramps_with_dq_flag
+    pipeline_ready_file, corrected_ramp_file = write_test_exposure(tmp_path)
+    flag_db, bitmask_db = scratch_db('miri_pixel_db_test_flags'), scratch_db('miri_pixel_db_test_bitmask', dq_bitmask=True)
+    for db in [flag_db, bitmask_db]:
+        db.ingest(pipeline_ready_file, corrected_ramp_file)
+    column_query = "SELECT column_name FROM information_schema.columns WHERE table_name = 'correctedramps' AND column_name IN ('dq_word', 'jump_det')"
+    assert [db.rows(column_query)[0][0] for db in [flag_db, bitmask_db]] == ['jump_det', 'dq_word']
+    ''' the flags decoded by the views of the bitmask DB are the boolean columns of the flag DB '''
+    dq_flags = list(exposuresdb.dq_val_ref.values())
+    for table_name, view_name, id_column in [('correctedramps', 'correctedrampflags', 'corr_ramp_id'), ('correctedgroups', 'correctedgroupflags', 'corr_group_id')]:
+        flag_rows = flag_db.rows('SELECT %s, %s FROM %s ORDER BY %s' % (id_column, ', '.join(dq_flags), table_name, id_column))
+        assert len(flag_rows) in (2 * 64 * 72, 2 * 64 * 72 * 4) and bitmask_db.rows('SELECT %s, %s FROM %s ORDER BY %s' % (id_column, ', '.join(dq_flags), view_name, id_column)) == flag_rows
+    ''' the synthetic corrected exposure flags groups as do_not_use, saturated and jump_det - the same ramps are found in either schema '''
+    corrected_exp_id = flag_db.rows('SELECT corrected_exp_id FROM correctedexposures')[0][0]
+    for dq_flag in dq_flags:
+        flagged_ramps = get_corrected_ramps_with_dq_flag(flag_db.engine, dq_flag, corrected_exp_id)
+        assert get_corrected_ramps_with_dq_flag(bitmask_db.engine, dq_flag, corrected_exp_id) == flagged_ramps
+        assert (len(flagged_ramps) > 0) == (dq_flag in ['do_not_use', 'saturated', 'jump_det'])
+
+def test_narrow_types_round_trip(tmp_path, scratch_db):
+    from astropy.io import fits
+    from miridb import get_exposure_cube, get_pixel_history
+    pipeline_ready_file, corrected_ramp_file = write_test_exposure(tmp_path)
+    ''' plant counts above the smallint range, which are only stored exactly with the RAW_ZERO_POINT shift '''
+    with fits.open(pipeline_ready_file, mode='update') as pipeline_ready_hdu:
+        raw_counts = pipeline_ready_hdu[1].data.copy()
+        raw_counts[0, :, 0, 0], raw_counts[1, :, 3, 5], raw_counts[1, 2, 10, 20] = 65535, 40000, 32768
+        pipeline_ready_hdu[1].data = raw_counts
+    with fits.open(pipeline_ready_file) as pipeline_ready_hdu:
+        raw_counts = pipeline_ready_hdu[1].data.astype(np.int64)
+    assert raw_counts.max() == 65535
+    narrow_db = scratch_db('miri_pixel_db_test_narrow', narrow_types=True)
+    narrow_db.ingest(pipeline_ready_file, corrected_ramp_file)
+    assert narrow_db.rows("SELECT data_type FROM information_schema.element_types WHERE object_name = 'ramps'")[0][0] == 'smallint'
+    ''' the stored values are shifted, the values read back are the original counts '''
+    assert narrow_db.rows('SELECT max(v) FROM ramps, unnest(ramp) v')[0][0] == 65535 - exposuresdb.RAW_ZERO_POINT
+    exposure_name = narrow_db.rows('SELECT exp FROM exposures')[0][0]
+    assert np.array_equal(get_exposure_cube(narrow_db.engine, exposure_name), raw_counts)
+    pixel_ids = [row[0] for row in narrow_db.rows('SELECT DISTINCT pixel_id FROM ramps')]
+    history = get_pixel_history(narrow_db.engine, pixel_ids=pixel_ids)
+    assert (history['ngroups'] == 4).all() and np.array_equal(np.sort(history['raw_ramp'].ravel()), np.sort(raw_counts.ravel()))
+    ''' a buffer that does not fit its narrow column is refused rather than rounded '''
+    with pytest.raises(ValueError):
+        exposuresdb.prepare_copy({'slope_value': np.zeros(3)}, 'correctedramps', {'slope_value': (700, None)})
+
+def test_pixel_history_fetch_size(tmp_path, scratch_db):
+    from astropy.io import fits
+    from miridb import get_pixel_history
+    ''' two exposures of different ramp lengths, in a narrow_types DB whose raw values are read back with the RAW_ZERO_POINT added '''
+    history_db = scratch_db('miri_pixel_db_test_history', narrow_types=True)
+    raw_counts = []
+    for ngroups in [4, 6]:
+        os.mkdir(str(tmp_path / str(ngroups)))
+        pipeline_ready_file, corrected_ramp_file = write_test_exposure(tmp_path / str(ngroups), ngroups=ngroups)
+        history_db.ingest(pipeline_ready_file, corrected_ramp_file)
+        with fits.open(pipeline_ready_file) as pipeline_ready_hdu:
+            raw_counts.append(pipeline_ready_hdu[1].data.astype(np.int64))
+    pixel_ids = [row[0] for row in history_db.rows('SELECT DISTINCT pixel_id FROM ramps ORDER BY pixel_id LIMIT 10')]
+    ''' 10 pixels x 2 integrations x 2 exposures = 40 ramps, fetched 7 at a time: the batches of the first exposure hold 4 group ramps only '''
+    history = get_pixel_history(history_db.engine, pixel_ids=pixel_ids, fetch_size=7)
+    assert np.array_equal(history['ngroups'], [4] * 20 + [6] * 20)
+    assert history['raw_ramp'].shape == (40, 6) and (history['raw_ramp'][:20, 4:] == -1).all() and np.isnan(history['corrected_ramp'][:20, 4:]).all()
+    assert (history['corrected_exp_id'] > 0).all()
+    for name, values in get_pixel_history(history_db.engine, pixel_ids=pixel_ids).items():
+        assert np.array_equal(history[name], values, equal_nan=values.dtype.kind == 'f')
+    ''' the raw ramps are the original counts of the pixel ramps '''
+    for exposure_counts, exposure_ramps in zip(raw_counts, [history['raw_ramp'][:20, :4], history['raw_ramp'][20:]]):
+        pixel_ramps = exposure_counts.transpose(0, 2, 3, 1).reshape(-1, exposure_counts.shape[1])
+        assert all((pixel_ramps == ramp).all(axis=1).any() for ramp in exposure_ramps)
+
+def test_pixel_stats(tmp_path, scratch_db):
+    from astropy.io import fits
+    from miridb import get_pixel_stats, get_dq_flag_totals, get_exposure_pixel_stats, pixel_stats_dtypes, pixel_stats_value_columns
+    from pixelmap import get_full_frame_positions, get_subarray_positions
+    pipeline_ready_file, corrected_ramp_file = write_test_exposure(tmp_path)
+    stats_db = scratch_db('miri_pixel_db_test_stats')
+    stats_db.ingest(pipeline_ready_file, corrected_ramp_file)
+    ''' the expected summary, accumulated from the corrected files in a single chunk '''
+    with fits.open(corrected_ramp_file) as corrected_ramp_hdu, fits.open(corrected_ramp_file.replace('_ramp.fits', '_rateints.fits')) as slope_hdu:
+        corrected_ramps, dq_ramps, slopes = corrected_ramp_hdu['SCI'].data, corrected_ramp_hdu['GROUPDQ'].data, slope_hdu['SCI'].data
+        nints, ngroups, nrows, ncols = corrected_ramps.shape
+        expected = exposuresdb.init_pixel_stats(nints, ngroups, nrows * ncols)
+        exposuresdb.accumulate_pixel_stats(expected, slice(0, nints), slice(0, nrows * ncols), slopes.reshape(-1),
+                                           exposuresdb.get_ramps_and_groups_column_data(corrected_ramps)[0], exposuresdb.get_ramps_and_groups_column_data(dq_ramps)[0])
+    expected = exposuresdb.get_pixel_stats_columns(expected, None, None, None)
+    pixel_ids = [row[0] for row in stats_db.rows('SELECT pixel_id FROM pixelstats')]
+    pixel_stats = get_pixel_stats(stats_db.engine, pixel_ids=pixel_ids)
+    assert len(pixel_stats['pixel_id']) == nrows * ncols and (pixel_stats['first_saturated_group'] > 0).any()
+    ''' each pixel is compared with its row-major subarray position '''
+    full_rows, full_cols = get_full_frame_positions(pixel_stats['pixel_id'])
+    pixel_rows, pixel_cols = get_subarray_positions(pixel_stats['pixel_id'], (full_rows.min(), full_cols.min()))
+    positions = pixel_rows * ncols + pixel_cols
+    for column in pixel_stats_value_columns + ['dq_flag_counts']:
+        assert pixel_stats[column].dtype == np.dtype(pixel_stats_dtypes[column])
+        expected_values = np.broadcast_to(expected[column], (nrows * ncols,) + np.shape(expected[column])[1:])[positions]
+        assert np.array_equal(pixel_stats[column], expected_values, equal_nan=pixel_stats[column].dtype.kind == 'f')
+    corrected_exp_id = pixel_stats['corrected_exp_id'][0]
+    sorted_positions = positions[np.argsort(pixel_stats['pixel_id'])]
+    for column in pixel_stats_value_columns:
+        exposure_pixel_ids, values = get_exposure_pixel_stats(stats_db.engine, corrected_exp_id, column)
+        assert np.array_equal(exposure_pixel_ids, np.sort(pixel_stats['pixel_id'])) and values.dtype == np.dtype(pixel_stats_dtypes[column])
+        assert np.array_equal(values, pixel_stats[column][np.argsort(pixel_stats['pixel_id'])], equal_nan=values.dtype.kind == 'f')
+    for k, dq_flag in enumerate(exposuresdb.dq_val_ref.values()):
+        flagged_pixel_ids, totals = get_dq_flag_totals(stats_db.engine, dq_flag)
+        assert np.array_equal(flagged_pixel_ids, np.sort(pixel_stats['pixel_id'])) and np.array_equal(totals, expected['dq_flag_counts'][sorted_positions, k])
+
+def test_reserve_id_block_transaction(scratch_db):
+    ''' reserving ids stays in the caller's transaction: rolling it back drops the row inserted before, but not the reserved block '''
+    id_db = scratch_db('miri_pixel_db_test_ids')
+    connection = id_db.connection
+    cursor = connection.cursor()
+    cursor.execute("INSERT INTO detectors (detector_id, name) VALUES (99, 'rolled back')")
+    first_id = exposuresdb.reserve_id_block('ramps', 'ramp_id', 1000, connection)
+    assert exposuresdb.reserve_id_block('ramps', 'ramp_id', 10, connection) == first_id + 1000
+    assert id_db.rows("SELECT count(*) FROM pg_locks WHERE locktype = 'advisory'")[0][0] == 0
+    connection.rollback()
+    assert id_db.rows('SELECT count(*) FROM detectors WHERE detector_id = 99')[0][0] == 0
+    assert exposuresdb.reserve_id_block('ramps', 'ramp_id', 1, connection) == first_id + 1010
+    connection.commit()
+    cursor.close()
@@ -0,0 +1,31 @@
+'''
+Unit tests for the memory-mapped FITS reader in fitsreader.py - slices of an ImageCube must match what astropy returns
+when it loads and scales the whole extension.
+'''
+import sys
+sys.path.append("..")
+import numpy as np
+from astropy.io import fits
+from fitsreader import open_fits, read_image_cube
+
+def test_read_image_cube(tmp_path):
+    rng = np.random.RandomState(17)
+    raw_ramps = rng.randint(0, 65536, size=(2, 3, 4, 5)).astype(np.uint16)
+    err = rng.randn(2, 3, 4, 5).astype(np.float32)
+    scaled = rng.randint(-100, 100, size=(4, 5)).astype(np.int16)
+    hdulist = fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(raw_ramps, name='SCI'), fits.ImageHDU(err, name='ERR'), fits.ImageHDU(scaled, name='SCALED')])
+    hdulist['SCALED'].header['BSCALE'] = 0.5
+    hdulist['SCALED'].header['BZERO'] = 10.0
+    file_path = str(tmp_path / 'cube.fits')
+    hdulist.writeto(file_path)
+    with fits.open(file_path) as reference_hdu, open_fits(file_path) as hdu:
+        ''' uint16 data (stored as int16 with BZERO = 32768) keeps its integer dtype '''
+        sci = read_image_cube(hdu, 'SCI')
+        assert sci.shape == raw_ramps.shape and sci.dtype == np.uint16
+        assert np.array_equal(sci[1, :, 1:3], raw_ramps[1, :, 1:3]) and sci[1, :, 1:3].dtype.kind == 'u'
+        assert np.array_equal(sci.reshape(2, 3, -1)[:, :, 7], raw_ramps.reshape(2, 3, -1)[:, :, 7])
+        ''' unscaled data is returned in the file's byte order '''
+        err_slice = read_image_cube(hdu, 'ERR')[0, 2]
+        assert np.array_equal(err_slice, err[0, 2]) and err_slice.dtype == np.dtype('>f4')
+        ''' general BSCALE/BZERO scaling matches astropy '''
+        assert np.allclose(read_image_cube(hdu, 'SCALED')[:], reference_hdu['SCALED'].data)
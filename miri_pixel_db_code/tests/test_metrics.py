@@ -0,0 +1,60 @@
+'''
+Unit tests for metrics.py - nothing is logged while metrics are off, the stages measured in a scope (in any thread) are aggregated into one
+line per stage plus the scope's total, and summarize_metrics sums a log by scope and stage.
+'''
+import sys
+sys.path.append("..")
+import threading
+import pytest
+from metrics import enable_metrics, disable_metrics, measure, measured, metrics_scope, instrumented, read_metrics, summarize_metrics
+
+@pytest.fixture
+def metrics_log(tmp_path):
+    log_path = str(tmp_path / 'metrics.jsonl')
+    enable_metrics(log_path)
+    yield log_path
+    disable_metrics()
+
+def test_metrics_disabled(tmp_path):
+    disable_metrics()
+    with metrics_scope('raw_ingest', 'exposure.fits'):
+        with measure('copy') as stage:
+            stage['rows'] = 10
+    assert not list(tmp_path.iterdir())
+
+def test_metrics_scope(metrics_log):
+    @measured('reshape')
+    def reshape():
+        pass
+    def serialize():
+        with measure('serialize') as stage:
+            stage['bytes'] = 100
+    with metrics_scope('raw_ingest', 'exposure.fits'):
+        for chunk in range(3):
+            reshape()
+            ''' as in a PrefetchIterator, a stage measured in a background thread belongs to the open scope '''
+            thread = threading.Thread(target=serialize)
+            thread.start()
+            thread.join()
+            with measure('copy') as stage:
+                stage['rows'], stage['bytes'] = 5, 100
+    records = {record['stage']: record for record in read_metrics(metrics_log)}
+    assert list(records) == ['reshape', 'serialize', 'copy', 'total']
+    assert all(record['scope'] == 'raw_ingest' and record['exposure'] == 'exposure.fits' for record in records.values())
+    assert records['copy']['calls'] == 3 and records['copy']['rows'] == 15 and records['copy']['bytes'] == 300
+    assert records['serialize']['calls'] == 3 and records['serialize']['bytes'] == 300
+    assert records['total']['rows'] == 15 and records['total']['wall_seconds'] >= records['copy']['wall_seconds']
+
+def test_instrumented(metrics_log):
+    @instrumented('pipeline_ready_file')
+    def create_file(full_data_path):
+        with measure('fits_write') as stage:
+            stage['bytes'] = 2880
+        return full_data_path
+    assert create_file('/data/exposure.fits') == '/data/exposure.fits'
+    with measure('commit'):
+        pass
+    summary = summarize_metrics(read_metrics(metrics_log) * 2)
+    assert set(summary) == {('pipeline_ready_file', 'fits_write'), ('pipeline_ready_file', 'total'), (None, 'commit')}
+    assert summary[('pipeline_ready_file', 'fits_write')]['calls'] == 2 and summary[('pipeline_ready_file', 'fits_write')]['bytes'] == 5760
+    assert [record['exposure'] for record in read_metrics(metrics_log)] == ['exposure.fits', 'exposure.fits', None]
@@ -0,0 +1,42 @@
+'''
+Unit tests for get_pixel_history_batch in miridb.py - the rows of the get_pixel_history query are built by hand (no database needed).
+'''
+import sys
+sys.path.append("..")
+import datetime
+import numpy as np
+from miridb import get_pixel_history_batch, pixel_history_scalar_columns, pixel_history_ramp_columns, pixel_history_padding
+
+''' One row of the get_pixel_history query: pixel_id, exp_id, t0, intnumber, ramp, corrected_exp_id, slope_value, dq_word, corrected_ramp, err_ramp, dq_ramp '''
+def history_row(pixel_id, ramp, corrected_exp_id=None, intnumber=1):
+    t0 = datetime.datetime(2018, 3, 8, 1, 2, 30)
+    if corrected_exp_id is None:
+        return (pixel_id, 7, t0, intnumber, ramp, None, None, None, None, None, None)
+    corrected_ramp = [value + 0.5 for value in ramp]
+    return (pixel_id, 7, t0, intnumber, ramp, corrected_exp_id, 1.25, 6, corrected_ramp, [0.1] * len(ramp), [0, 2] + [4] * (len(ramp) - 2))
+
+def test_pixel_history_batch():
+    rows = [history_row(101, [10, 20, 30, 40], corrected_exp_id=3), history_row(102, [11, 21, 31, 41]), history_row(103, [12, 22, 32, 42, 52, 62], 4, 2)]
+    batch = get_pixel_history_batch(rows)
+    assert np.array_equal(batch['pixel_id'], [101, 102, 103]) and np.array_equal(batch['intnumber'], [1, 1, 2])
+    assert batch['t0'].dtype == np.dtype('datetime64[us]') and batch['t0'][0] == np.datetime64('2018-03-08T01:02:30')
+    ''' the ramp without a corrected ramp gets corrected_exp_id -1, a NaN slope, dq_word 0 and padded corrected ramps '''
+    assert np.array_equal(batch['corrected_exp_id'], [3, -1, 4])
+    assert batch['slope_value'][0] == 1.25 and np.isnan(batch['slope_value'][1])
+    assert np.array_equal(batch['dq_word'], [6, 0, 6])
+    assert np.isnan(batch['corrected_ramp'][1]).all() and np.isnan(batch['err_ramp'][1]).all() and (batch['dq_ramp'][1] == 0).all()
+    ''' ramps of different lengths are padded to the longest one '''
+    assert np.array_equal(batch['ngroups'], [4, 4, 6])
+    assert batch['raw_ramp'].shape == (3, 6) and batch['raw_ramp'].dtype == np.int32
+    assert np.array_equal(batch['raw_ramp'], [[10, 20, 30, 40, -1, -1], [11, 21, 31, 41, -1, -1], [12, 22, 32, 42, 52, 62]])
+    assert np.array_equal(batch['corrected_ramp'][0, :4], [10.5, 20.5, 30.5, 40.5]) and np.isnan(batch['corrected_ramp'][0, 4:]).all()
+    assert np.array_equal(batch['dq_ramp'][2], [0, 2, 4, 4, 4, 4]) and np.array_equal(batch['dq_ramp'][0], [0, 2, 4, 4, 0, 0])
+
+def test_empty_pixel_history_batch():
+    batch = get_pixel_history_batch([])
+    for name, dtype, position in pixel_history_scalar_columns:
+        assert batch[name].shape == (0,) and batch[name].dtype == np.dtype(dtype)
+    for name, dtype, position in pixel_history_ramp_columns:
+        assert batch[name].shape == (0, 0) and batch[name].dtype == np.dtype(dtype)
+    assert batch['ngroups'].shape == (0,)
+    assert set(pixel_history_padding) == set(name for name, dtype, position in pixel_history_ramp_columns)
@@ -0,0 +1,63 @@
+'''
+Unit tests for the resumable batch runner in pipebatch.py - the FITS prep and Detector1Pipeline stages are replaced by functions that
+write placeholder files, so the scheduling, retries and state file can be checked without the JWST pipeline.
+'''
+import os
+import sys
+sys.path.append("..")
+import pytest
+''' pipefits imports the JWST calibration pipeline '''
+pytest.importorskip('jwst')
+import pipebatch
+from pipebatch import run_pipeline_batch, read_batch_state, default_state_path
+
+def test_run_pipeline_batch(tmp_path, monkeypatch):
+    campaign_directory = str(tmp_path)
+    exposure_paths = [os.path.join(campaign_directory, 'exposure%d.fits' % index) for index in range(3)]
+    for exposure_path in exposure_paths:
+        open(exposure_path, 'w').close()
+    def create_pipeline_ready_file(full_data_path, data_genesis, output_dir):
+        open(full_data_path.replace('.fits', '_pipe.fits'), 'w').close()
+    ''' the Detector1Pipeline fails on exposure1 the first time it runs, leaving a partial _ramp.fits behind '''
+    def run_detector1_pipeline(raw_exposure_filepath, data_origin, reference_directory, output_dir):
+        with open(raw_exposure_filepath.replace('.fits', '_ramp.fits'), 'a') as ramp_file:
+            ramp_file.write('x')
+        failure_marker = os.path.join(output_dir, 'failed_once')
+        if 'exposure1' in raw_exposure_filepath and not os.path.exists(failure_marker):
+            open(failure_marker, 'w').close()
+            raise RuntimeError('Detector1Pipeline failed')
+        return True
+    monkeypatch.setattr(pipebatch, 'create_pipeline_ready_file', create_pipeline_ready_file)
+    monkeypatch.setattr(pipebatch, 'run_detector1_pipeline', run_detector1_pipeline)
+    state = run_pipeline_batch('test', campaign_directory, None, num_processes=2)
+    assert state == read_batch_state(default_state_path(campaign_directory))
+    assert set(state) == set(exposure_paths)
+    for exposure_path in exposure_paths:
+        assert state[exposure_path]['completed'] == ['pipe', 'detector1'] and state[exposure_path]['error'] is None
+        ''' the failed attempt was retried, after its partial output was removed '''
+        with open(exposure_path.replace('.fits', '_pipe_ramp.fits')) as ramp_file:
+            assert ramp_file.read() == 'x'
+    assert state[exposure_paths[1]]['attempts'] == {'pipe': 1, 'detector1': 2}
+    ''' a rerun skips every completed stage '''
+    assert run_pipeline_batch('test', campaign_directory, None, num_processes=2) == state
+
+def test_pipe_stage_os_error(tmp_path, monkeypatch):
+    import errno
+    import pipefits
+    campaign_directory = str(tmp_path)
+    exposure_paths = [os.path.join(campaign_directory, 'exposure%d.fits' % index) for index in range(2)]
+    for exposure_path in exposure_paths:
+        open(exposure_path, 'w').close()
+    ''' exposure0 is already prepared, exposure1 runs out of disk space - only an existing output is skipped by create_pipeline_ready_file '''
+    def Generate_JPL_Pipeline_Ready_File(file_path, output_dir):
+        if 'exposure0' in file_path:
+            raise FileExistsError('File %r already exists.' % file_path.replace('.fits', '_pipe.fits'))
+        raise OSError(errno.ENOSPC, 'No space left on device')
+    open(exposure_paths[0].replace('.fits', '_pipe.fits'), 'w').close()
+    monkeypatch.setattr(pipefits, 'Generate_JPL_Pipeline_Ready_File', Generate_JPL_Pipeline_Ready_File)
+    monkeypatch.setattr(pipebatch, 'run_detector1_pipeline', lambda raw_exposure_filepath, data_origin, reference_directory, output_dir:
+                        open(raw_exposure_filepath.replace('.fits', '_ramp.fits'), 'w').close())
+    state = run_pipeline_batch('test', campaign_directory, None, num_processes=2, max_retries=0)
+    assert state[exposure_paths[0]]['completed'] == ['pipe', 'detector1']
+    ''' the state file records the real cause of the failure '''
+    assert state[exposure_paths[1]]['completed'] == [] and 'No space left on device' in state[exposure_paths[1]]['error']
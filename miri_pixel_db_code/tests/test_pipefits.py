@@ -0,0 +1,60 @@
+'''
+Unit tests for the pipeline ready file writer in pipefits.py - the vectorized split and the streamed file must match the original
+chunk-by-chunk reorganization of the LVL1 cube.
+'''
+import sys
+sys.path.append("..")
+import numpy as np
+import pytest
+from astropy.io import fits
+from fitsreader import open_fits
+''' pipefits imports the JWST calibration pipeline '''
+pytest.importorskip('jwst')
+from pipefits import chunks, split_data_and_refout, pipeline_ready_hdus, write_pipeline_ready_file, write_streamed_fits
+
+def test_write_pipeline_ready_file(tmp_path):
+    rng = np.random.RandomState(20)
+    ngroups, nrows, ncols = 3, 8, 12
+    lvl1_data = rng.randint(0, 65536, size=(2 * ngroups, nrows + nrows // 4, ncols)).astype(np.uint16)
+    primaryhdu = fits.PrimaryHDU(lvl1_data)
+    primaryhdu.header['ROWSTART'] = 1
+    primaryhdu.header['NGROUP'] = ngroups
+    lvl1_path = str(tmp_path / 'lvl1.fits')
+    primaryhdu.writeto(lvl1_path)
+    ''' the reorganization split_data_and_refout used to do with chunks '''
+    refout = np.array([np.array(list(chunks(dat.flatten(), nrows))).transpose() for dat in lvl1_data[:, nrows:]])
+    expected_sci = np.array(list(chunks(lvl1_data[:, :nrows], ngroups)))
+    expected_refout = np.array(list(chunks(refout, ngroups)))
+    with open_fits(lvl1_path) as hdu:
+        split_hdus = split_data_and_refout(hdu)
+        assert np.array_equal(split_hdus['SCI'].data, expected_sci) and np.array_equal(split_hdus['REFOUT'].data, expected_refout)
+        split_hdus.writeto(str(tmp_path / 'split.fits'))
+        ''' the streamed file is byte-for-byte the file written from the in-memory split, header edits included '''
+        pipeline_hdus = pipeline_ready_hdus(hdu)
+        pipeline_hdus[0].header.rename_keyword('NGROUP', 'NGROUPS')
+        write_pipeline_ready_file(hdu, pipeline_hdus, str(tmp_path / 'streamed.fits'))
+    with fits.open(str(tmp_path / 'split.fits')) as split_hdu:
+        split_hdu[0].header.rename_keyword('NGROUP', 'NGROUPS')
+        split_hdu.writeto(str(tmp_path / 'split_renamed.fits'))
+    with open(str(tmp_path / 'split_renamed.fits'), 'rb') as split_file, open(str(tmp_path / 'streamed.fits'), 'rb') as streamed_file:
+        assert split_file.read() == streamed_file.read()
+
+def test_write_streamed_fits_existing_file(tmp_path):
+    output_path = str(tmp_path / 'exposure_pipe.fits')
+    hdulist = fits.HDUList([fits.PrimaryHDU(np.broadcast_to(np.zeros(1, dtype=np.int16), (2, 4)))])
+    write_streamed_fits(hdulist, [[np.ones((2, 4), dtype=np.int16)]], output_path)
+    ''' an existing file is left alone, as HDUList.writeto does - create_pipeline_ready_file relies on the FileExistsError to skip it '''
+    with pytest.raises(FileExistsError):
+        write_streamed_fits(hdulist, [[np.full((2, 4), 2, dtype=np.int16)]], output_path)
+    with fits.open(output_path) as hdu:
+        assert np.all(hdu[0].data == 1)
+    ''' an interrupted write leaves neither a truncated file nor its temporary file '''
+    def failing_blocks():
+        yield np.full((1, 4), 3, dtype=np.int16)
+        raise KeyboardInterrupt
+    with pytest.raises(KeyboardInterrupt):
+        write_streamed_fits(hdulist, [failing_blocks()], output_path, overwrite=True)
+    assert [path.name for path in tmp_path.iterdir()] == ['exposure_pipe.fits']
+    write_streamed_fits(hdulist, [[np.full((2, 4), 3, dtype=np.int16)]], output_path, overwrite=True)
+    with fits.open(output_path) as hdu:
+        assert np.all(hdu[0].data == 3)
@@ -0,0 +1,28 @@
+'''
+Unit tests for the closed-form subarray pixel ids in pixelmap.py - they must match the ids found by slicing the full frame array built by
+exposuresdb.generate_structured_coordinates (no database needed).
+'''
+import sys
+sys.path.append("..")
+import numpy as np
+from exposuresdb import get_pixel_coordinates_for_subarray, generate_structured_coordinates
+from pixelmap import get_subarray_pixel_ids, get_full_frame_positions, get_subarray_positions, subarray_definitions
+
+def test_get_subarray_pixel_ids():
+    data_coords, ref_coords_reshape = generate_structured_coordinates()
+    ''' every named subarray, plus subarrays whose first column is not a multiple of 4 and one running past the last data row '''
+    subarrays = [(tuple(first_pix), tuple(size)) for first_pix, size in subarray_definitions.values()]
+    subarrays += [((2, 3), (77, 50)), ((7, 900), (13, 9)), ((1000, 1), (33, 10)), ((1, 1000), (72, 64))]
+    for first_pix, size in subarrays:
+        data_pixel_ids, reference_pixel_ids = get_pixel_coordinates_for_subarray(data_coords, ref_coords_reshape, first_pix, size)
+        assert np.array_equal(get_subarray_pixel_ids(first_pix, size)[0], data_pixel_ids)
+        assert np.array_equal(get_subarray_pixel_ids(first_pix, size)[1], reference_pixel_ids)
+    assert get_subarray_pixel_ids((1, 779), (72, 64))[0][0] == 802897
+
+def test_get_subarray_positions():
+    ''' FULL, SUB64 and unaligned subarrays - the unaligned ones pick up reference pixel ids in their data columns '''
+    for first_pix, size in [((1, 1), (1032, 1024)), ((1, 779), (72, 64)), ((413, 1), (516, 512)), ((2, 3), (77, 50)), ((7, 900), (13, 9))]:
+        pixel_ids = get_subarray_pixel_ids(first_pix, size)[0]
+        full_rows, full_cols = get_full_frame_positions(pixel_ids)
+        rows, cols = get_subarray_positions(pixel_ids, (full_rows.min(), full_cols.min()))
+        assert np.array_equal(rows * size[0] + cols, np.arange(size[0] * size[1]))
@@ -0,0 +1,35 @@
+'''
+Unit tests for the PrefetchIterator in prefetch.py - items come out in order, a failing generator raises in the consuming thread, and
+leaving the with block early stops the background thread and closes the generator.
+'''
+import sys
+sys.path.append("..")
+import pytest
+from prefetch import PrefetchIterator
+
+@pytest.mark.parametrize('depth', [0, 1, 3])
+def test_prefetch_order(depth):
+    with PrefetchIterator((number * number for number in range(50)), depth) as squares:
+        assert list(squares) == [number * number for number in range(50)]
+
+def test_prefetch_error():
+    def failing_items():
+        yield 1
+        raise ValueError('bad chunk')
+    with PrefetchIterator(failing_items()) as items:
+        assert next(items) == 1
+        with pytest.raises(ValueError, match='bad chunk'):
+            next(items)
+        assert list(items) == []
+
+def test_prefetch_close():
+    closed = []
+    def items():
+        try:
+            for number in range(1000):
+                yield number
+        finally:
+            closed.append(True)
+    with PrefetchIterator(items(), depth=2) as prefetched:
+        assert next(prefetched) == 0
+    assert not prefetched.thread.is_alive() and closed == [True]
@@ -0,0 +1,53 @@
+'''
+Unit tests for the on-disk cache in querycache.py - entries are written to and read from a temporary directory (no postgresql database needed).
+'''
+import os
+import sys
+sys.path.append("..")
+import numpy as np
+from sqlalchemy import create_engine
+from querycache import read_cache_entry, write_cache_entry, clear_cache, cached_query
+
+def test_cache_entries(tmp_path):
+    cache_dir = str(tmp_path)
+    dependencies = {'database': 'db', 'exp_ids': [1], 'corrected_exp_ids': []}
+    result = {'raw_ramp': np.arange(12, dtype=np.int32).reshape(3, 4), 't0': np.array(['2018-03-08T01:02:30'], dtype='datetime64[us]')}
+    assert read_cache_entry(cache_dir, 'a') is None
+    write_cache_entry(cache_dir, 'a', result, dependencies, max_bytes=10**6)
+    cached = read_cache_entry(cache_dir, 'a')
+    assert sorted(cached) == sorted(result)
+    assert all(np.array_equal(cached[name], result[name]) for name in result)
+    ''' entries are evicted least recently used first once the cache is over max_bytes - reading 'a' makes 'b' the oldest '''
+    entry_bytes = os.path.getsize(os.path.join(cache_dir, 'a.npz'))
+    write_cache_entry(cache_dir, 'b', result, dependencies, max_bytes=10**6)
+    os.utime(os.path.join(cache_dir, 'a.npz'), (0, 0))
+    os.utime(os.path.join(cache_dir, 'b.npz'), (1, 1))
+    read_cache_entry(cache_dir, 'a')
+    write_cache_entry(cache_dir, 'c', result, dependencies, max_bytes=2 * entry_bytes)
+    assert read_cache_entry(cache_dir, 'b') is None
+    assert read_cache_entry(cache_dir, 'a') is not None and read_cache_entry(cache_dir, 'c') is not None
+    clear_cache(cache_dir)
+    assert os.listdir(cache_dir) == []
+
+def test_unfinished_ingest_not_cached(tmp_path):
+    cache_dir = str(tmp_path)
+    ''' an in-memory DB holding the exposure tables the cache is pruned against '''
+    engine = create_engine('sqlite://')
+    engine.execute('CREATE TABLE exposures (exp_id integer)')
+    engine.execute('CREATE TABLE correctedexposures (corrected_exp_id integer)')
+    engine.execute('INSERT INTO exposures VALUES (1), (2)')
+    engine.execute('INSERT INTO correctedexposures VALUES (7)')
+    dependencies = {'exp_ids': [1, 2], 'corrected_exp_ids': [7]}
+    calls = []
+    def query_function():
+        calls.append(True)
+        return {'cube': np.full(3, len(calls))}
+    ''' while exposure 2 (or corrected exposure 7) is being ingested the query runs every time, and nothing is cached '''
+    for unfinished_ids in [{'exp_ids': {2}, 'corrected_exp_ids': set()}, {'exp_ids': set(), 'corrected_exp_ids': {7}}]:
+        result = cached_query(engine, 'exposure_cube', {}, dependencies, query_function, cache_dir, 10**6, unfinished_ids)
+        assert np.all(result['cube'] == len(calls)) and os.listdir(cache_dir) == []
+    ''' once the ingests are complete the result is cached, so the partial results above are never returned '''
+    unfinished_ids = {'exp_ids': {3}, 'corrected_exp_ids': set()}
+    first = cached_query(engine, 'exposure_cube', {}, dependencies, query_function, cache_dir, 10**6, unfinished_ids)
+    second = cached_query(engine, 'exposure_cube', {}, dependencies, query_function, cache_dir, 10**6, unfinished_ids)
+    assert len(calls) == 3 and np.all(first['cube'] == 3) and np.all(second['cube'] == 3)
@@ -0,0 +1,104 @@
+'''
+Unit tests for the vectorized ingest transforms in exposuresdb.py. Each vectorized method is checked against the
+original per-element implementation it replaces, on small random inputs (no database needed).
+'''
+import sys
+sys.path.append("..")
+import numpy as np
+from exposuresdb import decode_dq_flags, return_dq_flags, dq_val_ref, get_ramps_and_groups_column_data, transform_ramp, prep_ramps_for_db, iterate_ramp_chunks, take_ids, shift_raw_values, RAW_ZERO_POINT
+from exposuresdb import init_pixel_stats, accumulate_pixel_stats, get_pixel_stats_columns
+
+def test_decode_dq_flags():
+    rng = np.random.RandomState(5582)
+    dq_ramps = (rng.randint(0, 2, size=(40, 7, 31)) * (rng.rand(40, 7, 31) < 0.05) << np.arange(31)).sum(axis=2).astype(np.uint32)
+    dq_ramps[3, 2] = 287312209
+    group_flags, ramp_flags = decode_dq_flags(dq_ramps)
+    ''' reference: the per-group return_dq_flags loop previously used in add_corrected_exposure_to_db '''
+    possible_dq_vals = [2**k for k in range(0,31)]
+    dq_value_pose_dict = dict(zip(possible_dq_vals, range(0,len(possible_dq_vals))))
+    expected = np.array([[return_dq_flags(int(flag), possible_dq_vals, dq_value_pose_dict, 31) for flag in ramp] for ramp in dq_ramps], dtype=bool)
+    for k, name in enumerate(dq_val_ref.values()):
+        assert np.array_equal(group_flags[name], expected[:, :, k].reshape(-1))
+        assert np.array_equal(ramp_flags[name], expected[:, :, k].any(axis=1))
+
+def test_get_ramps_and_groups_column_data():
+    ramp_data = np.arange(3*5*4*6, dtype=np.uint16).reshape(3, 5, 4, 6)
+    all_ramps, all_groups = get_ramps_and_groups_column_data(ramp_data)
+    ''' reference: flatten each frame, transpose, and chain the integrations (previous implementation) '''
+    expected = np.array([ramp for integration in ramp_data for ramp in np.transpose([frame.flatten() for frame in integration])])
+    assert np.array_equal(all_ramps, expected)
+    assert np.array_equal(all_groups, expected.flatten())
+    assert all_ramps.flags['C_CONTIGUOUS'] and np.shares_memory(all_ramps, all_groups)
+    assert np.array_equal(transform_ramp(ramp_data[1]), expected[24:48])
+
+def test_prep_ramps_for_db():
+    rng = np.random.RandomState(89)
+    ''' integer ramps: literals hold exactly the same numbers as the ramps '''
+    int_ramps = rng.randint(-70000, 70000, size=(30, 11))
+    int_ramps[0] = 0
+    literals = prep_ramps_for_db(int_ramps)
+    assert all(literal[0] == '{' and literal[-1] == '}' for literal in literals)
+    assert np.array_equal(np.array([[int(v) for v in literal[1:-1].split(',')] for literal in literals]), int_ramps)
+    ''' float32 ramps (pipeline products): the default 9 significant digits reproduce every float32 value exactly '''
+    float_ramps = (rng.randn(30, 11) * 10.0**rng.randint(-30, 30, size=(30, 11))).astype(np.float32)
+    float_ramps[1, :4] = [0.0, np.nan, np.inf, -np.inf]
+    literals = prep_ramps_for_db(float_ramps)
+    parsed = np.array([[float(v.replace('Infinity', 'inf')) for v in literal[1:-1].split(',')] for literal in literals], dtype=np.float32)
+    assert np.array_equal(parsed, float_ramps, equal_nan=True)
+    ''' float_digits sets the precision '''
+    assert prep_ramps_for_db(np.array([[-1.37e-5, 9.99996]]), float_digits=4)[0] == '{-1.370e-005, 1.000e+001}'
+
+def test_iterate_ramp_chunks():
+    ramp_data = np.arange(3*5*7*6, dtype=np.uint16).reshape(3, 5, 7, 6)
+    all_ramps, all_groups = get_ramps_and_groups_column_data(ramp_data)
+    for chunk_rows in [None, 1, 3, 7, 10]:
+        ''' chunks cover every ramp of the exposure exactly once, and each chunk holds the ramps at its ramp positions '''
+        covered = np.zeros(len(all_ramps), dtype=int)
+        for int_slice, row_slice, ramp_positions in iterate_ramp_chunks(ramp_data.shape, chunk_rows):
+            chunk_ramps, chunk_groups = get_ramps_and_groups_column_data(ramp_data[int_slice, :, row_slice])
+            assert np.array_equal(chunk_ramps, all_ramps[ramp_positions])
+            covered[ramp_positions] += 1
+        assert (covered == 1).all()
+    positions = np.array([4, 0, 2])
+    assert np.array_equal(take_ids(range(100, 110), positions), [104, 100, 102])
+    assert np.array_equal(take_ids(np.arange(100, 110), positions), [104, 100, 102])
+
+def test_shift_raw_values():
+    raw_values = np.array([[0, 1, 32767], [32768, 50000, 65535]], dtype=np.uint16)
+    shifted = shift_raw_values(raw_values, RAW_ZERO_POINT)
+    assert shifted.dtype == np.int16
+    assert np.array_equal(shifted.astype(np.int64) + RAW_ZERO_POINT, raw_values)
+    assert np.array_equal(shift_raw_values(raw_values.astype(np.int32), RAW_ZERO_POINT), shifted)
+    assert shift_raw_values(raw_values, 0) is raw_values
+    try:
+        shift_raw_values(np.array([70000]), RAW_ZERO_POINT)
+        assert False
+    except ValueError:
+        pass
+
+def test_accumulate_pixel_stats():
+    rng = np.random.RandomState(18)
+    nints, ngroups, nrows, ncols = 3, 6, 5, 4
+    corrected_data = rng.randn(nints, ngroups, nrows, ncols).astype(np.float32)
+    corrected_data[:, :, 0, 0] = np.nan
+    dq_data = (rng.rand(nints, ngroups, nrows, ncols) < 0.2).astype(np.uint32) * 2 + (rng.rand(nints, ngroups, nrows, ncols) < 0.1).astype(np.uint32) * 4
+    slope_data = rng.randn(nints, nrows, ncols)
+    ''' chunked accumulation gives the same summary as a single chunk, and matches the statistics computed on the whole cube '''
+    columns = []
+    for chunk_rows in [None, 2]:
+        pixel_stats = init_pixel_stats(nints, ngroups, nrows * ncols)
+        for int_slice, row_slice, ramp_positions in iterate_ramp_chunks(corrected_data.shape, chunk_rows):
+            corrected_ramps = get_ramps_and_groups_column_data(corrected_data[int_slice, :, row_slice])[0]
+            dq_ramps = get_ramps_and_groups_column_data(dq_data[int_slice, :, row_slice])[0]
+            accumulate_pixel_stats(pixel_stats, int_slice, slice(row_slice.start * ncols, row_slice.stop * ncols), slope_data[int_slice, row_slice].reshape(-1), corrected_ramps, dq_ramps)
+        columns.append(get_pixel_stats_columns(pixel_stats, np.arange(nrows * ncols), 1, 2))
+    for name in columns[0]:
+        assert np.array_equal(columns[0][name], columns[1][name], equal_nan=True)
+    pixel_dq = dq_data.reshape(nints, ngroups, -1)
+    saturated = (pixel_dq & 2) != 0
+    first_saturated = np.where(saturated.any(axis=1), saturated.argmax(axis=1) + 1, ngroups + 1).min(axis=0)
+    assert np.array_equal(columns[0]['first_saturated_group'], np.where(first_saturated > ngroups, 0, first_saturated))
+    assert np.array_equal(columns[0]['dq_flag_counts'][:, 1], saturated.sum(axis=(0, 1)))
+    assert np.array_equal(columns[0]['dq_flag_counts'][:, 2], ((pixel_dq & 4) != 0).sum(axis=(0, 1)))
+    assert np.allclose(columns[0]['median_slope'], np.median(slope_data.reshape(nints, -1), axis=0))
+    assert np.isnan(columns[0]['corrected_max'][0]) and np.allclose(columns[0]['corrected_max'][1:], corrected_data.reshape(nints, ngroups, -1).max(axis=(0, 1))[1:])